@@ -0,0 +1,157 @@
+"""
+Admission control of the requests
+
+Only a limited number of requests are served at once, the rest wait in a
+bounded queue ordered by the priority of their class. When the queue is full
+or they wait for too long, requests are rejected right away with a 503 so
+clients can retry later instead of piling up.
+"""
+
+import asyncio
+import itertools
+from bisect import insort
+from collections import Counter
+
+from starlette.responses import JSONResponse
+
+
+class Overloaded(Exception):
+    pass
+
+
+class AdmissionController:
+    """
+    Limits the requests running at once to limit, with at most queue_size
+    waiting for up to timeout seconds. classes maps the name of a class of
+    requests to its (priority, limit), lower priorities are served first and
+    limit (if not None) is the maximum of requests of the class running at
+    once. Requests of unknown classes have priority 0 and no class limit
+    """
+
+    def __init__(self, limit, queue_size=0, timeout=None, classes=None):
+        self.limit = limit
+        self.queue_size = queue_size
+        self.timeout = timeout
+        self.classes = classes or {}
+        self.active = 0
+        self._class_active = Counter()
+        # sorted list of (priority, seq, class, future)
+        self._waiters = []
+        self._seq = itertools.count()
+        self.admitted = 0
+        self.queued = 0
+        self.rejected = 0
+
+    def _policy(self, cls):
+        return self.classes.get(cls, (0, None))
+
+    def _can_run(self, cls):
+        limit = self._policy(cls)[1]
+        return self.active < self.limit and (
+            limit is None or self._class_active[cls] < limit
+        )
+
+    def _start(self, cls):
+        self.active += 1
+        self._class_active[cls] += 1
+        self.admitted += 1
+
+    def _make_room(self, priority):
+        """Rejects the waiter with the lowest priority if it's lower than
+        priority, returns whether there is room in the queue afterwards"""
+        if len(self._waiters) < self.queue_size:
+            return True
+        if not self._waiters or self._waiters[-1][0] <= priority:
+            return False
+        *_, future = self._waiters.pop()
+        future.set_exception(Overloaded())
+        self.rejected += 1
+        return True
+
+    def _remove_waiter(self, future):
+        self._waiters = [w for w in self._waiters if w[3] is not future]
+
+    async def acquire(self, cls=None):
+        """Waits for a slot for a request of the class, raises Overloaded if
+        it can't be served now or in a reasonable time"""
+        # waiters are started as soon as a slot is free, so if this one can
+        # run nobody waiting in the queue can
+        if self._can_run(cls):
+            self._start(cls)
+            return
+        priority = self._policy(cls)[0]
+        if not self._make_room(priority):
+            self.rejected += 1
+            raise Overloaded()
+        future = asyncio.get_running_loop().create_future()
+        insort(self._waiters, (priority, next(self._seq), cls, future))
+        self.queued += 1
+        try:
+            await asyncio.wait({future}, timeout=self.timeout)
+        except asyncio.CancelledError:
+            if future.done() and not future.exception():
+                self.release(cls)
+            else:
+                self._remove_waiter(future)
+                future.cancel()
+            raise
+        if not future.done():
+            self._remove_waiter(future)
+            future.cancel()
+            self.rejected += 1
+            raise Overloaded()
+        future.result()
+
+    def release(self, cls=None):
+        self.active -= 1
+        self._class_active[cls] -= 1
+        for waiter in list(self._waiters):
+            if self.active >= self.limit:
+                break
+            _, _, waiter_cls, future = waiter
+            if self._can_run(waiter_cls):
+                self._waiters.remove(waiter)
+                self._start(waiter_cls)
+                future.set_result(None)
+
+
+class AdmissionMiddleware:
+    """
+    Serves the HTTP requests within the limits of an AdmissionController.
+    routes is a list of (path prefix, class), the class of the first match is
+    used. Paths starting with any of the exempt prefixes are always served
+    right away
+    """
+
+    def __init__(self, app, controller, routes=(), exempt=(), retry_after=5):
+        self.app = app
+        self.controller = controller
+        self.routes = list(routes)
+        self.exempt = tuple(exempt)
+        self.retry_after = retry_after
+
+    def _class(self, path):
+        for prefix, cls in self.routes:
+            if path.startswith(prefix):
+                return cls
+        return None
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"].startswith(self.exempt):
+            await self.app(scope, receive, send)
+            return
+        cls = self._class(scope["path"])
+        try:
+            await self.controller.acquire(cls)
+        except Overloaded:
+            response = JSONResponse(
+                {"detail": "Server overloaded, retry later"},
+                status_code=503,
+                headers={"Retry-After": str(self.retry_after)},
+            )
+            await response(scope, receive, send)
+            return
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            self.controller.release(cls)
@@ -0,0 +1,375 @@
+"""
+Caching of the rendered responses
+
+Responses only change when the information in the stores does, so they are
+kept for as long as the generation of the store they come from is the same,
+together with the compressed variants of their bodies, up to a total size.
+Requests only differing in parameters that the route does not read share the
+same response. Concurrent identical requests that miss the cache wait for a
+single rendering of the response.
+"""
+
+import asyncio
+import gzip
+from collections import Counter
+from functools import partial
+from urllib.parse import parse_qsl, urlencode
+
+from starlette.datastructures import Headers
+
+from .metrics import find_route
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+# about half the time of the highest levels for a few % larger bodies
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5
+
+
+def compress(body, encoding):
+    if encoding == "br":
+        return brotli.compress(body, quality=BROTLI_QUALITY)
+    return gzip.compress(body, compresslevel=GZIP_LEVEL, mtime=0)
+
+
+def query_params(route):
+    """Gets the names of the query parameters read by a route and its
+    dependencies, None if they are not known"""
+    dependant = getattr(route, "dependant", None)
+    if dependant is None:
+        return None
+    names = set()
+    dependants = [dependant]
+    while dependants:
+        dependant = dependants.pop()
+        names.update(param.alias for param in dependant.query_params)
+        dependants.extend(dependant.dependencies)
+    return names
+
+
+def normalize_query(query_string, names=None):
+    """Keeps only the given parameters of a query string, sorted by name and
+    keeping the order of repeated ones. All are kept if names is None"""
+    if names is None:
+        return query_string
+    params = [
+        (name, value)
+        for name, value in parse_qsl(query_string.decode("latin-1"), True)
+        if name in names
+    ]
+    params.sort(key=lambda param: param[0])
+    return urlencode(params).encode("latin-1")
+
+
+def supported_encodings():
+    return ["br", "gzip"] if brotli else ["gzip"]
+
+
+def select_encoding(accept_encoding, encodings):
+    """Selects the preferred encoding out of the Accept-Encoding header,
+    ties are resolved following the order of encodings"""
+    accepted = {}
+    for item in accept_encoding.split(","):
+        name, *params = [p.strip() for p in item.split(";")]
+        q = 1.0
+        for param in params:
+            if param.startswith("q="):
+                try:
+                    q = float(param[2:])
+                except ValueError:
+                    q = 0.0
+        accepted[name.lower()] = q
+    best, best_q = None, 0.0
+    for encoding in encodings:
+        q = accepted.get(encoding, accepted.get("*", 0.0))
+        if q > best_q:
+            best, best_q = encoding, q
+    return best
+
+
+class CachedResponse:
+    # set again for every response sent, or only meant for the first request
+    # as the id of its profile
+    uncached_headers = (
+        b"content-length",
+        b"content-encoding",
+        b"vary",
+        b"x-profile-id",
+    )
+
+    def __init__(self, status, headers, body):
+        self.status = status
+        self.headers = [
+            (k, v) for k, v in headers if k.lower() not in self.uncached_headers
+        ]
+        self.body = body
+        self._encoded = {}
+        self._compressing = {}
+
+    @property
+    def size(self):
+        """Bytes of the body and its compressed variants"""
+        return len(self.body) + sum(len(body) for body in self._encoded.values())
+
+    async def encode(self, encoding, min_size=0):
+        """Gets the body with the given encoding, compressing it in a thread
+        only once for all the requests. Bodies smaller than min_size are not
+        compressed"""
+        if not encoding or len(self.body) < min_size:
+            return None, self.body
+        if encoding not in self._encoded:
+            task = self._compressing.get(encoding)
+            if task is None:
+                task = asyncio.ensure_future(
+                    asyncio.to_thread(compress, self.body, encoding)
+                )
+                self._compressing[encoding] = task
+            # not cancelled with the request that started it
+            self._encoded[encoding] = await asyncio.shield(task)
+            self._compressing.pop(encoding, None)
+        return encoding, self._encoded[encoding]
+
+
+class ResponseCache:
+    """
+    Keeps the responses of the current generation of every namespace, e.g. the
+    routes served from the same store, older ones are dropped. The oldest
+    responses are also dropped to keep the size of the bodies and their
+    compressed variants under max_bytes. Hits, misses and coalesced requests
+    are counted by route
+    """
+
+    def __init__(self, max_bytes=128 * 2**20):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._generations = {}
+        # (namespace, key): entry
+        self._entries = {}
+        # (namespace, key): size of the entry when last counted
+        self._sizes = {}
+        self._in_flight = {}
+        self.hits = Counter()
+        self.misses = Counter()
+        self.coalesced = Counter()
+
+    def get(self, generation, key, namespace=None, route=""):
+        if generation != self._generations.get(namespace):
+            self._drop(namespace)
+            self._generations[namespace] = generation
+        entry = self._entries.get((namespace, key))
+        if entry:
+            self.hits[route] += 1
+        else:
+            self.misses[route] += 1
+        return entry
+
+    def put(self, generation, key, entry, namespace=None):
+        if generation != self._generations.get(namespace):
+            return
+        self._remove((namespace, key))
+        if entry.size > self.max_bytes:
+            return
+        self._entries[namespace, key] = entry
+        self._sizes[namespace, key] = entry.size
+        self.size += entry.size
+        self._evict()
+
+    def resize(self, key, entry, namespace=None):
+        """Counts the compressed variants added to entry if it is cached"""
+        if self._entries.get((namespace, key)) is not entry:
+            return
+        self.size += entry.size - self._sizes[namespace, key]
+        self._sizes[namespace, key] = entry.size
+        self._evict()
+
+    async def single_flight(self, generation, key, render, namespace=None, route=""):
+        """Renders the entry for key, requests arriving while it is being
+        rendered for the same generation wait for it instead of rendering
+        it again. Successful responses are stored in the cache"""
+        flight = (namespace, generation, key)
+        future = self._in_flight.get(flight)
+        if future is not None:
+            self.coalesced[route] += 1
+            try:
+                return await asyncio.shield(future)
+            except asyncio.CancelledError:
+                if not future.cancelled():
+                    raise
+                # the request rendering it went away, render it here
+        future = asyncio.get_running_loop().create_future()
+        self._in_flight[flight] = future
+        try:
+            entry = await render()
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            # avoid warnings about the exception when nobody else waits
+            future.exception()
+            raise
+        finally:
+            if self._in_flight.get(flight) is future:
+                del self._in_flight[flight]
+        future.set_result(entry)
+        if entry.status == 200:
+            self.put(generation, key, entry, namespace)
+        return entry
+
+    def _remove(self, item):
+        if self._entries.pop(item, None) is not None:
+            self.size -= self._sizes.pop(item)
+
+    def _evict(self):
+        while self.size > self.max_bytes:
+            # drop the oldest entry
+            self._remove(next(iter(self._entries)))
+
+    def _drop(self, namespace):
+        for item in [item for item in self._entries if item[0] == namespace]:
+            self._remove(item)
+
+    def entries(self):
+        """Gets the cached responses"""
+        return list(self._entries.values())
+
+    def clear(self):
+        self._entries = {}
+        self._sizes = {}
+        self.size = 0
+        self._generations = {}
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class CachedResponseMiddleware:
+    """
+    Serves GET requests under the given path prefixes from a ResponseCache,
+    negotiating the compression of the body with the client.
+
+    generation is a callable returning the current generation of the data,
+    or a dict with the callable of every path prefix, whose responses are
+    then only dropped when that generation changes. Streamed responses (with
+    NDJSON requested) are not cached. The cache counts the requests by the
+    path of the matching route out of routes, and only the query parameters
+    read by that route are part of the key. If given, media_types are the
+    ones the app chooses between out of the Accept header, other values of
+    the header get the same response. Requests for which bypass, given their
+    headers, is true skip the cache, e.g. to be profiled. Misses are rendered
+    once for all the concurrent identical requests.
+    """
+
+    def __init__(
+        self,
+        app,
+        cache,
+        generation,
+        paths=(),
+        routes=(),
+        bypass=None,
+        min_size=1024,
+        media_types=None,
+        no_cache_media_types=("application/x-ndjson",),
+    ):
+        self.app = app
+        self.cache = cache
+        if callable(generation):
+            # prefix: (namespace, generation)
+            self.generations = {path: (None, generation) for path in paths}
+        else:
+            self.generations = {
+                path: (path, path_generation)
+                for path, path_generation in generation.items()
+            }
+        self.paths = tuple(self.generations)
+        self.routes = routes
+        self.bypass = bypass
+        self.min_size = min_size
+        self.media_types = media_types
+        self.no_cache_media_types = no_cache_media_types
+        self.encodings = supported_encodings()
+
+    def _cacheable(self, scope, headers):
+        if scope["method"] != "GET":
+            return False
+        if not scope["path"].startswith(self.paths):
+            return False
+        accept = headers.get("accept", "")
+        return not any(t in accept for t in self.no_cache_media_types)
+
+    def _accept(self, headers):
+        accept = headers.get("accept", "")
+        if self.media_types is None:
+            return accept
+        return tuple(t for t in self.media_types if t in accept)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        headers = Headers(scope=scope)
+        if not self._cacheable(scope, headers) or (
+            self.bypass and self.bypass(headers)
+        ):
+            await self.app(scope, receive, send)
+            return
+        prefix = next(p for p in self.paths if scope["path"].startswith(p))
+        namespace, generation = self.generations[prefix]
+        generation = generation()
+        matched = find_route(scope, self.routes)
+        query_string = normalize_query(scope["query_string"], query_params(matched))
+        if query_string != scope["query_string"]:
+            # rendered as if only the parameters in the key were given, as
+            # they may show up in the response, e.g. in links
+            scope = dict(scope, query_string=query_string)
+        # responses may include URLs of the app, so host is part of the key
+        key = (
+            scope["scheme"],
+            headers.get("host", ""),
+            scope["path"],
+            query_string,
+            self._accept(headers),
+        )
+        route = getattr(matched, "path", "unmatched")
+        entry = self.cache.get(generation, key, namespace, route)
+        if entry is None:
+            entry = await self.cache.single_flight(
+                generation,
+                key,
+                partial(self._render, scope, receive),
+                namespace,
+                route,
+            )
+        encoding = select_encoding(headers.get("accept-encoding", ""), self.encodings)
+        encoding, body = await entry.encode(encoding, self.min_size)
+        self.cache.resize(key, entry, namespace)
+        await self._send(send, entry, encoding, body)
+
+    async def _render(self, scope, receive):
+        start = {}
+        body = []
+
+        async def capture(message):
+            if message["type"] == "http.response.start":
+                start.update(message)
+            elif message["type"] == "http.response.body":
+                body.append(message.get("body", b""))
+
+        await self.app(scope, receive, capture)
+        return CachedResponse(start["status"], start["headers"], b"".join(body))
+
+    async def _send(self, send, entry, encoding, body):
+        headers = list(entry.headers)
+        headers.append((b"content-length", str(len(body)).encode()))
+        headers.append((b"vary", b"Accept, Accept-Encoding"))
+        if encoding:
+            headers.append((b"content-encoding", encoding.encode()))
+        await send(
+            {"type": "http.response.start", "status": entry.status, "headers": headers}
+        )
+        await send({"type": "http.response.body", "body": body})
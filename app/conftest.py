@@ -57,7 +57,9 @@ def site():
                         vo="ops",
                     )
                 ],
-                instancetypes=[GlueInstanceType(name="m1.tiny")],
+                instancetypes=[
+                    GlueInstanceType(name="m1.tiny", cpu=1, ram=512, disk=1)
+                ],
             )
         ],
         url="https://colossus.cesar.unizar.es:5000/v3",
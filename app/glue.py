@@ -3,24 +3,68 @@ Glue Objects and the helpers to manage them
 """
 
 import asyncio
+import contextlib
 import datetime
 import glob
+import heapq
 import itertools
 import json
 import logging
 import os.path
+import re
+import threading
+import time
+from bisect import bisect_left
+from collections import deque
 from typing import Optional
 
-import dateutil.parser
-import httpx
-import xmltodict
-from pydantic import BaseModel
-from watchfiles import awatch
+from pydantic import BaseModel, field_validator
+
+from . import tracing
+from .memory import live_snapshots
+from .metrics import (
+    RELOAD_DURATION,
+    SITE_PARSE_DURATION,
+    SITE_PARSE_FAILURES,
+    UPSTREAM_DURATION,
+    UPSTREAM_ERRORS,
+)
+from .parsing import Quarantine, SiteFileError, SiteParser
+from .profiling import Profiler
+
+
+class _HTTPXClient:
+    """httpx client of a store, created on first use as importing httpx
+    takes a while"""
+
+    def __set_name__(self, owner, name):
+        self.name = f"_{name}"
+
+    def __get__(self, obj, objtype=None):
+        if obj is None:
+            return self
+        if obj.__dict__.get(self.name) is None:
+            import httpx
+
+            obj.__dict__[self.name] = httpx.Client()
+        return obj.__dict__[self.name]
+
+    def __set__(self, obj, value):
+        obj.__dict__[self.name] = value
 
 
 class VO(BaseModel):
     serial: int
     name: str
+    # ids of the disciplines of the VO
+    disciplines: list[str] = []
+
+    @field_validator("disciplines", mode="before")
+    @classmethod
+    def discipline_ids(cls, value):
+        # listed either as ids or as objects with an id, skipped without one
+        ids = [d.get("id") if isinstance(d, dict) else d for d in value or []]
+        return [str(id) for id in ids if id is not None]
 
 
 class Discipline(BaseModel):
@@ -30,7 +74,59 @@ class Discipline(BaseModel):
     order: int
 
 
+class DisciplineNode(BaseModel):
+    id: str
+    name: str
+    # VOs of this very discipline, those of the children are in them
+    vos: list[str] = []
+    children: list["DisciplineNode"] = []
+
+
+class VOIndex:
+    """
+    Views of the VOs and disciplines built once every time either of them is
+    loaded: the sorted VO names, the tree of disciplines ordered by their
+    order and name, and the VOs of every discipline and its sub-disciplines
+    """
+
+    def __init__(self, vos=(), disciplines=()):
+        self.vo_names = sorted(vo.name for vo in vos)
+        by_id = {d.id: d for d in disciplines}
+        direct = {}
+        for vo in vos:
+            for discipline_id in vo.disciplines:
+                direct.setdefault(discipline_id, []).append(vo.name)
+        children = {}
+        roots = []
+        for d in sorted(disciplines, key=lambda d: (d.order, d.name)):
+            if d.parent in by_id and d.parent != d.id:
+                children.setdefault(d.parent, []).append(d)
+            else:
+                roots.append(d)
+        self.vos = {}
+        self.tree = [self._node(d, children, direct) for d in roots]
+        if len(self.vos) < len(by_id):
+            logging.warning(
+                f"Disciplines in a loop of parents: {sorted(by_id.keys() - self.vos)}"
+            )
+
+    def _node(self, discipline, children, direct):
+        nodes = [
+            self._node(d, children, direct) for d in children.get(discipline.id, [])
+        ]
+        vos = sorted(direct.get(discipline.id, []))
+        all_vos = set(vos)
+        for node in nodes:
+            all_vos.update(self.vos[node.id])
+        self.vos[discipline.id] = sorted(all_vos)
+        return DisciplineNode(
+            id=discipline.id, name=discipline.name, vos=vos, children=nodes
+        )
+
+
 class VOStore:
+    httpx_client = _HTTPXClient()
+
     def __init__(
         self,
         ops_portal_url="",
@@ -42,50 +138,105 @@ class VOStore:
         self.ops_portal_url = ops_portal_url
         self.ops_portal_token = ops_portal_token
         self._vos = []
+        self.generation = 0
         self._update_period = 60 * 60 * 2  # Every 2 hours
-        self._disciplines = []
-        if vo_disciplines_file:
+        # least time between the updates made by requests finding no VOs
+        self._retry_period = 60 * 5  # 5 minutes
+        self._last_update = None
+        self.vo_disciplines_file = vo_disciplines_file
+        # loaded when started or first needed
+        self._disciplines = None
+        self._index = VOIndex()
+        self.httpx_client = httpx_client
+        self.profiler = Profiler()
+
+    def _load_disciplines(self):
+        disciplines = []
+        if self.vo_disciplines_file:
             try:
-                with open(vo_disciplines_file) as f:
+                with open(self.vo_disciplines_file) as f:
                     for d in json.loads(f.read()):
-                        self._disciplines.append(Discipline(**d))
+                        disciplines.append(Discipline(**d))
             except Exception as e:
                 logging.warning(f"Unable to load disciplines: {e}")
-        if httpx_client:
-            self.httpx_client = httpx_client
-        else:
-            self.httpx_client = httpx.Client()
+        self._disciplines = disciplines
+        self._update_index()
+
+    def _update_index(self):
+        # swapped at once, so requests see either the old or the new views
+        self._index = VOIndex(self._vos, self._disciplines or [])
+        self.generation += 1
 
     def update_vos(self):
+        with self.profiler.profile("reload", "update_vos"):
+            self._update_vos()
+
+    def _update_vos(self):
+        import httpx
+
+        self._last_update = time.monotonic()
         try:
-            r = self.httpx_client.get(
-                self.ops_portal_url,
-                headers={
-                    "accept": "application/json",
-                    "X-API-Key": self.ops_portal_token,
-                },
-            )
+            with UPSTREAM_DURATION.labels("ops_portal").time():
+                r = self.httpx_client.get(
+                    self.ops_portal_url,
+                    headers={
+                        "accept": "application/json",
+                        "X-API-Key": self.ops_portal_token,
+                    },
+                )
             r.raise_for_status()
             vos = []
             for vo_info in r.json()["data"]:
-                vo = VO(**vo_info)
-                vos.append(vo)
-            self._vos = vos
-        except httpx.HTTPError as e:
+                try:
+                    vos.append(VO(**vo_info))
+                except (TypeError, ValueError) as e:
+                    logging.warning(f"Skipping invalid VO {vo_info}: {e}")
+        except (httpx.HTTPError, ValueError, KeyError, TypeError) as e:
+            # including responses that are not JSON or have no data
+            UPSTREAM_ERRORS.labels("ops_portal").inc()
             logging.error(f"Unable to load VOs: {e}")
-            self._vos = []
+            # keep the last VOs, if any
+            return
+        if vos != self._vos:
+            self._vos = vos
+            self._update_index()
 
     def get_vos(self):
-        if not self._vos:
+        # with the Operations Portal down or no token, don't call it again for
+        # every request, the VOs are updated in the background anyway
+        if not self._vos and (
+            self._last_update is None
+            or time.monotonic() - self._last_update >= self._retry_period
+        ):
             self.update_vos()
         return self._vos
 
     def get_disciplines(self):
+        if self._disciplines is None:
+            self._load_disciplines()
         return self._disciplines
 
+    def _get_index(self):
+        self.get_vos()
+        self.get_disciplines()
+        return self._index
+
+    def get_vo_names(self):
+        """Gets the sorted names of the VOs"""
+        return self._get_index().vo_names
+
+    def get_discipline_tree(self):
+        return self._get_index().tree
+
+    def get_discipline_vos(self, discipline_id):
+        """Gets the sorted names of the VOs of a discipline, including its
+        sub-disciplines, None if there is no such discipline"""
+        return self._get_index().vos.get(discipline_id)
+
     async def start(self):
+        await asyncio.to_thread(self._load_disciplines)
         while True:
-            self.update_vos()
+            await asyncio.to_thread(self.update_vos)
             await asyncio.sleep(self._update_period)
 
 
@@ -100,6 +251,13 @@ class GlueImage(BaseModel):
 
 class GlueInstanceType(BaseModel):
     name: str
+    cpu: int = 0
+    ram: int = 0
+    disk: int = 0
+    accelerator_type: str = ""
+    accelerator_vendor: str = ""
+    accelerator_model: str = ""
+    accelerator_count: int = 0
 
 
 class GlueShare(BaseModel):
@@ -149,32 +307,324 @@ class GlueSite(BaseModel):
         return site
 
 
+def clean_image_name(name):
+    # we want to remove the Image for and [distro/arch]
+    return name.removeprefix("Image for ").split("[", 1)[0].strip()
+
+
+def _to_int(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return 0
+
+
+def tokenize(value):
+    return {t for t in re.split(r"[^a-z0-9]+", value.lower()) if t}
+
+
+class ImageIndex:
+    """
+    Inverted index over a list of (site, image) tuples, supports lookups by
+    exact or prefix value of a field and by the tokens in any of the fields
+    """
+
+    FIELDS = ("name", "egi_id", "version", "mpuri", "vo")
+
+    def __init__(self, images):
+        self.images = images
+        self._values = {field: {} for field in self.FIELDS}
+        self._tokens = {}
+        for pos, (_, image) in enumerate(images):
+            for field in self.FIELDS:
+                value = getattr(image, field)
+                keys = {value.lower()}
+                if field == "name":
+                    keys.add(clean_image_name(value).lower())
+                for key in filter(None, keys):
+                    self._values[field].setdefault(key, []).append(pos)
+                for token in tokenize(value):
+                    self._tokens.setdefault(token, set()).add(pos)
+        self._sorted_values = {
+            field: sorted(values) for field, values in self._values.items()
+        }
+
+    def match(self, field, value):
+        """Gets the positions of the images whose field is equal to value, or
+        starts with it if value ends with *"""
+        value = value.lower()
+        values = self._values[field]
+        if not value.endswith("*"):
+            return set(values.get(value, []))
+        prefix = value[:-1]
+        keys = self._sorted_values[field]
+        matches = set()
+        for key in itertools.islice(keys, bisect_left(keys, prefix), None):
+            if not key.startswith(prefix):
+                break
+            matches.update(values[key])
+        return matches
+
+    def search(self, criteria, query=""):
+        """Gets the images matching all the field values in criteria and
+        having all the tokens of query"""
+        candidates = [self.match(field, value) for field, value in criteria.items()]
+        candidates.extend(self._tokens.get(t, set()) for t in tokenize(query))
+        if not candidates:
+            return list(self.images)
+        candidates.sort(key=len)
+        matches = candidates[0].intersection(*candidates[1:])
+        return [self.images[pos] for pos in sorted(matches)]
+
+
+class ChangeSet(BaseModel):
+    added: list[str] = []
+    removed: list[str] = []
+    changed: list[str] = []
+
+
+class SiteChanges(BaseModel):
+    generation: int
+    sites: ChangeSet
+    shares: ChangeSet
+    images: ChangeSet
+
+
+def _diff(old, new):
+    return ChangeSet(
+        added=sorted(new.keys() - old.keys()),
+        removed=sorted(old.keys() - new.keys()),
+        changed=sorted(k for k in old.keys() & new.keys() if old[k] != new[k]),
+    )
+
+
+def diff_sites(old_sites, new_sites, generation):
+    """Gets the sites, shares and images that changed between two lists of
+    sites. Shares are named as site/vo and images as site/vo/image_id"""
+    old_by_name = {s.name: s for s in old_sites}
+    new_by_name = {s.name: s for s in new_sites}
+    old_shares, new_shares = {}, {}
+    old_images, new_images = {}, {}
+    for name in old_by_name.keys() | new_by_name.keys():
+        old_site, new_site = old_by_name.get(name), new_by_name.get(name)
+        if old_site is new_site:
+            continue
+        for site, shares, images in (
+            (old_site, old_shares, old_images),
+            (new_site, new_shares, new_images),
+        ):
+            for share in site.shares if site else []:
+                shares[f"{name}/{share.vo}"] = share
+                for image in share.images:
+                    images[f"{name}/{share.vo}/{image.id}"] = image
+    return SiteChanges(
+        generation=generation,
+        sites=_diff(old_by_name, new_by_name),
+        shares=_diff(old_shares, new_shares),
+        images=_diff(old_images, new_images),
+    )
+
+
+class SiteSnapshot:
+    """
+    Read-only view of the sites published by a store at a given generation,
+    with the indexes needed to answer queries without scanning every site
+    """
+
+    # derived data is kept for as long as the snapshot, so it's built for
+    # every VO before publishing it
+    warm_every_vo = True
+
+    def __init__(self, sites, generation=0):
+        self.source = sites
+        self.generation = generation
+        self.sites = list(sites)
+        self._by_name = {}
+        self._by_goc_id = {}
+        self._vo_sites = {}
+        self._cache = {}
+        live_snapshots.add(self)
+        for site in self.sites:
+            self._by_name.setdefault(site.name, site)
+            self._by_goc_id.setdefault(site.gocdb_id, site)
+            for share in site.shares:
+                vo_sites = self._vo_sites.setdefault(share.vo, [])
+                if not vo_sites or vo_sites[-1] is not site:
+                    vo_sites.append(site)
+
+    def get_sites(self, vo_name=None, details=True):
+        """Gets the sites supporting the VO, or all of them. Without details
+        the shares of the sites may not have their images and instance types"""
+        if vo_name:
+            return self._vo_sites.get(vo_name, [])
+        return self.sites
+
+    def get_site_by_name(self, name):
+        return self._by_name.get(name)
+
+    def get_site_by_goc_id(self, gocdb_id):
+        return self._by_goc_id.get(gocdb_id)
+
+    def vo_names(self):
+        return list(self._vo_sites)
+
+    def has_vo(self, vo_name):
+        """Whether any site supports the VO, always true without one"""
+        return not vo_name or vo_name in self._vo_sites
+
+    def counts(self):
+        """Gets the number of sites, shares and images"""
+        return self.cached(
+            "counts",
+            lambda: (
+                len(self.sites),
+                sum(len(site.shares) for site in self.sites),
+                sum(len(share.images) for site in self.sites for share in site.shares),
+            ),
+        )
+
+    def cached(self, key, build, vo_name=None):
+        """Gets data derived from this snapshot, calling build only once. Data
+        of a VO without sites is built every time instead, so the cache does
+        not grow with any VO name sent by clients"""
+        if not self.has_vo(vo_name):
+            return build()
+        try:
+            return self._cache[key]
+        except KeyError:
+            value = self._cache[key] = build()
+            return value
+
+    def cached_items(self):
+        """Gets the (key, value) of the derived data built so far"""
+        return list(self._cache.items())
+
+    def _build_images(self, vo_name, only_egi_images):
+        images = []
+        for site in self.get_sites(vo_name):
+            shares = [site.vo_share(vo_name)] if vo_name else site.shares
+            images.extend(
+                (site, image)
+                for share in shares
+                for image in share.images
+                if image.egi_id or not only_egi_images
+            )
+        return images
+
+    def get_images(self, vo_name=None, only_egi_images=False):
+        """Returns a list of (site, image) tuples, built once per snapshot"""
+        return self.cached(
+            ("images", vo_name or None, only_egi_images),
+            lambda: self._build_images(vo_name, only_egi_images),
+            vo_name,
+        )
+
+    def image_index(self):
+        return self.cached("image_index", lambda: ImageIndex(self.get_images()))
+
+    def _build_flavors(self, vo_name, accelerated):
+        flavors = []
+        for site in self.get_sites(vo_name):
+            shares = [site.vo_share(vo_name)] if vo_name else site.shares
+            flavors.extend(
+                (site, share, instancetype)
+                for share in shares
+                for instancetype in share.instancetypes
+                if instancetype.accelerator_count or not accelerated
+            )
+        flavors.sort(key=lambda f: (f[2].cpu, f[2].ram, f[2].disk))
+        return [f[2].cpu for f in flavors], flavors
+
+    def get_flavors(self, vo_name=None, accelerated=False):
+        """Returns the CPUs of the flavors and the (site, share, instancetype)
+        tuples of the flavors, both sorted by CPU, built once per snapshot"""
+        return self.cached(
+            ("flavors", vo_name or None, accelerated),
+            lambda: self._build_flavors(vo_name, accelerated),
+            vo_name,
+        )
+
+    def warm(self):
+        """Builds the image and flavor lists of every VO and the image index"""
+        for vo_name in [None, *self.vo_names()]:
+            for flag in (True, False):
+                self.get_images(vo_name, only_egi_images=flag)
+                self.get_flavors(vo_name, accelerated=flag)
+        self.image_index()
+
+    def find_flavors(
+        self, vo_name=None, min_cpu=0, min_ram=0, min_disk=0, accelerator=None
+    ):
+        """Gets the flavors with at least the given resources, if accelerator
+        is not None, only those with/without accelerators"""
+        cpus, flavors = self.get_flavors(vo_name, accelerated=bool(accelerator))
+        return [
+            f
+            for f in itertools.islice(flavors, bisect_left(cpus, min_cpu), None)
+            if f[2].ram >= min_ram
+            and f[2].disk >= min_disk
+            and (accelerator is None or bool(f[2].accelerator_count) == accelerator)
+        ]
+
+
 class SiteStore:
+    httpx_client = _HTTPXClient()
+
     def __init__(
         self,
         gocdb_url="",
         httpx_client=None,
         check_glue_validity=True,
+        change_history_size=100,
+        max_site_file_size=0,
+        max_site_objects=0,
+        site_parse_timeout=0,
+        site_parse_workers=0,
+        quarantine_after=2,
         **kwargs,
     ):
         self.gocdb_hostnames = {}
         self.gocdb_url = gocdb_url
-        if httpx_client:
-            self.httpx_client = httpx_client
-        else:
-            self.httpx_client = httpx.Client()
+        self.httpx_client = httpx_client
         self.check_glue_validity = check_glue_validity
+        # sites expiry, as a heap of (valid_until, key) with stale entries
+        # discarded when they reach the top of the heap
+        self._expiry_queue = []
+        self._expiry_times = {}
+        self._expiry_updated = asyncio.Event()
+        self._expiry_task = None
+        self._snapshot = SiteSnapshot([])
+        self._snapshot_updated = asyncio.Event()
+        self._publish_lock = asyncio.Lock()
+        # swaps the sites and their snapshot at once for the worker threads
+        self._swap_lock = threading.Lock()
+        self.changes = deque(maxlen=change_history_size)
+        # callables preparing data derived from a snapshot before publishing it
+        self.warmers = []
+        self.profiler = Profiler()
+        self.parser = SiteParser(
+            max_size=max_site_file_size,
+            max_objects=max_site_objects,
+            timeout=site_parse_timeout,
+            workers=site_parse_workers,
+        )
+        # site files or objects failing over and over
+        self.quarantine = Quarantine(after=quarantine_after)
 
     def _get_gocdb_hostname(self, gocid):
         if not self.gocdb_hostnames:
+            import httpx
+            import xmltodict
+
             try:
-                r = self.httpx_client.get(
-                    os.path.join(self.gocdb_url, "gocdbpi/public/"),
-                    params={
-                        "method": "get_service",
-                        "service_type": "org.openstack.nova",
-                    },
-                )
+                with UPSTREAM_DURATION.labels("gocdb").time():
+                    r = self.httpx_client.get(
+                        os.path.join(self.gocdb_url, "gocdbpi/public/"),
+                        params={
+                            "method": "get_service",
+                            "service_type": "org.openstack.nova",
+                        },
+                    )
                 data = xmltodict.parse(r.text.replace("\n", ""))["results"]
                 # xmltodict may return just the dict if only one element
                 endpoints = data["SERVICE_ENDPOINT"]
@@ -185,17 +635,82 @@ class SiteStore:
                         "HOSTNAME"
                     ]
             except httpx.HTTPError as e:
+                UPSTREAM_ERRORS.labels("gocdb").inc()
                 logging.error(f"Unable to load site information: {e}")
             except KeyError:
+                UPSTREAM_ERRORS.labels("gocdb").inc()
                 logging.error("Unable to load site information")
         return self.gocdb_hostnames.get(gocid, "")
 
     async def start(self):
         return
 
+    def _get_valid_until(self, info):
+        import dateutil.parser
+
+        with tracing.phase("validity"):
+            svc = info["CloudComputingService"][0]
+            creation_time = dateutil.parser.parse(svc["CreationTime"])
+            if not creation_time.tzinfo:
+                creation_time = creation_time.replace(tzinfo=datetime.timezone.utc)
+            return creation_time + datetime.timedelta(seconds=int(svc["Validity"]))
+
+    def _schedule_expiry(self, key, valid_until):
+        self._expiry_times[key] = valid_until
+        heapq.heappush(self._expiry_queue, (valid_until, key))
+        if len(self._expiry_queue) > 2 * len(self._expiry_times) + 16:
+            # too many stale entries, rebuild the heap
+            self._expiry_queue = [(v, k) for k, v in self._expiry_times.items()]
+            heapq.heapify(self._expiry_queue)
+        self._expiry_updated.set()
+
+    def _cancel_expiry(self, key):
+        # the entry in the heap is left there and ignored once popped
+        self._expiry_times.pop(key, None)
+
+    def _next_expiry(self):
+        while self._expiry_queue:
+            valid_until, key = self._expiry_queue[0]
+            if self._expiry_times.get(key) == valid_until:
+                return valid_until
+            heapq.heappop(self._expiry_queue)
+        return None
+
+    def _pop_expired(self, now):
+        expired = []
+        while (next_expiry := self._next_expiry()) and next_expiry <= now:
+            _, key = heapq.heappop(self._expiry_queue)
+            del self._expiry_times[key]
+            expired.append(key)
+        return expired
+
+    async def _expire_sites(self, keys):
+        """Removes the sites identified by keys, to be done by subclasses"""
+        return
+
+    async def _expire_loop(self):
+        while True:
+            self._expiry_updated.clear()
+            now = datetime.datetime.now(datetime.UTC)
+            expired = self._pop_expired(now)
+            if expired:
+                logging.warning(f"Site info no longer valid for {expired}, removing")
+                await self._expire_sites(expired)
+            next_expiry = self._next_expiry()
+            timeout = None
+            if next_expiry:
+                timeout = (next_expiry - now).total_seconds()
+            try:
+                await asyncio.wait_for(self._expiry_updated.wait(), timeout)
+            except TimeoutError:
+                pass
+
+    def _start_expiry(self):
+        if self.check_glue_validity and not self._expiry_task:
+            self._expiry_task = asyncio.create_task(self._expire_loop())
+
     def _clean_name(self, name):
-        # we want to remove the Image for and [distro/arch]
-        return name.removeprefix("Image for ").split("[", 1)[0].strip()
+        return clean_image_name(name)
 
     def _build_egi_id(self, name):
         return f"{name.replace(' ', '.').lower()}"
@@ -210,17 +725,13 @@ class SiteStore:
             mp_data.update(dict(egi_id=egi_id, version=version))
         return mp_data
 
-    def create_site(self, info):
+    def create_site(self, info, valid_until=None):
         svc = info["CloudComputingService"][0]
         ept = info["CloudComputingEndpoint"][0]
 
         if self.check_glue_validity:
-            creation_time = dateutil.parser.parse(svc["CreationTime"])
-            if not creation_time.tzinfo:
-                creation_time = creation_time.replace(tzinfo=datetime.timezone.utc)
-            valid_until = creation_time + datetime.timedelta(
-                seconds=int(svc["Validity"])
-            )
+            if valid_until is None:
+                valid_until = self._get_valid_until(info)
             if datetime.datetime.now(datetime.UTC) > valid_until:
                 logging.warning(f"Site info was valid until {valid_until}, skipping")
                 raise ValueError("Outdated info for site")
@@ -259,7 +770,19 @@ class SiteStore:
                         for acc in info["CloudComputingVirtualAccelerator"]:
                             if acc["ID"] == acc_id:
                                 instance_info.update({"accelerator": acc})
-                    instances.append(GlueInstanceType(name=instance_info["Name"]))
+                    acc = instance_info.get("accelerator", {})
+                    instances.append(
+                        GlueInstanceType(
+                            name=instance_info["Name"],
+                            cpu=_to_int(instance_info.get("CPU")),
+                            ram=_to_int(instance_info.get("RAM")),
+                            disk=_to_int(instance_info.get("Disk")),
+                            accelerator_type=acc.get("Type", ""),
+                            accelerator_vendor=acc.get("Vendor", ""),
+                            accelerator_model=acc.get("Model", ""),
+                            accelerator_count=_to_int(acc.get("Number")) if acc else 0,
+                        )
+                    )
             share = GlueShare(
                 name=share_info["Name"],
                 project_id=share_info["ProjectID"],
@@ -269,43 +792,160 @@ class SiteStore:
             )
             shares.append(share)
         gocdb_id = svc["OtherInfo"]["gocdb_id"]
+        with tracing.phase("gocdb"):
+            hostname = self._get_gocdb_hostname(gocdb_id)
         site = GlueSite(
             name=svc["Associations"]["AdminDomain"][0],
             gocdb_id=gocdb_id,
             url=ept["URL"],
             shares=shares,
-            hostname=self._get_gocdb_hostname(gocdb_id),
+            hostname=hostname,
         )
         return site
 
+    def _read_site_info(self, info):
+        """Creates the site and gets until when it is valid (None if not
+        checked), without a site if it has already expired. The store is not
+        modified so it's safe to run in a thread"""
+        valid_until = None
+        if self.check_glue_validity:
+            valid_until = self._get_valid_until(info)
+            if datetime.datetime.now(datetime.UTC) > valid_until:
+                logging.warning(f"Site info was valid until {valid_until}, skipping")
+                return None, valid_until
+        with tracing.phase("create_site"):
+            site = self.create_site(info, valid_until)
+        return site, valid_until
+
     def _sites(self):
         return []
 
+    def _set_sites(self, sites):
+        """Makes _sites() return sites"""
+
+    @contextlib.contextmanager
+    def _reload(self, store, operation, name, **metadata):
+        """Measures, profiles and traces a reload of the sites"""
+        with (
+            RELOAD_DURATION.labels(store, operation).time(),
+            self.profiler.profile("reload", name, **metadata),
+            tracing.trace(store, operation) as trace,
+        ):
+            yield trace
+            counts = self.snapshot().counts()
+            trace.set(
+                generation=self.generation,
+                **dict(zip(("sites", "shares", "images"), counts)),
+            )
+
+    def snapshot(self):
+        """Returns the snapshot for the current sites, creating a new one if
+        they have changed since the last call"""
+        sites = self._sites()
+        snapshot = self._snapshot
+        if snapshot.source is not sites:
+            with self._swap_lock:
+                # checked again, _publish may have swapped them meanwhile
+                sites = self._sites()
+                snapshot = self._snapshot
+                if snapshot.source is not sites:
+                    snapshot = SiteSnapshot(sites, snapshot.generation + 1)
+                    self._set_snapshot(snapshot)
+        return snapshot
+
+    def _set_snapshot(self, snapshot, changes=None):
+        old_snapshot = self._snapshot
+        self._snapshot = snapshot
+        if changes is None:
+            changes = diff_sites(
+                old_snapshot.sites, snapshot.sites, snapshot.generation
+            )
+        self.changes.append(changes)
+        self._notify_snapshot()
+
+    def warm_snapshot(self, snapshot):
+        """Builds the indexes of snapshot and runs the warmers on it"""
+        snapshot.warm()
+        for warmer in self.warmers:
+            try:
+                warmer(snapshot)
+            except Exception as e:
+                logging.error(f"Unable to warm snapshot {snapshot.generation}: {e}")
+
+    def _prepare_snapshot(self, current, sites):
+        """Creates and warms the snapshot following current and gets the
+        changes, or None if there is nothing to publish. Meant to be run in a
+        worker thread"""
+        with tracing.phase("snapshot"):
+            snapshot = SiteSnapshot(sites, current.generation + 1)
+        with tracing.phase("warm"):
+            self.warm_snapshot(snapshot)
+        with tracing.phase("diff"):
+            changes = diff_sites(current.sites, snapshot.sites, snapshot.generation)
+        return snapshot, changes
+
+    async def _publish(self, sites):
+        """Prepares the snapshot for sites in a worker thread while requests
+        keep using the current one, then makes it current along with sites,
+        so snapshot() never sees the sites without their snapshot"""
+        async with self._publish_lock:
+            current = self.snapshot()
+            prepared = await asyncio.to_thread(self._prepare_snapshot, current, sites)
+            with tracing.phase("swap"), self._swap_lock:
+                self._set_sites(sites)
+                if prepared:
+                    self._set_snapshot(*prepared)
+
+    def _notify_snapshot(self):
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            # not in the event loop, waiters will notice on their next check
+            return
+        self._snapshot_updated.set()
+        self._snapshot_updated = asyncio.Event()
+
+    async def wait_for_snapshot(self, generation, timeout=None):
+        """Waits until there is a snapshot newer than generation or the
+        timeout expires, returns the current snapshot"""
+        snapshot = self.snapshot()
+        if snapshot.generation == generation:
+            try:
+                await asyncio.wait_for(self._snapshot_updated.wait(), timeout)
+            except TimeoutError:
+                pass
+            snapshot = self.snapshot()
+        return snapshot
+
+    def get_changes(self, since):
+        """Gets the changes for the generations after since, None if they are
+        not available anymore"""
+        generation = self.generation
+        if since == generation:
+            return []
+        if (
+            since > generation
+            or not self.changes
+            or self.changes[0].generation > since + 1
+        ):
+            return None
+        return [c for c in self.changes if c.generation > since]
+
+    @property
+    def generation(self):
+        return self.snapshot().generation
+
     def get_sites(self, vo_name=None):
-        if vo_name:
-            sites = list(filter(lambda s: s.supports_vo(vo_name), self._sites()))
-        else:
-            sites = self._sites()
-        return sites
+        return self.snapshot().get_sites(vo_name)
 
     def get_site_by_goc_id(self, gocdb_id):
-        for site in self.get_sites():
-            if site.gocdb_id == gocdb_id:
-                return site
-        return None
+        return self.snapshot().get_site_by_goc_id(gocdb_id)
 
     def get_site_by_name(self, name):
-        for site in self.get_sites():
-            if site.name == name:
-                return site
-        return None
+        return self.snapshot().get_site_by_name(name)
 
     def get_site_summary(self, vo_name=None):
-        if vo_name:
-            sites = filter(lambda s: s.supports_vo(vo_name), self.get_sites())
-        else:
-            sites = self.get_sites()
-        return (s.summary() for s in sites)
+        return (s.summary() for s in self.get_sites(vo_name))
 
 
 class FileSiteStore(SiteStore):
@@ -316,19 +956,32 @@ class FileSiteStore(SiteStore):
     def __init__(self, cloud_info_dir="", **kwargs):
         super().__init__(**kwargs)
         self.cloud_info_dir = cloud_info_dir
+        self._site_files = {}
         self._site_store = []
 
-    def _load_site_file(self, path):
+    def _read_site_file(self, path, info=None):
+        """Reads the site in path, info is its content if already decoded
+        by the parser, or the exception raised decoding it"""
+        tracing.count("files_read")
         try:
-            with open(path) as f:
-                return self.create_site(json.loads(f.read()))
+            with SITE_PARSE_DURATION.labels("file").time(), tracing.item(path):
+                if info is None:
+                    info = self.parser.read_file(path)
+                elif isinstance(info, Exception):
+                    raise info
+                return self._read_site_info(info)
         except Exception as e:
+            tracing.count("files_failed")
+            SITE_PARSE_FAILURES.labels("file").inc()
             logging.error(f"Unable to load site {path}: {e}")
-            return None
+            return None, None
 
     def _sites(self):
         return self._site_store
 
+    def _set_sites(self, sites):
+        self._site_store = sites
+
     def _clean_up_duplicated_sites(self, sites):
         # We may have multiple endpoints for a given site so even
         # if the gocdb_id is not the same, the name may be duplicated
@@ -354,28 +1007,121 @@ class FileSiteStore(SiteStore):
                 clean_sites.append(renamed_site)
         return clean_sites
 
-    def _load_sites(self):
-        sites = {}
-        for file in glob.iglob(
-            os.path.join(self.cloud_info_dir, "**/*.json"), recursive=True
-        ):
-            if os.path.isfile(file):
-                site = self._load_site_file(file)
-                if site:
-                    named_sites = sites.get(site.name, [])
-                    named_sites.append(site)
-                    sites[site.name] = named_sites
-                logging.debug(f"Loaded {file}")
-        new_sites = self._clean_up_duplicated_sites(sites)
-        logging.info(f"Re-loaded info about {len(new_sites)} sites")
-        self._site_store = new_sites
+    async def _publish_sites(self):
+        with tracing.phase("cleanup"):
+            sites = {}
+            for site in self._site_files.values():
+                sites.setdefault(site.name, []).append(site)
+            site_store = self._clean_up_duplicated_sites(sites)
+        await self._publish(site_store)
+
+    def _list_site_files(self):
+        with tracing.phase("scan"):
+            paths = glob.glob(
+                os.path.join(self.cloud_info_dir, "**/*.json"), recursive=True
+            )
+        tracing.count("files_listed", len(paths))
+        return paths
+
+    def _read_site_files(self, paths):
+        """Reads the given files, but those quarantined, meant to be run in a
+        worker thread"""
+        results = {}
+        versions = {}
+        for path in paths:
+            path = os.path.abspath(path)
+            results[path] = (None, None)
+            if not os.path.isfile(path):
+                self.quarantine.release(path)
+                continue
+            stat = os.stat(path)
+            version = (stat.st_size, stat.st_mtime_ns)
+            if self.quarantine.holds(path, version):
+                tracing.count("files_quarantined")
+                continue
+            versions[path] = version
+        decoded = {}
+        if self.parser.workers:
+            with tracing.phase("decode"):
+                decoded = self.parser.read_files(versions)
+        for path, version in versions.items():
+            results[path] = site, valid_until = self._read_site_file(
+                path, decoded.get(path)
+            )
+            # expired sites are not failures
+            if site is None and valid_until is None:
+                self.quarantine.failed(path, version)
+            else:
+                self.quarantine.release(path)
+                logging.debug(f"Loaded {path}")
+        return results
+
+    async def _apply_site_files(self, results, replace_all=False):
+        if replace_all:
+            for path in self._site_files:
+                self._cancel_expiry(path)
+            self._site_files = {}
+        for path, (site, valid_until) in results.items():
+            self._cancel_expiry(path)
+            if site:
+                self._site_files[path] = site
+                if valid_until:
+                    self._schedule_expiry(path, valid_until)
+            else:
+                self._site_files.pop(path, None)
+        await self._publish_sites()
+
+    async def _load_sites(self):
+        with self._reload("file", "load", "_load_sites"):
+            paths = await asyncio.to_thread(self._list_site_files)
+            results = await asyncio.to_thread(self._read_site_files, paths)
+            await self._apply_site_files(results, replace_all=True)
+        logging.info(f"Re-loaded info about {len(self._site_store)} sites")
+
+    def _changed_site_files(self, paths, known_paths):
+        """Gets the site files among the changed paths, including those in
+        directories that were added, moved or removed"""
+        files = set()
+        for path in map(os.path.abspath, paths):
+            if path.endswith(".json"):
+                files.add(path)
+            elif os.path.isdir(path):
+                files.update(
+                    os.path.abspath(p)
+                    for p in glob.glob(os.path.join(path, "**/*.json"), recursive=True)
+                )
+            else:
+                # gone, along with the site files that were in it, if any
+                prefix = os.path.join(path, "")
+                files.update(p for p in known_paths if p.startswith(prefix))
+        return sorted(files)
+
+    async def _update_site_files(self, paths):
+        # only re-parse the files that changed, keep the rest as they are
+        paths = await asyncio.to_thread(
+            self._changed_site_files, list(paths), list(self._site_files)
+        )
+        if not paths:
+            # e.g. temporary files of rsync or a SQLite database
+            return
+        with self._reload("file", "update", "_update_site_files", files=len(paths)):
+            results = await asyncio.to_thread(self._read_site_files, paths)
+            await self._apply_site_files(results)
+        logging.info(f"Updated info, now with {len(self._site_store)} sites")
+
+    async def _expire_sites(self, keys):
+        for path in keys:
+            self._site_files.pop(path, None)
+        await self._publish_sites()
 
     async def start(self):
-        self._load_sites()
+        from watchfiles import awatch
+
+        await self._load_sites()
+        self._start_expiry()
         if os.path.exists(self.cloud_info_dir):
             async for changes in awatch(self.cloud_info_dir):
-                # just reload everything
-                self._load_sites()
+                await self._update_site_files(path for _, path in changes)
 
 
 class S3SiteStore(SiteStore):
@@ -383,55 +1129,123 @@ class S3SiteStore(SiteStore):
         super().__init__(**kwargs)
         self.s3_url = s3_url
         self._sites_info = {}
+        self._site_list = []
         self._update_period = 60 * 10  # 10 minutes
 
+    def _parse_failed(self, site, error):
+        tracing.count("objects_failed")
+        SITE_PARSE_FAILURES.labels("s3").inc()
+        logging.error(f"Unable to load site {site['name']}: {error}")
+        self.quarantine.failed(site["name"], site["last_modified"])
+        return {}
+
     def _load_site(self, site):
+        import httpx
+
         name = site["name"]
         if name in self._sites_info:
             if site["last_modified"] == self._sites_info[name]["last_modified"]:
                 # same update, no need to reload
                 logging.info(f"No update neeeded for {name}")
                 return {name: self._sites_info[name]}
+        if self.quarantine.holds(name, site["last_modified"]):
+            tracing.count("objects_quarantined")
+            return {}
+        tracing.count("objects_read")
         try:
-            r = self.httpx_client.get(
-                os.path.join(self.s3_url, name),
-                headers={
-                    "accept": "application/json",
-                },
-            )
+            # not worth downloading if too large
+            self.parser.check_size(site.get("bytes", 0))
+        except SiteFileError as e:
+            return self._parse_failed(site, e)
+        try:
+            with UPSTREAM_DURATION.labels("s3").time(), tracing.phase("download"):
+                r = self.httpx_client.get(
+                    os.path.join(self.s3_url, name),
+                    headers={
+                        "accept": "application/json",
+                    },
+                )
             r.raise_for_status()
             try:
-                site.update({"info": self.create_site(r.json())})
+                with SITE_PARSE_DURATION.labels("s3").time():
+                    with tracing.phase("decode"):
+                        info = self.parser.decode(r.content)
+                    info, valid_until = self._read_site_info(info)
             except Exception as e:
-                logging.error(f"Unable to load site {name}: {e}")
+                return self._parse_failed(site, e)
+            self.quarantine.release(name)
+            if info is None:
+                # expired, not a failure
                 return {}
+            site.update({"info": info, "valid_until": valid_until})
             logging.info(f"Loaded info from {name}")
             return {name: site}
         except httpx.HTTPError as e:
+            UPSTREAM_ERRORS.labels("s3").inc()
             logging.error(f"Unable to load site information: {e}")
+            return {}
 
-    def _update_sites(self):
+    def _fetch_sites(self):
+        """Gets the sites from S3, meant to be run in a worker thread"""
         new_sites = {}
         try:
-            r = self.httpx_client.get(
-                self.s3_url,
-                headers={
-                    "accept": "application/json",
-                },
-            )
+            with UPSTREAM_DURATION.labels("s3").time(), tracing.phase("scan"):
+                r = self.httpx_client.get(
+                    self.s3_url,
+                    headers={
+                        "accept": "application/json",
+                    },
+                )
             r.raise_for_status()
-            for site in r.json():
+            listing = r.json()
+            tracing.count("objects_listed", len(listing))
+            for site in listing:
                 logging.error(f"Update site {site['name']}")
-                new_sites.update(self._load_site(site))
+                with tracing.item(site["name"]):
+                    new_sites.update(self._load_site(site))
         except Exception as e:
+            UPSTREAM_ERRORS.labels("s3").inc()
             logging.error(f"Unable to load Sites: {e}")
+        return new_sites
+
+    async def _apply_sites(self, new_sites):
+        if new_sites.keys() == self._sites_info.keys() and all(
+            site is self._sites_info[name] for name, site in new_sites.items()
+        ):
+            # nothing changed, keep the current snapshot
+            return
+        for name in self._sites_info.keys() - new_sites.keys():
+            self._cancel_expiry(name)
+        for name, site in new_sites.items():
+            valid_until = site.get("valid_until")
+            if valid_until and self._expiry_times.get(name) != valid_until:
+                self._schedule_expiry(name, valid_until)
         # change all at once
         self._sites_info = new_sites
+        await self._publish_sites()
+
+    async def _update_sites(self):
+        with self._reload("s3", "update", "_update_sites"):
+            await self._apply_sites(await asyncio.to_thread(self._fetch_sites))
+
+    async def _expire_sites(self, keys):
+        self._sites_info = {
+            name: site for name, site in self._sites_info.items() if name not in keys
+        }
+        await self._publish_sites()
+
+    async def _publish_sites(self):
+        site_list = [site["info"] for site in self._sites_info.values()]
+        await self._publish(site_list)
 
     def _sites(self):
-        return [site["info"] for site in self._sites_info.values()]
+        return self._site_list
+
+    def _set_sites(self, sites):
+        self._site_list = sites
 
     async def start(self):
+        self._start_expiry()
         while True:
-            self._update_sites()
+            await self._update_sites()
             await asyncio.sleep(self._update_period)
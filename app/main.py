@@ -6,15 +6,33 @@ needed by IM
 """
 
 import asyncio
+import base64
+import gc
+import json
+import secrets
 from contextlib import asynccontextmanager
-from typing import Optional
+from functools import partial, wraps
+from typing import Annotated, Optional
 
-import yaml
-from fastapi import FastAPI, HTTPException, Request, Response
-from pydantic import BaseModel
+import anyio
+from fastapi import Depends, FastAPI, Header, HTTPException, Query, Request, Response
+from fastapi.responses import JSONResponse, StreamingResponse
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, generate_latest
+from pydantic import BaseModel, model_validator
 from pydantic_settings import BaseSettings
 
-from .glue import Discipline, FileSiteStore, VOStore
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+from .admission import AdmissionController, AdmissionMiddleware
+from .cache import CachedResponseMiddleware, ResponseCache
+from .glue import Discipline, DisciplineNode, FileSiteStore, SiteChanges, VOStore
+from .memory import ReloadMemoryDiff, live_generations, snapshot_usage
+from .metrics import MetricsMiddleware, StateCollector
+from .profiling import Profiler, ProfilingMiddleware
+from .sqlite_store import SQLiteSiteStore
 
 
 class Image(BaseModel):
@@ -32,6 +50,24 @@ class Project(BaseModel):
     name: str
 
 
+class InstanceType(BaseModel):
+    name: str
+    cpu: int
+    ram: int
+    disk: int
+    accelerator_type: str
+    accelerator_vendor: str
+    accelerator_model: str
+    accelerator_count: int
+
+
+class Flavor(InstanceType):
+    site: str
+    endpoint: str
+    vo: str
+    project_id: str
+
+
 class Site(BaseModel):
     id: str
     name: str
@@ -39,6 +75,83 @@ class Site(BaseModel):
     state: str
     hostname: str
     projects: Optional[list[Project]] = None
+    images: Optional[list[Image]] = None
+    instancetypes: Optional[list[InstanceType]] = None
+
+
+class SiteVO(BaseModel):
+    site_name: str
+    vo_name: str
+
+
+class SiteLookup(BaseModel):
+    items: list[SiteVO] = []
+    vo_name: str = ""
+    site_names: list[str] = []
+    include_images: bool = True
+    only_egi_images: bool = True
+
+    @model_validator(mode="after")
+    def check_items(self):
+        if self.site_names and not self.vo_name:
+            raise ValueError("vo_name is needed to look up site_names")
+        if len(self.items) + len(self.site_names) > 1000:
+            raise ValueError("Too many items to look up, 1000 max")
+        return self
+
+    def pairs(self):
+        return [(i.site_name, i.vo_name) for i in self.items] + [
+            (site_name, self.vo_name) for site_name in self.site_names
+        ]
+
+
+class SiteLookupResult(BaseModel):
+    site_name: str
+    vo_name: str
+    project: Optional[Project] = None
+    images: Optional[list[Image]] = None
+    error: Optional[str] = None
+
+
+class Changes(BaseModel):
+    generation: int
+    changes: list[SiteChanges]
+
+
+class MemoryUsage(BaseModel):
+    name: str
+    objects: Optional[int] = None
+    bytes: int
+
+
+class MemoryAllocation(BaseModel):
+    location: str
+    size_diff: int
+    count_diff: int
+    size: int
+
+
+class MemoryDiff(BaseModel):
+    from_generation: int
+    to_generation: int
+    size_diff: int
+    top: list[MemoryAllocation]
+
+
+class MemoryReport(BaseModel):
+    generation: int
+    live_generations: list[int]
+    total_bytes: int
+    by_type: list[MemoryUsage]
+    by_site: list[MemoryUsage]
+    by_vo: list[MemoryUsage]
+    by_cache_entry: list[MemoryUsage]
+    reload_diff: Optional[MemoryDiff] = None
+
+
+class Pagination(BaseModel):
+    limit: Optional[int] = None
+    cursor: str = ""
 
 
 class Settings(BaseSettings):
@@ -52,18 +165,86 @@ class Settings(BaseSettings):
     )
     gocdb_url: str = "https://goc.egi.eu"
     check_glue_validity: bool = True
+    max_site_file_size: int = 64 * 2**20
+    max_site_objects: int = 100_000
+    site_parse_timeout: float = 30
+    site_parse_workers: int = 0
+    quarantine_after: int = 2
+    change_history_size: int = 100
+    change_stream_keepalive: int = 15
+    threadpool_size: int = 40
+    response_cache_bytes: int = 128 * 2**20
+    compression_min_size: int = 1024
+    max_concurrent_requests: int = 64
+    max_concurrent_slow_requests: int = 16
+    max_queued_requests: int = 256
+    queue_timeout: float = 10
+    overload_retry_after: int = 5
+    sqlite_db: str = ""
+    sqlite_readonly: bool = False
+    sqlite_cache_bytes: int = 64 * 2**20
+    sqlite_poll_period: int = 5
+    profile_dir: str = ""
+    profile_token: str = ""
+    profile_sample_rate: float = 0
+    profile_reload_sample_rate: float = 0
+    profile_format: str = "collapsed"
+    profile_interval: float = 0.005
+    profile_max_files: int = 100
+    admin_token: str = ""
+    memory_trace: bool = False
+    memory_trace_frames: int = 1
 
 
 settings = Settings()
-site_store = FileSiteStore(**settings.model_dump())
+if settings.sqlite_db:
+    site_store = SQLiteSiteStore(**settings.model_dump())
+else:
+    site_store = FileSiteStore(**settings.model_dump())
 vo_store = VOStore(**settings.model_dump())
+response_cache = ResponseCache(max_bytes=settings.response_cache_bytes)
+# routes that may need to build large responses, served after the rest
+SLOW_ROUTES = [
+    "/images/",
+    "/flavors/",
+    "/sites/lookup",
+    "/fedcloudclient/sites.yaml",
+    "/changes/",
+    "/admin/",
+]
+NDJSON_MEDIA_TYPE = "application/x-ndjson"
+MSGPACK_MEDIA_TYPE = "application/msgpack"
+admission = AdmissionController(
+    limit=settings.max_concurrent_requests,
+    queue_size=settings.max_queued_requests,
+    timeout=settings.queue_timeout,
+    classes={"slow": (1, settings.max_concurrent_slow_requests)},
+)
+profiler = Profiler(
+    directory=settings.profile_dir,
+    sample_rate=settings.profile_sample_rate,
+    reload_sample_rate=settings.profile_reload_sample_rate,
+    token=settings.profile_token,
+    output_format=settings.profile_format,
+    interval=settings.profile_interval,
+    max_files=settings.profile_max_files,
+    generation=lambda: site_store.generation,
+)
+site_store.profiler = vo_store.profiler = profiler
+memory_diff = ReloadMemoryDiff(frames=settings.memory_trace_frames)
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
+    limiter = anyio.to_thread.current_default_thread_limiter()
+    limiter.total_tokens = settings.threadpool_size
     asyncio.create_task(vo_store.start())
     asyncio.create_task(site_store.start())
+    if settings.memory_trace:
+        memory_diff.start()
+        asyncio.create_task(memory_diff.watch(site_store))
     yield
+    site_store.parser.close()
 
 
 tags_metadata = [
@@ -79,10 +260,30 @@ tags_metadata = [
         "name": "images",
         "description": "Discovery of images.",
     },
+    {
+        "name": "flavors",
+        "description": "Discovery of flavors.",
+    },
     {
         "name": "fedcloudclient",
         "description": "Fedcloudclient configuration files.",
     },
+    {
+        "name": "changes",
+        "description": "Changes in the site information.",
+    },
+    {
+        "name": "health",
+        "description": "Liveness of the API.",
+    },
+    {
+        "name": "metrics",
+        "description": "Prometheus metrics.",
+    },
+    {
+        "name": "admin",
+        "description": "Introspection of the API, needs the admin token.",
+    },
 ]
 
 
@@ -101,39 +302,382 @@ app = FastAPI(
     lifespan=lifespan,
     openapi_tags=tags_metadata,
 )
+# only requests actually reaching the routes are profiled
+app.add_middleware(
+    ProfilingMiddleware,
+    profiler=profiler,
+    exempt=["/health", "/metrics", "/changes/stream"],
+)
+# cached responses are served before going through admission control
+app.add_middleware(
+    AdmissionMiddleware,
+    controller=admission,
+    routes=[(path, "slow") for path in SLOW_ROUTES],
+    exempt=["/health", "/metrics", "/changes/stream"],
+    retry_after=settings.overload_retry_after,
+)
+app.add_middleware(
+    CachedResponseMiddleware,
+    cache=response_cache,
+    # refreshing the VOs does not drop the responses about the sites
+    generation={
+        "/sites/": lambda: site_store.generation,
+        "/images/": lambda: site_store.generation,
+        "/flavors/": lambda: site_store.generation,
+        "/fedcloudclient/": lambda: site_store.generation,
+        "/vos/": lambda: vo_store.generation,
+        "/disciplines/": lambda: vo_store.generation,
+    },
+    routes=app.router.routes,
+    # requests to be profiled go through to the app
+    bypass=profiler.requested,
+    min_size=settings.compression_min_size,
+    media_types=[MSGPACK_MEDIA_TYPE],
+    no_cache_media_types=[NDJSON_MEDIA_TYPE],
+)
+app.add_middleware(MetricsMiddleware, routes=app.router.routes)
+REGISTRY.register(StateCollector(site_store, response_cache, admission))
 
 
 #
 # Helper functions
 #
+def _site_error(site, site_name: str, vo_name: str = ""):
+    """Gets the reason why a site cannot be used, None if it's fine"""
+    if not site:
+        return f"Site {site_name} not found"
+    if vo_name and not site.supports_vo(vo_name):
+        return f"VO {vo_name} not supported by Site {site_name}"
+    return None
+
+
 def _get_site(site_name: str, vo_name: str = ""):
     """Gets site given a name and optionally a VO"""
     site = site_store.get_site_by_name(site_name)
-    if not site:
-        raise HTTPException(status_code=404, detail=f"Site {site_name} not found")
-    if vo_name and not site.supports_vo(vo_name):
+    error = _site_error(site, site_name, vo_name)
+    if error:
+        raise HTTPException(status_code=404, detail=error)
+    return site
+
+
+def pagination(
+    limit: Annotated[Optional[int], Query(gt=0, le=10000)] = None, cursor: str = ""
+) -> Pagination:
+    return Pagination(limit=limit, cursor=cursor)
+
+
+def _parse_fields(fields: str, model: type[BaseModel]):
+    """Gets the list of fields requested for a model, None if not given"""
+    if not fields:
+        return None
+    selected = list(dict.fromkeys(f.strip() for f in fields.split(",") if f.strip()))
+    unknown = [f for f in selected if f not in model.model_fields]
+    if unknown:
         raise HTTPException(
-            status_code=404, detail=f"VO {vo_name} not supported by Site {site_name}"
+            status_code=400, detail=f"Unknown fields: {', '.join(unknown)}"
         )
-    return site
+    return selected
 
 
-def filter_images(images: list[Image], only_egi_images: bool = True):
-    """Filters images if only_egi_images is True"""
-    if only_egi_images:
-        return filter(lambda x: x.egi_id, images)
-    else:
-        return images
+NDJSON_BATCH_SIZE = 100
+
+
+def _encode_cursor(generation: int, offset: int):
+    return base64.urlsafe_b64encode(f"{generation}:{offset}".encode()).decode()
+
+
+def _decode_cursor(cursor: str, generation: int):
+    """Gets the offset of a cursor, only valid for the given generation"""
+    try:
+        cursor_generation, offset = base64.urlsafe_b64decode(cursor).decode().split(":")
+        cursor_generation, offset = int(cursor_generation), int(offset)
+        if offset < 0:
+            raise ValueError("Negative offset")
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    if cursor_generation != generation:
+        raise HTTPException(
+            status_code=410, detail="Cursor expired, site information was updated"
+        )
+    return offset
+
+
+def _image(site, image):
+    return Image(**image.model_dump(), endpoint=site.url)
+
+
+def _image_column(images, field):
+    if field == "endpoint":
+        return [site.url for site, _ in images]
+    return [getattr(image, field) for _, image in images]
+
+
+SITE_INCLUDES = ("projects", "images", "instancetypes")
+# includes needing the images and instance types of the shares
+SITE_DETAILS = ("images", "instancetypes")
+
+
+def _parse_includes(include: str, include_projects: bool, fields):
+    """Gets the sorted tuple of extra details to include for sites"""
+    includes = {i.strip() for i in include.split(",") if i.strip()}
+    unknown = includes.difference(SITE_INCLUDES)
+    if unknown:
+        raise HTTPException(
+            status_code=400, detail=f"Unknown includes: {', '.join(sorted(unknown))}"
+        )
+    if include_projects:
+        includes.add("projects")
+    # requesting the field is enough to include it
+    includes.update(f for f in fields or [] if f in SITE_INCLUDES)
+    return tuple(sorted(includes))
+
+
+def _site_view(site, vo_name, includes, only_egi_images):
+    view = site.summary()
+    shares = [site.vo_share(vo_name)] if vo_name else site.shares
+    if "projects" in includes:
+        view["projects"] = [share.get_project() for share in shares]
+    if "images" in includes:
+        view["images"] = [
+            dict(image.model_dump(), endpoint=site.url)
+            for share in shares
+            for image in share.images
+            if image.egi_id or not only_egi_images
+        ]
+    if "instancetypes" in includes:
+        view["instancetypes"] = [
+            instancetype.model_dump()
+            for share in shares
+            for instancetype in share.instancetypes
+        ]
+    return view
+
+
+def _site_views(sites, vo_name, includes, only_egi_images):
+    return [_site_view(s, vo_name, includes, only_egi_images) for s in sites]
+
+
+def _snapshot_site_views(snapshot, vo_name, includes, only_egi_images):
+    """Gets the views of the sites of the VO, built once per snapshot"""
+    return snapshot.cached(
+        ("site_views", vo_name or None, includes, only_egi_images),
+        lambda: _site_views(
+            snapshot.get_sites(
+                vo_name, details=any(i in includes for i in SITE_DETAILS)
+            ),
+            vo_name,
+            includes,
+            only_egi_images,
+        ),
+        vo_name,
+    )
+
+
+def _flavor(site, share, instancetype):
+    return Flavor(
+        **instancetype.model_dump(),
+        site=site.name,
+        endpoint=site.url,
+        vo=share.vo,
+        project_id=share.project_id,
+    )
+
+
+def _flavor_column(flavors, field):
+    if field in InstanceType.model_fields:
+        return [getattr(instancetype, field) for _, _, instancetype in flavors]
+    return [getattr(_flavor(*f), field) for f in flavors]
+
+
+def _ndjson(lines):
+    batch = []
+    for line in lines:
+        batch.append(line)
+        if len(batch) == NDJSON_BATCH_SIZE:
+            yield "\n".join(batch) + "\n"
+            batch = []
+    if batch:
+        yield "\n".join(batch) + "\n"
+
+
+def _accepts(request: Request, media_type: str):
+    return media_type in request.headers.get("accept", "")
+
+
+def _listing(
+    request: Request,
+    response: Response,
+    items: list,
+    page: Pagination,
+    generation: int,
+    build,
+    columns,
+    fields: Optional[list[str]],
+    default_fields: list[str],
+):
+    """Builds a listing out of items, a list indexed for the current
+    generation, with build converting each item into the response model
+    and columns returning the values of a given field for every item.
+
+    If a limit is given, only a page of items is returned with a Link header
+    pointing to the next one. If NDJSON is accepted, the results are streamed
+    one per line. If fields are requested or MessagePack is accepted, the
+    response is built from the columns instead of the models.
+    """
+    start = _decode_cursor(page.cursor, generation) if page.cursor else 0
+    end = start + page.limit if page.limit else len(items)
+    headers = {}
+    if end < len(items):
+        next_url = request.url.include_query_params(
+            cursor=_encode_cursor(generation, end), limit=page.limit
+        )
+        headers["Link"] = f'<{next_url}>; rel="next"'
+    use_msgpack = msgpack and _accepts(request, MSGPACK_MEDIA_TYPE)
+    if fields is None and not use_msgpack:
+        models = map(build, items[start:end])
+        if _accepts(request, NDJSON_MEDIA_TYPE):
+            return StreamingResponse(
+                _ndjson(m.model_dump_json(exclude_none=True) for m in models),
+                media_type=NDJSON_MEDIA_TYPE,
+                headers=headers,
+            )
+        response.headers.update(headers)
+        return list(models)
+    fields = fields or default_fields
+    rows = (
+        dict(zip(fields, values))
+        for values in zip(*(columns(f)[start:end] for f in fields))
+    )
+    if _accepts(request, NDJSON_MEDIA_TYPE):
+        return StreamingResponse(
+            _ndjson(map(json.dumps, rows)),
+            media_type=NDJSON_MEDIA_TYPE,
+            headers=headers,
+        )
+    if use_msgpack:
+        return Response(
+            content=msgpack.packb(list(rows)),
+            media_type=MSGPACK_MEDIA_TYPE,
+            headers=headers,
+        )
+    return JSONResponse(list(rows), headers=headers)
+
+
+YAML_MEDIA_TYPE = "application/yaml"
+
+
+def _fedcloudclient_site(site):
+    return {
+        "gocdb": site.name,
+        "endpoint": site.url,
+        "vos": [
+            {"name": p.vo, "auth": {"project_id": p.project_id}} for p in site.shares
+        ],
+    }
+
+
+def _dump_yamls(sites):
+    # only needed once the sites are loaded, not worth importing at startup
+    import yaml
+
+    # use the C emitter if available, it's way faster than the python one
+    dumper = getattr(yaml, "CSafeDumper", yaml.SafeDumper)
+    return {s.name: yaml.dump(_fedcloudclient_site(s), Dumper=dumper) for s in sites}
+
+
+def _fedcloudclient_yamls(snapshot):
+    """Gets the fedcloudclient yaml of every site, rendered once per snapshot"""
+    return snapshot.cached(
+        "fedcloudclient", lambda: _dump_yamls(snapshot.get_sites(details=False))
+    )
+
+
+def _join_fedcloudclient_yamls(snapshot, vo_name):
+    """Joins the yaml of the sites as a yaml list"""
+    site_yamls = _fedcloudclient_yamls(snapshot)
+    items = [
+        # indent the rendered mapping so it becomes an item of the list
+        "- " + site_yamls[s.name].rstrip("\n").replace("\n", "\n  ") + "\n"
+        for s in snapshot.get_sites(vo_name, details=False)
+    ]
+    return "".join(items) or "[]\n"
+
+
+def _fedcloudclient_bundle(snapshot, vo_name):
+    """Gets the yaml with all the sites of the VO, built once per snapshot"""
+    return snapshot.cached(
+        ("fedcloudclient_bundle", vo_name or None),
+        lambda: _join_fedcloudclient_yamls(snapshot, vo_name),
+        vo_name,
+    )
+
+
+def _fedcloudclient_paths(snapshot):
+    return snapshot.cached(
+        "fedcloudclient_paths",
+        lambda: [
+            app.url_path_for("get_fedcloudclient_site", site_name=s.name)
+            for s in snapshot.get_sites(details=False)
+        ],
+    )
+
+
+def warm_snapshot(snapshot):
+    """Prepares the content of the most requested responses for a snapshot,
+    called by the site store before publishing it"""
+    _fedcloudclient_yamls(snapshot)
+    _fedcloudclient_paths(snapshot)
+    vo_names = snapshot.vo_names() if snapshot.warm_every_vo else []
+    for vo_name in [None, *vo_names]:
+        _fedcloudclient_bundle(snapshot, vo_name)
+        _snapshot_site_views(snapshot, vo_name, (), True)
+
+
+site_store.warmers.append(warm_snapshot)
+
+
+def _lookup_route(route):
+    """Lookups are served on the event loop with the in-memory snapshots, to
+    avoid the overhead of the threadpool, but the queries of the SQLite
+    snapshots block, so with them they stay in the threadpool"""
+    if isinstance(site_store, SQLiteSiteStore):
+        return route
+
+    @wraps(route)
+    async def lookup(*args, **kwargs):
+        return route(*args, **kwargs)
+
+    return lookup
 
 
 #
 # API functions
 #
+# Lookups only reading from the stores snapshots are async to avoid the
+# overhead of the threadpool. Listings stay as plain functions, building and
+# serializing them would block the event loop, as would anything else that
+# may block
+@app.get("/health", tags=["health"])
+async def get_health() -> dict[str, str]:
+    """Check that the API is alive, never waits behind other requests."""
+    return {"status": "ok"}
+
+
+@app.get(
+    "/metrics",
+    tags=["metrics"],
+    response_class=Response,
+    responses={200: {"content": {CONTENT_TYPE_LATEST: {}}}},
+)
+async def get_metrics():
+    """Get the metrics of the API in Prometheus format."""
+    return Response(content=generate_latest(), media_type=CONTENT_TYPE_LATEST)
+
+
 @app.get("/vos/", tags=["vos"])
 def get_vos() -> list[str]:
     """Get a list of available VOs."""
-    vos = sorted([vo.name for vo in vo_store.get_vos()])
-    return vos
+    return vo_store.get_vo_names()
 
 
 @app.get("/disciplines/", tags=["vos"])
@@ -141,31 +685,74 @@ def get_disciplines() -> list[Discipline]:
     return vo_store.get_disciplines()
 
 
+@app.get("/disciplines/tree", tags=["vos"])
+def get_discipline_tree() -> list[DisciplineNode]:
+    """Get the disciplines as a tree, with the VOs of every discipline."""
+    return vo_store.get_discipline_tree()
+
+
+@app.get("/disciplines/{discipline_id}/vos", tags=["vos"])
+def get_discipline_vos(discipline_id: str) -> list[str]:
+    """Get the VOs of a discipline and its sub-disciplines."""
+    vos = vo_store.get_discipline_vos(discipline_id)
+    if vos is None:
+        raise HTTPException(
+            status_code=404, detail=f"Discipline {discipline_id} not found"
+        )
+    return vos
+
+
 @app.get("/sites/", tags=["sites"], response_model_exclude_none=True)
 def get_sites(
-    vo_name: str = "", site_name: str = "", include_projects: bool = False
+    request: Request,
+    response: Response,
+    page: Annotated[Pagination, Depends(pagination)],
+    vo_name: str = "",
+    site_name: str = "",
+    include_projects: bool = False,
+    include: str = "",
+    only_egi_images: bool = True,
+    fields: str = "",
 ) -> list[Site]:
     """Get a list of available sites.
 
     Optionally filter by VO or site name (as listed in GOCDB).
-    Optionally add details on projects
+    Optionally add details on projects.
+    Optionally include projects, images and/or instancetypes as a
+    comma-separated list, these are restricted to the VO if given.
+    Optionally select the fields to return as a comma-separated list.
+    Optionally paginate with limit and cursor or stream as NDJSON.
     """
+    selected_fields = _parse_fields(fields, Site)
+    includes = _parse_includes(include, include_projects, selected_fields)
+    default_fields = [
+        f for f in Site.model_fields if f not in SITE_INCLUDES or f in includes
+    ]
     if site_name:
         site = site_store.get_site_by_name(site_name)
-        if vo_name:
-            if site.supports_vo(vo_name):
-                return [Site(**site.summary(include_projects=include_projects))]
-            else:
-                return []
-        else:
-            return [Site(**site.summary(include_projects=include_projects))]
-    return [
-        Site(**s.summary(include_projects=include_projects))
-        for s in site_store.get_sites(vo_name)
-    ]
+        sites = [site] if site and (not vo_name or site.supports_vo(vo_name)) else []
+        generation = site_store.generation
+        views = _site_views(sites, vo_name, includes, only_egi_images)
+    else:
+        snapshot = site_store.snapshot()
+        generation = snapshot.generation
+        views = _snapshot_site_views(snapshot, vo_name, includes, only_egi_images)
+
+    return _listing(
+        request,
+        response,
+        views,
+        page,
+        generation,
+        lambda view: Site(**view),
+        lambda field: [view.get(field) for view in views],
+        selected_fields,
+        default_fields,
+    )
 
 
 @app.get("/site/{site_name}/", tags=["sites"], response_model_exclude_none=True)
+@_lookup_route
 def get_site(site_name: str, include_projects: bool = False) -> Site:
     """Get site information
 
@@ -175,6 +762,7 @@ def get_site(site_name: str, include_projects: bool = False) -> Site:
 
 
 @app.get("/site/{site_name}/projects", tags=["sites"])
+@_lookup_route
 def get_site_project_ids(site_name: str) -> list[Project]:
     """Get information about the projects supported at a site"""
     site = _get_site(site_name)
@@ -182,15 +770,43 @@ def get_site_project_ids(site_name: str) -> list[Project]:
 
 
 @app.get("/site/{site_name}/images", tags=["sites"])
-def get_site_images(site_name: str, only_egi_images: bool = True) -> list[Image]:
-    """Get all images from a site"""
+def get_site_images(
+    request: Request,
+    response: Response,
+    site_name: str,
+    page: Annotated[Pagination, Depends(pagination)],
+    only_egi_images: bool = True,
+    fields: str = "",
+) -> list[Image]:
+    """Get all images from a site
+
+    Optionally select the fields to return as a comma-separated list.
+    Optionally paginate with limit and cursor or stream as NDJSON.
+    """
+    selected_fields = _parse_fields(fields, Image)
+    generation = site_store.generation
     site = _get_site(site_name)
-    return filter_images(
-        [Image(**img, endpoint=site.url) for img in site.image_list()], only_egi_images
+    images = [
+        (site, image)
+        for share in site.shares
+        for image in share.images
+        if image.egi_id or not only_egi_images
+    ]
+    return _listing(
+        request,
+        response,
+        images,
+        page,
+        generation,
+        lambda i: _image(*i),
+        partial(_image_column, images),
+        selected_fields,
+        list(Image.model_fields),
     )
 
 
 @app.get("/site/{site_name}/{vo_name}/project", tags=["sites"])
+@_lookup_route
 def get_project_id(site_name: str, vo_name: str) -> Project:
     """Get information about the project supporting a VO at a site"""
     site = _get_site(site_name, vo_name)
@@ -199,58 +815,294 @@ def get_project_id(site_name: str, vo_name: str) -> Project:
 
 @app.get("/site/{site_name}/{vo_name}/images", tags=["sites"])
 def get_images(
-    site_name: str, vo_name: str, only_egi_images: bool = True
+    request: Request,
+    response: Response,
+    site_name: str,
+    vo_name: str,
+    page: Annotated[Pagination, Depends(pagination)],
+    only_egi_images: bool = True,
+    fields: str = "",
 ) -> list[Image]:
-    """Get information about the images of a VO"""
+    """Get information about the images of a VO
+
+    Optionally select the fields to return as a comma-separated list.
+    Optionally paginate with limit and cursor or stream as NDJSON.
+    """
+    selected_fields = _parse_fields(fields, Image)
+    generation = site_store.generation
     site = _get_site(site_name, vo_name)
-    return filter_images(
-        [
-            Image(**img, endpoint=site.url)
-            for img in site.vo_share(vo_name).image_list()
-        ],
-        only_egi_images,
+    images = [
+        (site, image)
+        for image in site.vo_share(vo_name).images
+        if image.egi_id or not only_egi_images
+    ]
+    return _listing(
+        request,
+        response,
+        images,
+        page,
+        generation,
+        lambda i: _image(*i),
+        partial(_image_column, images),
+        selected_fields,
+        list(Image.model_fields),
+    )
+
+
+@app.post("/sites/lookup", tags=["sites"], response_model_exclude_none=True)
+def lookup_sites(lookup: SiteLookup) -> list[SiteLookupResult]:
+    """Get the project and images of several sites and VOs at once
+
+    Sites and VOs can be given as a list of items with site_name and vo_name,
+    or as a vo_name with a list of site_names. Errors are reported for
+    each of the items.
+    """
+    snapshot = site_store.snapshot()
+    results = []
+    for site_name, vo_name in lookup.pairs():
+        result = SiteLookupResult(site_name=site_name, vo_name=vo_name)
+        site = snapshot.get_site_by_name(site_name)
+        result.error = _site_error(site, site_name, vo_name)
+        if not result.error:
+            share = site.vo_share(vo_name)
+            result.project = Project(**share.get_project())
+            if lookup.include_images:
+                result.images = [
+                    _image(site, image)
+                    for image in share.images
+                    if image.egi_id or not lookup.only_egi_images
+                ]
+        results.append(result)
+    return results
+
+
+@app.get("/images/search", tags=["images"])
+def search_images(
+    request: Request,
+    response: Response,
+    page: Annotated[Pagination, Depends(pagination)],
+    name: str = "",
+    egi_id: str = "",
+    version: str = "",
+    mpuri: str = "",
+    vo: str = "",
+    q: str = "",
+    only_egi_images: bool = True,
+    fields: str = "",
+) -> list[Image]:
+    """Search images.
+
+    Filter by the exact value of name, egi_id, version, mpuri or vo, or by
+    their prefix if the value ends with *. Names match also without the
+    "Image for" prefix and the [distro/arch] suffix.
+    Optionally search for the words in q in any of those.
+    Optionally select the fields to return as a comma-separated list.
+    Optionally paginate with limit and cursor or stream as NDJSON.
+    """
+    selected_fields = _parse_fields(fields, Image)
+    criteria = dict(name=name, egi_id=egi_id, version=version, mpuri=mpuri, vo=vo)
+    snapshot = site_store.snapshot()
+    images = [
+        (site, image)
+        for site, image in snapshot.image_index().search(
+            {field: value for field, value in criteria.items() if value}, q
+        )
+        if image.egi_id or not only_egi_images
+    ]
+    return _listing(
+        request,
+        response,
+        images,
+        page,
+        snapshot.generation,
+        lambda i: _image(*i),
+        partial(_image_column, images),
+        selected_fields,
+        list(Image.model_fields),
     )
 
 
 @app.get("/images/", tags=["images"])
-def get_all_images(vo_name: str = "", only_egi_images: bool = True) -> list[Image]:
+def get_all_images(
+    request: Request,
+    response: Response,
+    page: Annotated[Pagination, Depends(pagination)],
+    vo_name: str = "",
+    only_egi_images: bool = True,
+    fields: str = "",
+) -> list[Image]:
     """Get a list of available images.
 
     Optionally filter by VO and EGI images.
+    Optionally select the fields to return as a comma-separated list.
+    Optionally paginate with limit and cursor or stream as NDJSON.
     """
-    images: list[Image] = []
-    for site in site_store.get_sites(vo_name):
-        if vo_name:
-            images.extend(
-                Image(**img, endpoint=site.url)
-                for img in site.vo_share(vo_name).image_list()
-            )
-        else:
-            images.extend(Image(**img, endpoint=site.url) for img in site.image_list())
-    return filter_images(images, only_egi_images)
+    selected_fields = _parse_fields(fields, Image)
+    snapshot = site_store.snapshot()
+    images = snapshot.get_images(vo_name, only_egi_images)
+
+    def columns(field):
+        return snapshot.cached(
+            ("image_column", vo_name or None, only_egi_images, field),
+            lambda: _image_column(images, field),
+            vo_name,
+        )
+
+    return _listing(
+        request,
+        response,
+        images,
+        page,
+        snapshot.generation,
+        lambda i: _image(*i),
+        columns,
+        selected_fields,
+        list(Image.model_fields),
+    )
+
+
+@app.get("/flavors/", tags=["flavors"])
+def get_flavors(
+    request: Request,
+    response: Response,
+    page: Annotated[Pagination, Depends(pagination)],
+    vo_name: str = "",
+    min_cpu: Annotated[int, Query(ge=0)] = 0,
+    min_ram: Annotated[int, Query(ge=0)] = 0,
+    min_disk: Annotated[int, Query(ge=0)] = 0,
+    gpu: Optional[bool] = None,
+    fields: str = "",
+) -> list[Flavor]:
+    """Get the flavors available in the federation, sorted by CPU.
+
+    Optionally filter by VO, minimum CPU, RAM (MB) and disk (GB), and by
+    having (or not) accelerators.
+    Optionally select the fields to return as a comma-separated list.
+    Optionally paginate with limit and cursor or stream as NDJSON.
+    """
+    selected_fields = _parse_fields(fields, Flavor)
+    snapshot = site_store.snapshot()
+    flavors = snapshot.find_flavors(vo_name, min_cpu, min_ram, min_disk, gpu)
+    return _listing(
+        request,
+        response,
+        flavors,
+        page,
+        snapshot.generation,
+        lambda f: _flavor(*f),
+        partial(_flavor_column, flavors),
+        selected_fields,
+        list(Flavor.model_fields),
+    )
 
 
 @app.get("/fedcloudclient/", tags=["fedcloudclient"])
+@_lookup_route
 def get_fedcloudclient_sites(request: Request) -> list[str]:
     """Get a list of available site configurations for fedcloudclient."""
-    return [
-        str(request.url_for("get_fedcloudclient_site", site_name=s.name))
-        for s in site_store.get_sites()
-    ]
+    paths = _fedcloudclient_paths(site_store.snapshot())
+    base_url = str(request.base_url).rstrip("/")
+    return [base_url + path for path in paths]
+
+
+@app.get(
+    "/fedcloudclient/sites.yaml",
+    tags=["fedcloudclient"],
+    response_class=Response,
+    responses={200: {"content": {YAML_MEDIA_TYPE: {}}}},
+)
+@_lookup_route
+def get_fedcloudclient_all_sites(vo_name: str = ""):
+    """Get the configuration of all sites for fedcloudclient as a single yaml
+
+    Optionally filter by VO
+    """
+    content = _fedcloudclient_bundle(site_store.snapshot(), vo_name)
+    return Response(content=content, media_type=YAML_MEDIA_TYPE)
 
 
 @app.get("/fedcloudclient/{site_name}/", tags=["fedcloudclient"])
+@_lookup_route
 def get_fedcloudclient_site(site_name: str) -> str:
     """Get site information as yaml compatible with fedcloudclient
 
     Name of the site in the GOCDB
     """
-    site = _get_site(site_name)
-    fedcloud_site = {
-        "gocdb": site.name,
-        "endpoint": site.url,
-        "vos": [
-            {"name": p.vo, "auth": {"project_id": p.project_id}} for p in site.shares
-        ],
-    }
-    return Response(content=yaml.dump(fedcloud_site), media_type="application/yaml")
+    snapshot = site_store.snapshot()
+    content = _fedcloudclient_yamls(snapshot).get(site_name)
+    if content is None:
+        raise HTTPException(status_code=404, detail=f"Site {site_name} not found")
+    return Response(content=content, media_type=YAML_MEDIA_TYPE)
+
+
+@app.get("/changes/", tags=["changes"])
+async def get_changes(since: Annotated[int, Query(ge=0)] = 0) -> Changes:
+    """Get the changes on sites, shares and images after a given generation
+
+    Only a limited number of changes are kept, if those since the given
+    generation are not available anymore, a 410 is returned and clients
+    should get the full information again.
+    """
+    generation = site_store.generation
+    changes = site_store.get_changes(since)
+    if changes is None:
+        raise HTTPException(
+            status_code=410, detail=f"Changes since {since} are not available"
+        )
+    return Changes(generation=generation, changes=changes)
+
+
+async def _generation_events(request: Request):
+    generation = None
+    while not await request.is_disconnected():
+        snapshot = await site_store.wait_for_snapshot(
+            generation, settings.change_stream_keepalive
+        )
+        if snapshot.generation == generation:
+            yield ": keepalive\n\n"
+            continue
+        generation = snapshot.generation
+        data = json.dumps({"generation": generation})
+        yield f"id: {generation}\nevent: generation\ndata: {data}\n\n"
+
+
+@app.get(
+    "/changes/stream",
+    tags=["changes"],
+    response_class=StreamingResponse,
+    responses={200: {"content": {"text/event-stream": {}}}},
+)
+async def get_changes_stream(request: Request):
+    """Stream the new generations of the site information as server-sent
+    events, use /changes/ to get what changed"""
+    return StreamingResponse(
+        _generation_events(request), media_type="text/event-stream"
+    )
+
+
+def check_admin(x_admin_token: Annotated[str, Header()] = ""):
+    if not settings.admin_token:
+        raise HTTPException(status_code=404, detail="Admin endpoints are disabled")
+    if not secrets.compare_digest(x_admin_token, settings.admin_token):
+        raise HTTPException(status_code=403, detail="Invalid admin token")
+
+
+@app.get("/admin/memory", tags=["admin"], dependencies=[Depends(check_admin)])
+def get_memory(
+    top: Annotated[int, Query(gt=0, le=1000)] = 20, collect: bool = False
+) -> MemoryReport:
+    """Get the approximate memory retained by the current site information
+
+    The size of the objects is attributed to the first site, VO or derived
+    data reaching them. Use collect to run the garbage collector before
+    counting the live generations. If MEMORY_TRACE is set, the allocations
+    that changed the most between the last two reloads are included.
+    """
+    if collect:
+        gc.collect()
+    usage = snapshot_usage(site_store.snapshot(), response_cache, top)
+    return MemoryReport(
+        live_generations=live_generations(),
+        reload_diff=memory_diff.diff(top),
+        **usage,
+    )
@@ -0,0 +1,161 @@
+"""
+Memory accounting of the site information
+
+Estimates the memory retained by a snapshot by walking its objects, every
+object is counted once, for the first site, VO or kind of data that reaches
+it, so the figures are approximate but add up. Objects are attributed to the
+closest model (GlueSite, GlueShare, GlueImage...) containing them.
+
+ReloadMemoryDiff compares the allocations traced by tracemalloc after two
+consecutive reloads, to find what grows on every reload.
+"""
+
+import asyncio
+import sys
+import tracemalloc
+import types
+import weakref
+from collections import Counter, deque
+
+from pydantic import BaseModel
+
+# snapshots alive, to notice those kept after being replaced
+live_snapshots = weakref.WeakSet()
+
+_SKIPPED = (type, types.ModuleType, types.FunctionType, types.MethodType)
+
+
+class MemoryCounter:
+    """Counts the size of objects, skipping those already counted"""
+
+    def __init__(self):
+        self.seen = set()
+        self.bytes = Counter()
+        self.objects = Counter()
+
+    def _referents(self, obj):
+        if isinstance(obj, dict):
+            return [*obj.keys(), *obj.values()]
+        if isinstance(obj, (list, tuple, set, frozenset, deque)):
+            return list(obj)
+        referents = []
+        attrs = getattr(obj, "__dict__", None)
+        if attrs is not None:
+            referents.append(attrs)
+        for slot in getattr(type(obj), "__slots__", ()):
+            if hasattr(obj, slot):
+                referents.append(getattr(obj, slot))
+        return referents
+
+    def measure(self, obj, owner):
+        """Gets the size of obj and what it references that wasn't counted
+        yet, attributed to owner or the models found on the way"""
+        total = 0
+        stack = [(obj, owner)]
+        while stack:
+            obj, owner = stack.pop()
+            if id(obj) in self.seen or isinstance(obj, _SKIPPED):
+                continue
+            self.seen.add(id(obj))
+            if isinstance(obj, BaseModel):
+                owner = type(obj).__name__
+                self.objects[owner] += 1
+            size = sys.getsizeof(obj)
+            self.bytes[owner] += size
+            total += size
+            stack.extend((referent, owner) for referent in self._referents(obj))
+        return total
+
+
+def snapshot_usage(snapshot, response_cache=None, top=20):
+    """Gets the memory used by the snapshot by type, site, VO and derived
+    data, and by the responses cached for it"""
+    # SQLite snapshots don't have their sites in memory, only the writer
+    # keeps them as source
+    sites = snapshot.source if isinstance(snapshot.source, list) else []
+    counter = MemoryCounter()
+    by_site = [(site.name, counter.measure(site, "GlueSite")) for site in sites]
+    by_cache_entry = [
+        (str(key), counter.measure(value, "snapshot_cache"))
+        for key, value in snapshot.cached_items()
+    ]
+    counter.measure(snapshot, type(snapshot).__name__)
+    if response_cache is not None:
+        counter.measure(response_cache.entries(), "cached_responses")
+    # another pass, as the shares of a VO are already counted in their sites
+    vo_counter = MemoryCounter()
+    by_vo = Counter()
+    for site in sites:
+        for share in site.shares:
+            by_vo[share.vo] += vo_counter.measure(share, "GlueShare")
+
+    def largest(items):
+        items = sorted(items, key=lambda item: item[1], reverse=True)[:top]
+        return [{"name": name, "bytes": size} for name, size in items]
+
+    return {
+        "generation": snapshot.generation,
+        "total_bytes": sum(counter.bytes.values()),
+        "by_type": [
+            {"name": name, "objects": counter.objects[name], "bytes": size}
+            for name, size in counter.bytes.most_common()
+        ],
+        "by_site": largest(by_site),
+        "by_vo": largest(by_vo.items()),
+        "by_cache_entry": largest(by_cache_entry),
+    }
+
+
+def live_generations():
+    return sorted(snapshot.generation for snapshot in list(live_snapshots))
+
+
+class ReloadMemoryDiff:
+    """Takes a tracemalloc snapshot after every reload of the site store,
+    tracing the allocations has a large overhead so it's opt-in"""
+
+    def __init__(self, frames=1):
+        self.frames = frames
+        self.previous = None
+        self.current = None
+
+    def start(self):
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(self.frames)
+
+    def take(self, generation):
+        snapshot = tracemalloc.take_snapshot().filter_traces(
+            [tracemalloc.Filter(False, tracemalloc.__file__)]
+        )
+        self.previous, self.current = self.current, (generation, snapshot)
+
+    def diff(self, top=20):
+        """Gets the allocations that changed the most between the last two
+        reloads, or None if there haven't been two yet"""
+        if self.previous is None:
+            return None
+        (old_generation, old), (generation, new) = self.previous, self.current
+        return {
+            "from_generation": old_generation,
+            "to_generation": generation,
+            "size_diff": sum(
+                stat.size_diff for stat in new.compare_to(old, "filename")
+            ),
+            "top": [
+                {
+                    "location": str(stat.traceback),
+                    "size_diff": stat.size_diff,
+                    "count_diff": stat.count_diff,
+                    "size": stat.size,
+                }
+                for stat in new.compare_to(old, "lineno")[:top]
+            ],
+        }
+
+    async def watch(self, site_store):
+        generation = None
+        while True:
+            snapshot = await site_store.wait_for_snapshot(generation)
+            if snapshot.generation != generation:
+                generation = snapshot.generation
+                await asyncio.to_thread(self.take, generation)
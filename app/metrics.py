@@ -0,0 +1,164 @@
+"""
+Prometheus metrics of the API
+
+The stores record their reloads, parsing of the site information and the
+calls to the Operations Portal, GOCDB and S3. Requests are measured by
+MetricsMiddleware and the state of the caches is collected when scraped.
+"""
+
+import time
+
+from prometheus_client import Counter, Histogram
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+from prometheus_client.registry import Collector
+from starlette.routing import Match
+
+RELOAD_DURATION = Histogram(
+    "cloud_info_reload_duration_seconds",
+    "Time to reload the site information",
+    ["store", "operation"],
+    buckets=(0.01, 0.05, 0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120),
+)
+SITE_PARSE_DURATION = Histogram(
+    "cloud_info_site_parse_duration_seconds",
+    "Time to read and parse the information of a site",
+    ["source"],
+    buckets=(0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5),
+)
+SITE_PARSE_FAILURES = Counter(
+    "cloud_info_site_parse_failures_total",
+    "Site information that could not be parsed",
+    ["source"],
+)
+UPSTREAM_DURATION = Histogram(
+    "cloud_info_upstream_request_duration_seconds",
+    "Time of the requests to upstream services",
+    ["service"],
+)
+UPSTREAM_ERRORS = Counter(
+    "cloud_info_upstream_errors_total",
+    "Failed requests to upstream services",
+    ["service"],
+)
+REQUEST_DURATION = Histogram(
+    "cloud_info_request_duration_seconds",
+    "Time to serve the HTTP requests",
+    ["method", "route", "status"],
+    buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10),
+)
+
+
+def find_route(scope, routes):
+    """Gets the route of a request, out of routes if it was not routed yet"""
+    route = scope.get("route")
+    if route is None:
+        for candidate in routes:
+            if candidate.matches(scope)[0] == Match.FULL:
+                return candidate
+    return route
+
+
+def route_path(scope, routes):
+    """Gets the path of the route of a request, e.g. /site/{site_name}/"""
+    return getattr(find_route(scope, routes), "path", "unmatched")
+
+
+class StateCollector(Collector):
+    """Collects the size of the published site information, the quarantined
+    sites and the counters of the response cache and admission control, when
+    scraped"""
+
+    def __init__(self, site_store, response_cache, admission):
+        self.site_store = site_store
+        self.response_cache = response_cache
+        self.admission = admission
+
+    def collect(self):
+        snapshot = self.site_store.snapshot()
+        yield GaugeMetricFamily(
+            "cloud_info_generation",
+            "Generation of the site information",
+            value=snapshot.generation,
+        )
+        counts = GaugeMetricFamily(
+            "cloud_info_objects",
+            "Objects in the published site information",
+            labels=["kind"],
+        )
+        for kind, value in zip(("sites", "shares", "images"), snapshot.counts()):
+            counts.add_metric([kind], value)
+        yield counts
+        yield GaugeMetricFamily(
+            "cloud_info_quarantined_sites",
+            "Site files or objects not parsed until they change",
+            value=len(self.site_store.quarantine.quarantined()),
+        )
+        cache = CounterMetricFamily(
+            "cloud_info_response_cache_requests",
+            "Lookups in the response cache",
+            labels=["route", "result"],
+        )
+        for result, counts in [
+            ("hit", self.response_cache.hits),
+            ("miss", self.response_cache.misses),
+            ("coalesced", self.response_cache.coalesced),
+        ]:
+            for route, value in sorted(counts.items()):
+                cache.add_metric([route, result], value)
+        yield cache
+        yield GaugeMetricFamily(
+            "cloud_info_response_cache_entries",
+            "Responses in the response cache",
+            value=len(self.response_cache),
+        )
+        yield GaugeMetricFamily(
+            "cloud_info_response_cache_bytes",
+            "Size of the cached responses, with their compressed variants",
+            value=self.response_cache.size,
+        )
+        admitted = CounterMetricFamily(
+            "cloud_info_admission_requests",
+            "Requests going through admission control",
+            labels=["result"],
+        )
+        admitted.add_metric(["admitted"], self.admission.admitted)
+        admitted.add_metric(["queued"], self.admission.queued)
+        admitted.add_metric(["rejected"], self.admission.rejected)
+        yield admitted
+        yield GaugeMetricFamily(
+            "cloud_info_active_requests",
+            "Requests being served within admission control",
+            value=self.admission.active,
+        )
+
+
+class MetricsMiddleware:
+    """Measures the HTTP requests, labelled by the path of the matching route
+    out of routes so that every site has the same label"""
+
+    def __init__(self, app, routes=()):
+        self.app = app
+        self.routes = routes
+
+    def _route(self, scope):
+        # not routed if served from the cache or rejected
+        return route_path(scope, self.routes)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        status = [500]
+
+        async def send_status(message):
+            if message["type"] == "http.response.start":
+                status[0] = message["status"]
+            await send(message)
+
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_status)
+        finally:
+            REQUEST_DURATION.labels(
+                scope["method"], self._route(scope), str(status[0])
+            ).observe(time.perf_counter() - start)
@@ -0,0 +1,185 @@
+"""
+Bounded parsing of the site information
+
+A SiteParser rejects the files that are too large, too slow to decode or that
+have too many GLUE objects, before building their site, so a single broken or
+pathological file can't stall or exhaust the memory of a reload. With
+workers, files are decoded in separate processes that are killed if they
+take too long. Otherwise they are decoded in the calling thread, where the
+time limit can only be checked once done.
+
+The Quarantine keeps the files that failed several times with the same
+content, so they are not parsed again until they change.
+"""
+
+import json
+import logging
+import multiprocessing
+import time
+
+from . import tracing
+
+
+class SiteFileError(ValueError):
+    """The site information is over the limits or not valid JSON"""
+
+
+def _check_size(size, max_size):
+    if max_size and size > max_size:
+        raise SiteFileError(f"Size over the limit of {max_size} bytes")
+
+
+def _decode(content, max_size=0, max_objects=0):
+    _check_size(len(content), max_size)
+    try:
+        info = json.loads(content)
+    except (ValueError, RecursionError) as e:
+        # not the JSONDecodeError, it has a copy of the whole document
+        raise SiteFileError(f"Invalid JSON: {e}") from None
+    if not isinstance(info, dict):
+        raise SiteFileError("Site information is not a JSON object")
+    objects = sum(len(value) for value in info.values() if isinstance(value, list))
+    if max_objects and objects > max_objects:
+        raise SiteFileError(f"{objects} GLUE objects, over the limit of {max_objects}")
+    return info
+
+
+def _read(path, max_size=0):
+    # bytes, as the limit is in bytes, decoded as JSON by _decode
+    with open(path, "rb") as f:
+        # one more than allowed to know if it's over the limit
+        return f.read(max_size + 1) if max_size else f.read()
+
+
+def _read_file(path, max_size, max_objects):
+    """Reads and decodes a file in a worker process"""
+    return _decode(_read(path, max_size), max_size, max_objects)
+
+
+class SiteParser:
+    """
+    Decodes site information of at most max_size bytes, max_objects GLUE
+    objects and taking at most timeout seconds (0 for no limit). Files are
+    decoded in workers processes if any
+    """
+
+    def __init__(self, max_size=0, max_objects=0, timeout=0, workers=0):
+        self.max_size = max_size
+        self.max_objects = max_objects
+        self.timeout = timeout
+        self.workers = workers
+        self._pool = None
+
+    def check_size(self, size):
+        _check_size(size, self.max_size)
+
+    def decode(self, content):
+        """Decodes the content in the calling thread"""
+        start = time.perf_counter()
+        info = _decode(content, self.max_size, self.max_objects)
+        elapsed = time.perf_counter() - start
+        if self.timeout and elapsed > self.timeout:
+            raise SiteFileError(
+                f"Took {elapsed:.1f} s to decode, over the limit of {self.timeout} s"
+            )
+        return info
+
+    def read_file(self, path):
+        """Reads and decodes a file in the calling thread"""
+        with tracing.phase("read"):
+            content = _read(path, self.max_size)
+        with tracing.phase("decode"):
+            return self.decode(content)
+
+    def _get_pool(self):
+        if self._pool is None:
+            # not forked, the parent has threads running
+            context = multiprocessing.get_context("spawn")
+            self._pool = context.Pool(self.workers)
+        return self._pool
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.terminate()
+            self._pool = None
+
+    def read_files(self, paths):
+        """
+        Reads and decodes the files in the worker processes, returns the
+        information in every path or the exception raised reading it. When a
+        file takes longer than timeout the workers are killed, and the files
+        not done yet are sent to new ones
+        """
+        results = {}
+        pending = list(paths)
+        while pending:
+            pool = self._get_pool()
+            submitted = [
+                (
+                    path,
+                    pool.apply_async(
+                        _read_file, (path, self.max_size, self.max_objects)
+                    ),
+                )
+                for path in pending
+            ]
+            pending = []
+            # files are started in order, so by the time a file is waited
+            # for it is already running in a worker
+            for i, (path, result) in enumerate(submitted):
+                try:
+                    results[path] = result.get(self.timeout or None)
+                except multiprocessing.TimeoutError:
+                    results[path] = SiteFileError(
+                        f"Took over the limit of {self.timeout} s to parse"
+                    )
+                    for other, other_result in submitted[i + 1 :]:
+                        if other_result.ready():
+                            results[other] = self._result(other_result)
+                        else:
+                            pending.append(other)
+                    self.close()
+                    break
+                except Exception as e:
+                    results[path] = e
+        return results
+
+    def _result(self, result):
+        try:
+            return result.get()
+        except Exception as e:
+            return e
+
+
+class Quarantine:
+    """
+    Keeps track of the failures of every file, or object, and quarantines
+    those that failed after times with the same version, e.g. modification
+    time, until their version changes. Never quarantines if after is 0
+    """
+
+    def __init__(self, after=2):
+        self.after = after
+        # key: (version, consecutive failures with that version)
+        self._failures = {}
+
+    def holds(self, key, version):
+        failed_version, failures = self._failures.get(key, (None, 0))
+        return bool(self.after) and failed_version == version and failures >= self.after
+
+    def failed(self, key, version):
+        failed_version, failures = self._failures.get(key, (None, 0))
+        failures = failures + 1 if failed_version == version else 1
+        self._failures[key] = (version, failures)
+        if failures == self.after:
+            logging.warning(f"Quarantined {key} after {failures} failures")
+
+    def release(self, key):
+        self._failures.pop(key, None)
+
+    def quarantined(self):
+        return sorted(
+            key
+            for key, (_, failures) in self._failures.items()
+            if self.after and failures >= self.after
+        )
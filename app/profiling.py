@@ -0,0 +1,268 @@
+"""
+On-demand profiling of requests and reloads
+
+A Profiler records a sample of the requests, or those with the profiling
+header, and of the reloads of the stores. By default the stacks of every
+busy thread are sampled by a background thread and written as collapsed
+stacks, ready for flamegraph.pl or speedscope. cProfile output is also
+available for requests, but it only sees the thread it's started in, i.e.
+the event loop. Next to every profile a JSON file has the route, parameters,
+generation and duration.
+
+Only one profile runs at a time, others are skipped, and only the latest
+max_files profiles are kept, so the overhead stays bounded even if switched
+on for a share of the traffic. Profiles are written by a background thread,
+not to block the event loop.
+"""
+
+import contextlib
+import cProfile
+import glob
+import itertools
+import json
+import logging
+import marshal
+import os
+import random
+import re
+import secrets
+import sys
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+from starlette.datastructures import Headers, MutableHeaders
+
+HEADER = "X-Profile"
+FORMATS = {"collapsed": "collapsed", "cprofile": "prof"}
+# innermost frames of threads waiting for work, not worth sampling
+IDLE_FRAMES = {
+    ("threading.py", "wait"),
+    ("selectors.py", "select"),
+    ("queue.py", "get"),
+    ("thread.py", "_worker"),
+}
+# a single thread shared by all the profilers, so the oldest profiles are
+# removed in order and it is not started or stopped while profiling
+_writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="profile-writer")
+
+
+def _frame_name(code):
+    path = os.path.join(*code.co_filename.split(os.sep)[-2:])
+    return f"{code.co_qualname} ({path}:{code.co_firstlineno})"
+
+
+class StackSampler(threading.Thread):
+    """Counts the stacks of the busy threads every interval seconds, for at
+    most max_duration seconds"""
+
+    def __init__(self, interval=0.005, max_duration=60):
+        super().__init__(name="profiler", daemon=True)
+        self.interval = interval
+        self.max_duration = max_duration
+        self.stacks = Counter()
+        self.samples = 0
+        self._done = threading.Event()
+
+    def _sample(self):
+        names = {t.ident: t.name for t in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():
+            code = frame.f_code
+            if ident == self.ident or (
+                (os.path.basename(code.co_filename), code.co_name) in IDLE_FRAMES
+            ):
+                continue
+            stack = []
+            while frame is not None:
+                stack.append(_frame_name(frame.f_code))
+                frame = frame.f_back
+            stack.append(names.get(ident, str(ident)))
+            self.stacks[";".join(reversed(stack))] += 1
+        self.samples += 1
+
+    def run(self):
+        deadline = time.monotonic() + self.max_duration
+        while not self._done.wait(self.interval) and time.monotonic() < deadline:
+            self._sample()
+
+    def stop(self):
+        self._done.set()
+        self.join()
+
+    def collapsed(self):
+        return "".join(f"{stack} {count}\n" for stack, count in self.stacks.items())
+
+
+class Profiler:
+    """
+    Profiles a share of the requests (sample_rate) and of the reloads
+    (reload_sample_rate), writing the profiles to directory. Profiling is
+    disabled without a directory. Requests with token in the profiling header
+    are always profiled if nothing else is. generation is a callable getting
+    the generation of the data to attach to the profiles
+    """
+
+    def __init__(
+        self,
+        directory="",
+        sample_rate=0,
+        reload_sample_rate=0,
+        token="",
+        output_format="collapsed",
+        interval=0.005,
+        max_duration=60,
+        max_files=100,
+        generation=None,
+    ):
+        if output_format not in FORMATS:
+            raise ValueError(f"Unknown profile format {output_format}")
+        self.directory = directory
+        self.sample_rates = {"request": sample_rate, "reload": reload_sample_rate}
+        self.token = token
+        self.output_format = output_format
+        self.interval = interval
+        self.max_duration = max_duration
+        self.max_files = max_files
+        self.generation = generation
+        self.profiles = 0
+        self.skipped = 0
+        self._lock = threading.Lock()
+        self._seq = itertools.count()
+        self._random = random.Random()
+
+    def authorized(self, value):
+        return bool(self.token) and secrets.compare_digest(value, self.token)
+
+    def requested(self, headers, header=HEADER):
+        """Whether the request asks to be profiled with the token in header"""
+        return bool(self.directory) and self.authorized(headers.get(header, ""))
+
+    def _wanted(self, kind, force):
+        if not self.directory:
+            return False
+        rate = self.sample_rates.get(kind, 0)
+        return force or (rate > 0 and self._random.random() < rate)
+
+    def flush(self):
+        """Waits for the profiles being written"""
+        _writer.submit(lambda: None).result()
+
+    def _save(self, info, profile):
+        try:
+            if info["format"] == "cprofile":
+                # same format as dump_stats, readable with pstats
+                content = marshal.dumps(profile.stats)
+            else:
+                info["samples"] = profile.samples
+                content = profile.collapsed()
+            self._write(info, content)
+            self.profiles += 1
+        except OSError as e:
+            logging.error(f"Unable to write profile {info['id']}: {e}")
+
+    def _write(self, info, content):
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, info["id"])
+        mode = "wb" if isinstance(content, bytes) else "w"
+        with open(f"{path}.{FORMATS[info['format']]}", mode) as f:
+            f.write(content)
+        with open(f"{path}.json", "w") as f:
+            json.dump(info, f, indent=2)
+        # keep only the newest profiles
+        for old in sorted(glob.glob(os.path.join(self.directory, "*.json")))[
+            : -self.max_files
+        ]:
+            for old_path in glob.glob(f"{old.removesuffix('.json')}.*"):
+                os.remove(old_path)
+
+    @contextlib.contextmanager
+    def profile(self, kind, name, force=False, output_format=None, **metadata):
+        """Profiles the block if it is sampled, yielding the information to
+        be written with the profile, or None if it's not profiled"""
+        if not self._wanted(kind, force):
+            yield None
+            return
+        if not self._lock.acquire(blocking=False):
+            self.skipped += 1
+            yield None
+            return
+        try:
+            output_format = output_format or self.output_format
+            slug = re.sub(r"[^A-Za-z0-9]+", "_", name).strip("_")
+            info = dict(
+                id=f"{time.strftime('%Y%m%dT%H%M%S')}-{next(self._seq):06}-"
+                f"{kind}-{slug}",
+                kind=kind,
+                name=name,
+                format=output_format,
+                started=time.time(),
+                **metadata,
+            )
+            start = time.perf_counter()
+            if output_format == "cprofile":
+                profile = cProfile.Profile()
+                profile.enable()
+            else:
+                profile = StackSampler(self.interval, self.max_duration)
+                profile.start()
+            try:
+                yield info
+            finally:
+                if output_format == "cprofile":
+                    # disables it and takes the stats before writing them
+                    profile.create_stats()
+                else:
+                    profile.stop()
+                info["duration"] = time.perf_counter() - start
+                if self.generation:
+                    info["generation"] = self.generation()
+                _writer.submit(self._save, info, profile)
+        finally:
+            self._lock.release()
+
+
+class ProfilingMiddleware:
+    """
+    Profiles the HTTP requests as sampled by profiler, or those with its
+    token in the header. Profiled responses have the id of the profile in
+    the X-Profile-Id header. Paths starting with any of the exempt prefixes,
+    e.g. streams, are never profiled
+    """
+
+    def __init__(self, app, profiler, header=HEADER, exempt=()):
+        self.app = app
+        self.profiler = profiler
+        self.header = header
+        self.exempt = tuple(exempt)
+
+    async def __call__(self, scope, receive, send):
+        if (
+            scope["type"] != "http"
+            or not self.profiler.directory
+            or scope["path"].startswith(self.exempt)
+        ):
+            await self.app(scope, receive, send)
+            return
+        force = self.profiler.requested(Headers(scope=scope), self.header)
+        with self.profiler.profile(
+            "request",
+            scope["path"],
+            force=force,
+            method=scope["method"],
+            path=scope["path"],
+            query=scope["query_string"].decode("latin-1"),
+        ) as info:
+            if info is None:
+                await self.app(scope, receive, send)
+                return
+
+            async def send_with_id(message):
+                if message["type"] == "http.response.start":
+                    info["status"] = message["status"]
+                    MutableHeaders(scope=message)["X-Profile-Id"] = info["id"]
+                await send(message)
+
+            await self.app(scope, receive, send_with_id)
+            info["route"] = getattr(scope.get("route"), "path", None)
+            info["path_params"] = scope.get("path_params", {})
@@ -0,0 +1,462 @@
+"""
+Site information kept in a SQLite database
+
+A writer loads the site files as the FileSiteStore does and saves every new
+generation as a database that atomically replaces the previous one. Readers
+(e.g. the workers of the API) only open that database, so they share the
+on-disk copy instead of keeping all the sites in memory.
+"""
+
+import asyncio
+import logging
+import os
+import sqlite3
+import sys
+import threading
+from collections import OrderedDict
+
+from . import tracing
+from .glue import (
+    FileSiteStore,
+    GlueImage,
+    GlueInstanceType,
+    GlueShare,
+    GlueSite,
+    SiteChanges,
+    SiteSnapshot,
+    diff_sites,
+)
+from .memory import MemoryCounter, live_snapshots
+
+SITE_COLUMNS = ("name", "url", "hostname", "gocdb_id")
+SHARE_COLUMNS = ("name", "vo", "project_id")
+IMAGE_COLUMNS = tuple(GlueImage.model_fields)
+INSTANCETYPE_COLUMNS = tuple(GlueInstanceType.model_fields)
+
+SCHEMA = f"""
+CREATE TABLE meta (key TEXT PRIMARY KEY, value);
+CREATE TABLE changes (generation INTEGER PRIMARY KEY, changes TEXT);
+CREATE TABLE sites (pk INTEGER PRIMARY KEY, {", ".join(SITE_COLUMNS)});
+CREATE TABLE shares (
+    pk INTEGER PRIMARY KEY, site_pk INTEGER, {", ".join(SHARE_COLUMNS)}
+);
+CREATE TABLE images (
+    pk INTEGER PRIMARY KEY, share_pk INTEGER, {", ".join(IMAGE_COLUMNS)}
+);
+CREATE TABLE instancetypes (
+    pk INTEGER PRIMARY KEY, share_pk INTEGER, {", ".join(INSTANCETYPE_COLUMNS)}
+);
+CREATE INDEX sites_name ON sites (name);
+CREATE INDEX sites_gocdb_id ON sites (gocdb_id);
+CREATE INDEX shares_site ON shares (site_pk);
+CREATE INDEX shares_vo ON shares (vo, site_pk);
+CREATE INDEX images_share ON images (share_pk);
+CREATE INDEX images_egi_id ON images (egi_id);
+CREATE INDEX instancetypes_share ON instancetypes (share_pk);
+"""
+
+
+def _insert(db, table, columns, values):
+    placeholders = ", ".join("?" * len(columns))
+    db.execute(
+        f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({placeholders})",
+        values,
+    )
+    return db.execute("SELECT last_insert_rowid()").fetchone()[0]
+
+
+def write_sites_db(path, sites, generation, changes=()):
+    """Saves the sites and the latest changes in a new database that replaces
+    the one at path"""
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    db = sqlite3.connect(tmp_path)
+    try:
+        db.execute("PRAGMA journal_mode = OFF")
+        db.executescript(SCHEMA)
+        db.execute("INSERT INTO meta VALUES ('generation', ?)", (generation,))
+        db.executemany(
+            "INSERT INTO changes VALUES (?, ?)",
+            [(c.generation, c.model_dump_json()) for c in changes],
+        )
+        for site in sites:
+            site_pk = _insert(
+                db, "sites", SITE_COLUMNS, [getattr(site, c) for c in SITE_COLUMNS]
+            )
+            for share in site.shares:
+                share_pk = _insert(
+                    db,
+                    "shares",
+                    ("site_pk",) + SHARE_COLUMNS,
+                    [site_pk] + [getattr(share, c) for c in SHARE_COLUMNS],
+                )
+                db.executemany(
+                    f"INSERT INTO images (share_pk, {', '.join(IMAGE_COLUMNS)}) "
+                    f"VALUES (?, {', '.join('?' * len(IMAGE_COLUMNS))})",
+                    [
+                        [share_pk] + [getattr(image, c) for c in IMAGE_COLUMNS]
+                        for image in share.images
+                    ],
+                )
+                db.executemany(
+                    "INSERT INTO instancetypes "
+                    f"(share_pk, {', '.join(INSTANCETYPE_COLUMNS)}) "
+                    f"VALUES (?, {', '.join('?' * len(INSTANCETYPE_COLUMNS))})",
+                    [
+                        [share_pk] + [getattr(it, c) for c in INSTANCETYPE_COLUMNS]
+                        for it in share.instancetypes
+                    ],
+                )
+        db.commit()
+    finally:
+        db.close()
+    os.replace(tmp_path, path)
+
+
+def _estimated_size(value, samples=16):
+    """Estimates the memory used by derived data, only measuring some of the
+    items of large lists"""
+    if isinstance(value, (list, tuple)):
+        items = value
+        if len(value) > samples:
+            step = len(value) / samples
+            items = [value[int(i * step)] for i in range(samples)]
+        measured = sum(_estimated_size(item, samples) for item in items)
+        return sys.getsizeof(value) + measured * len(value) // max(len(items), 1)
+    return MemoryCounter().measure(value, "cache")
+
+
+def _columns(table, columns):
+    return ", ".join(f"{table}.{c}" for c in columns)
+
+
+class SQLiteSnapshot(SiteSnapshot):
+    """
+    Snapshot answering the queries from a database written by
+    write_sites_db, only the most recently used derived data is kept in
+    memory, up to about cache_bytes
+    """
+
+    # derived data may be evicted soon after built, so it's not built for
+    # every VO in advance
+    warm_every_vo = False
+
+    def __init__(self, path, source=None, cache_bytes=64 * 2**20):
+        # the database is never modified once written, so this connection
+        # keeps reading the same generation even if a newer one replaces it
+        self._db = sqlite3.connect(
+            f"file:{path}?mode=ro", uri=True, check_same_thread=False
+        )
+        self._db.row_factory = sqlite3.Row
+        self._lock = threading.Lock()
+        self.source = source
+        self.generation = self._query(
+            "SELECT value FROM meta WHERE key = 'generation'"
+        )[0]["value"]
+        self.cache_bytes = cache_bytes
+        # key: (value, estimated size)
+        self._cache = OrderedDict()
+        self._cache_used = 0
+        # routes reading the snapshot run in several threads
+        self._cache_lock = threading.Lock()
+        live_snapshots.add(self)
+
+    def _query(self, sql, params=()):
+        with self._lock:
+            return self._db.execute(sql, params).fetchall()
+
+    def _load_sites(self, where="", params=(), details=True):
+        """Gets the sites selected by the where clause, without details their
+        shares have no images and instance types"""
+        site_pks = f"SELECT pk FROM sites {where}"
+        share_pks = f"SELECT pk FROM shares WHERE site_pk IN ({site_pks})"
+        shares = {}
+        for row in self._query(
+            f"SELECT * FROM shares WHERE site_pk IN ({site_pks}) ORDER BY pk", params
+        ):
+            shares[row["pk"]] = (
+                row["site_pk"],
+                GlueShare.model_construct(
+                    **{c: row[c] for c in SHARE_COLUMNS}, images=[], instancetypes=[]
+                ),
+            )
+        if details:
+            self._load_share_details(shares, share_pks, params)
+        sites = {
+            row["pk"]: GlueSite.model_construct(
+                **{c: row[c] for c in SITE_COLUMNS}, shares=[]
+            )
+            for row in self._query(f"SELECT * FROM sites {where} ORDER BY pk", params)
+        }
+        for site_pk, share in shares.values():
+            sites[site_pk].shares.append(share)
+        return list(sites.values())
+
+    def _load_share_details(self, shares, share_pks, params):
+        """Adds the images and instance types to the (site_pk, share) values
+        of shares, share_pks is the query of their keys"""
+        for row in self._query(
+            f"SELECT * FROM images WHERE share_pk IN ({share_pks}) ORDER BY pk", params
+        ):
+            image = GlueImage.model_construct(**{c: row[c] for c in IMAGE_COLUMNS})
+            shares[row["share_pk"]][1].images.append(image)
+        for row in self._query(
+            f"SELECT * FROM instancetypes WHERE share_pk IN ({share_pks}) "
+            "ORDER BY pk",
+            params,
+        ):
+            instancetype = GlueInstanceType.model_construct(
+                **{c: row[c] for c in INSTANCETYPE_COLUMNS}
+            )
+            shares[row["share_pk"]][1].instancetypes.append(instancetype)
+
+    @property
+    def sites(self):
+        return self.get_sites()
+
+    def get_sites(self, vo_name=None, details=True):
+        if vo_name:
+            where, params = (
+                "WHERE pk IN (SELECT site_pk FROM shares WHERE vo = ?)",
+                (vo_name,),
+            )
+        else:
+            where, params = "", ()
+        return self.cached(
+            ("sites", vo_name or None, details),
+            lambda: self._load_sites(where, params, details),
+            vo_name,
+        )
+
+    def get_site_by_name(self, name):
+        return self.cached(("site_by_name", name), lambda: self._load_site(name))
+
+    def _load_site(self, name):
+        sites = self._load_sites(
+            "WHERE pk = (SELECT min(pk) FROM sites WHERE name = ?)", (name,)
+        )
+        return sites[0] if sites else None
+
+    def get_site_by_goc_id(self, gocdb_id):
+        sites = self._load_sites(
+            "WHERE pk = (SELECT min(pk) FROM sites WHERE gocdb_id = ?)", (gocdb_id,)
+        )
+        return sites[0] if sites else None
+
+    def get_change_history(self):
+        rows = self._query("SELECT changes FROM changes ORDER BY generation")
+        return [SiteChanges.model_validate_json(row["changes"]) for row in rows]
+
+    def counts(self):
+        return self.cached(
+            "counts",
+            lambda: tuple(
+                self._query(f"SELECT count(*) AS n FROM {table}")[0]["n"]
+                for table in ("sites", "shares", "images")
+            ),
+        )
+
+    def vo_names(self):
+        rows = self._query("SELECT vo FROM shares GROUP BY vo ORDER BY min(pk)")
+        return [row["vo"] for row in rows]
+
+    def has_vo(self, vo_name):
+        return not vo_name or vo_name in self.cached(
+            "vo_name_set", lambda: set(self.vo_names())
+        )
+
+    def cached(self, key, build, vo_name=None):
+        """Gets data derived from this snapshot, building it again if it was
+        evicted from the cache"""
+        if not self.has_vo(vo_name):
+            return build()
+        with self._cache_lock:
+            if key in self._cache:
+                self._cache.move_to_end(key)
+                return self._cache[key][0]
+        # built out of the lock, the same data may be built twice at once
+        value = build()
+        size = _estimated_size(value)
+        with self._cache_lock:
+            if key not in self._cache:
+                self._cache[key] = (value, size)
+                self._cache_used += size
+            # the least recently used go first, the new value always stays
+            while self._cache_used > self.cache_bytes and len(self._cache) > 1:
+                _, (_, evicted_size) = self._cache.popitem(last=False)
+                self._cache_used -= evicted_size
+        return value
+
+    def cached_items(self):
+        with self._cache_lock:
+            return [(key, value) for key, (value, _) in self._cache.items()]
+
+    def _summary_sites(self, rows):
+        """Creates the sites of the rows, without their shares"""
+        sites = {}
+        for row in rows:
+            if row["site_pk"] not in sites:
+                sites[row["site_pk"]] = GlueSite.model_construct(
+                    **{c: row[f"site_{c}"] for c in SITE_COLUMNS}, shares=[]
+                )
+        return sites
+
+    def _build_images(self, vo_name, only_egi_images):
+        vo_name = vo_name or None
+        rows = self._query(
+            f"SELECT sites.pk AS site_pk, "
+            f"{', '.join(f'sites.{c} AS site_{c}' for c in SITE_COLUMNS)}, "
+            f"{_columns('images', IMAGE_COLUMNS)} "
+            "FROM images JOIN shares ON images.share_pk = shares.pk "
+            "JOIN sites ON shares.site_pk = sites.pk "
+            "WHERE (? IS NULL OR shares.vo = ?) AND (NOT ? OR images.egi_id != '') "
+            "ORDER BY images.pk",
+            (vo_name, vo_name, only_egi_images),
+        )
+        sites = self._summary_sites(rows)
+        return [
+            (
+                sites[row["site_pk"]],
+                GlueImage.model_construct(**{c: row[c] for c in IMAGE_COLUMNS}),
+            )
+            for row in rows
+        ]
+
+    def _build_flavors(self, vo_name, accelerated):
+        vo_name = vo_name or None
+        rows = self._query(
+            f"SELECT sites.pk AS site_pk, "
+            f"{', '.join(f'sites.{c} AS site_{c}' for c in SITE_COLUMNS)}, "
+            f"{', '.join(f'shares.{c} AS share_{c}' for c in SHARE_COLUMNS)}, "
+            f"{_columns('instancetypes', INSTANCETYPE_COLUMNS)} "
+            "FROM instancetypes JOIN shares ON instancetypes.share_pk = shares.pk "
+            "JOIN sites ON shares.site_pk = sites.pk "
+            "WHERE (? IS NULL OR shares.vo = ?) "
+            "AND (NOT ? OR instancetypes.accelerator_count != 0) "
+            "ORDER BY instancetypes.cpu, instancetypes.ram, instancetypes.disk, "
+            "instancetypes.pk",
+            (vo_name, vo_name, accelerated),
+        )
+        sites = self._summary_sites(rows)
+        flavors = [
+            (
+                sites[row["site_pk"]],
+                GlueShare.model_construct(
+                    **{c: row[f"share_{c}"] for c in SHARE_COLUMNS},
+                    images=[],
+                    instancetypes=[],
+                ),
+                GlueInstanceType.model_construct(
+                    **{c: row[c] for c in INSTANCETYPE_COLUMNS}
+                ),
+            )
+            for row in rows
+        ]
+        return [f[2].cpu for f in flavors], flavors
+
+    def warm(self):
+        # derived data is built on demand to keep the memory bounded
+        return
+
+
+class SQLiteSiteStore(FileSiteStore):
+    """
+    Keeps the sites in the SQLite database at sqlite_db. If sqlite_readonly
+    is set, the database is only read and checked for new generations every
+    sqlite_poll_period seconds, otherwise it's written from the site files
+    """
+
+    def __init__(
+        self,
+        sqlite_db="",
+        sqlite_readonly=False,
+        sqlite_cache_bytes=64 * 2**20,
+        sqlite_poll_period=5,
+        **kwargs,
+    ):
+        super().__init__(**kwargs)
+        self.sqlite_db = sqlite_db
+        self.sqlite_readonly = sqlite_readonly
+        self.sqlite_cache_bytes = sqlite_cache_bytes
+        self.sqlite_poll_period = sqlite_poll_period
+        self._db_stat = None
+
+    def _stat_db(self):
+        try:
+            st = os.stat(self.sqlite_db)
+            return st.st_ino, st.st_mtime_ns
+        except OSError:
+            return None
+
+    def _open_db(self):
+        if not os.path.exists(self.sqlite_db):
+            return None
+        snapshot = self._open_snapshot()
+        if not self.sqlite_readonly:
+            # the following changes are computed against these sites
+            snapshot.source = snapshot.get_sites()
+        return snapshot
+
+    async def _load_db(self):
+        """Serves what was already in the database until there is something
+        newer"""
+        snapshot = await asyncio.to_thread(self._open_db)
+        if snapshot:
+            with self._swap_lock:
+                if not self.sqlite_readonly:
+                    self._set_sites(snapshot.source)
+                self._set_snapshot(snapshot)
+
+    def _open_snapshot(self, source=None):
+        self._db_stat = self._stat_db()
+        return SQLiteSnapshot(
+            self.sqlite_db, source or object(), self.sqlite_cache_bytes
+        )
+
+    def _sites(self):
+        if self.sqlite_readonly:
+            return self._snapshot.source
+        return super()._sites()
+
+    def _set_snapshot(self, snapshot, changes=None):
+        if not isinstance(snapshot, SQLiteSnapshot):
+            super()._set_snapshot(snapshot, changes)
+            return
+        # the latest changes are in the database, shared by all its readers
+        self._snapshot = snapshot
+        self.changes.clear()
+        self.changes.extend(snapshot.get_change_history())
+        self._notify_snapshot()
+
+    def _prepare_snapshot(self, current, sites):
+        if self.sqlite_readonly:
+            if self._stat_db() in (None, self._db_stat):
+                return None
+            snapshot = self._open_snapshot()
+            if snapshot.generation == current.generation:
+                return None
+        else:
+            generation = current.generation + 1
+            with tracing.phase("diff"):
+                changes = [*self.changes, diff_sites(current.source, sites, generation)]
+            with tracing.phase("write_db"):
+                write_sites_db(
+                    self.sqlite_db, sites, generation, changes[-self.changes.maxlen :]
+                )
+            snapshot = self._open_snapshot(sites)
+        with tracing.phase("warm"):
+            self.warm_snapshot(snapshot)
+        return snapshot, None
+
+    async def start(self):
+        await self._load_db()
+        if not self.sqlite_readonly:
+            await super().start()
+            return
+        while True:
+            try:
+                await self._publish(None)
+            except Exception as e:
+                logging.error(f"Unable to load sites from {self.sqlite_db}: {e}")
+            await asyncio.sleep(self.sqlite_poll_period)
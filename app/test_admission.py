@@ -0,0 +1,103 @@
+"""Testing the admission control"""
+
+import asyncio
+
+import pytest
+from starlette.applications import Starlette
+from starlette.responses import JSONResponse
+from starlette.routing import Route
+from starlette.testclient import TestClient
+
+from . import admission
+
+
+def test_admission_controller_queue():
+    controller = admission.AdmissionController(
+        limit=2, queue_size=2, classes={"slow": (1, 1)}
+    )
+    started = []
+
+    async def request(name, cls=None):
+        await controller.acquire(cls)
+        started.append(name)
+
+    async def run():
+        await request("a", "slow")
+        # class limit reached
+        slow = asyncio.create_task(request("b", "slow"))
+        await request("c")
+        other = asyncio.create_task(request("d"))
+        await asyncio.sleep(0)
+        assert started == ["a", "c"]
+        assert controller.queued == 2
+        # higher priority goes first, even if it arrived later
+        controller.release()
+        await other
+        assert started == ["a", "c", "d"]
+        controller.release("slow")
+        await slow
+        assert started == ["a", "c", "d", "b"]
+        assert controller.active == 2
+
+    asyncio.run(run())
+
+
+def test_admission_controller_rejects():
+    controller = admission.AdmissionController(
+        limit=1, queue_size=1, classes={"slow": (1, None)}
+    )
+
+    async def run():
+        await controller.acquire()
+        slow = asyncio.create_task(controller.acquire("slow"))
+        await asyncio.sleep(0)
+        # the queue is full, the slow request makes room for this one
+        waiting = asyncio.create_task(controller.acquire())
+        await asyncio.sleep(0)
+        with pytest.raises(admission.Overloaded):
+            await slow
+        # nothing with lower priority to drop
+        with pytest.raises(admission.Overloaded):
+            await controller.acquire("slow")
+        controller.release()
+        await waiting
+        assert controller.rejected == 2
+
+    asyncio.run(run())
+
+
+def test_admission_controller_timeout():
+    controller = admission.AdmissionController(limit=1, queue_size=1, timeout=0.01)
+
+    async def run():
+        await controller.acquire()
+        with pytest.raises(admission.Overloaded):
+            await controller.acquire()
+        assert controller._waiters == []
+        controller.release()
+        assert controller.active == 0
+
+    asyncio.run(run())
+
+
+def test_admission_middleware():
+    controller = admission.AdmissionController(limit=0)
+
+    def endpoint(request):
+        return JSONResponse("ok")
+
+    app = Starlette(routes=[Route("/", endpoint), Route("/health", endpoint)])
+    app.add_middleware(
+        admission.AdmissionMiddleware,
+        controller=controller,
+        exempt=["/health"],
+        retry_after=3,
+    )
+    client = TestClient(app)
+    response = client.get("/")
+    assert response.status_code == 503
+    assert response.headers["retry-after"] == "3"
+    assert client.get("/health").json() == "ok"
+    controller.limit = 1
+    assert client.get("/").json() == "ok"
+    assert controller.active == 0
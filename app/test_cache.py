@@ -0,0 +1,345 @@
+"""Testing the response cache"""
+
+import asyncio
+import contextlib
+import gzip
+import os
+from unittest import mock
+
+import pytest
+from fastapi import Depends, FastAPI, Header
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import JSONResponse
+from starlette.routing import Route
+from starlette.testclient import TestClient
+
+from . import cache
+
+
+@pytest.mark.parametrize(
+    "accept_encoding,expected",
+    [
+        ("", None),
+        ("gzip", "gzip"),
+        ("gzip, deflate, br", "br"),
+        ("br;q=0.5, gzip", "gzip"),
+        ("br;q=0, gzip;q=0", None),
+        ("*", "br"),
+        ("identity", None),
+    ],
+)
+def test_select_encoding(accept_encoding, expected):
+    assert cache.select_encoding(accept_encoding, ["br", "gzip"]) == expected
+
+
+@pytest.mark.parametrize(
+    "query_string,names,expected",
+    [
+        (b"x=1&a=2", None, b"x=1&a=2"),
+        (b"x=1&a=2", {"a"}, b"a=2"),
+        (b"b=1&a=2&b=0", {"a", "b"}, b"a=2&b=1&b=0"),
+        (b"a=%C3%A9&a=", {"a"}, b"a=%C3%A9&a="),
+        (b"x=1", set(), b""),
+    ],
+)
+def test_normalize_query(query_string, names, expected):
+    assert cache.normalize_query(query_string, names) == expected
+
+
+def test_query_params():
+    app = FastAPI()
+
+    def page(limit: int = 0):
+        return limit
+
+    @app.get("/items/")
+    def items(vo: str = "", page: int = Depends(page)):
+        return []
+
+    assert cache.query_params(app.router.routes[-1]) == {"vo", "limit"}
+    assert cache.query_params(Route("/", lambda request: None)) is None
+
+
+def test_cached_response_encode():
+    entry = cache.CachedResponse(200, [(b"content-length", b"3000")], b"foo" * 1000)
+    assert entry.headers == []
+
+    async def requests():
+        return await asyncio.gather(entry.encode("gzip"), entry.encode("gzip"))
+
+    with mock.patch("app.cache.compress", wraps=cache.compress) as m_compress:
+        (_, first), (_, second) = asyncio.run(requests())
+        assert first is second
+        assert gzip.decompress(first) == entry.body
+        assert asyncio.run(entry.encode("gzip"))[1] is first
+        assert m_compress.call_count == 1
+    assert entry.size == len(entry.body) + len(first)
+    assert asyncio.run(entry.encode("gzip", min_size=10000)) == (None, entry.body)
+
+
+def _entry(body):
+    return cache.CachedResponse(200, [], body)
+
+
+def test_response_cache_generations():
+    response_cache = cache.ResponseCache(max_bytes=20)
+    assert response_cache.get(1, "a") is None
+    a, b, c = _entry(b"a" * 10), _entry(b"b" * 10), _entry(b"c" * 10)
+    response_cache.put(1, "a", a)
+    response_cache.put(1, "b", b)
+    response_cache.put(1, "c", c)
+    assert len(response_cache) == 2
+    assert response_cache.size == 20
+    assert response_cache.get(1, "a") is None
+    assert response_cache.get(1, "c") is c
+    # old generations are ignored
+    response_cache.put(0, "d", _entry(b"d"))
+    assert response_cache.get(1, "d") is None
+    # new generation drops everything
+    assert response_cache.get(2, "c") is None
+    assert response_cache.size == 0
+    assert response_cache.hits[""] == 1
+    assert response_cache.misses[""] == 4
+
+
+def test_response_cache_size():
+    response_cache = cache.ResponseCache(max_bytes=150)
+    response_cache.get(1, "a")
+    # too large on its own
+    response_cache.put(1, "a", _entry(b"a" * 151))
+    assert len(response_cache) == 0
+    # random bodies grow when compressed
+    a, b = _entry(os.urandom(40)), _entry(os.urandom(40))
+    response_cache.put(1, "a", a)
+    response_cache.put(1, "b", b)
+    assert response_cache.size == 80
+    # compressed variants count
+    asyncio.run(b.encode("gzip"))
+    response_cache.resize("b", b)
+    assert response_cache.size == a.size + b.size > 80
+    # and drop the oldest entries when over the limit
+    asyncio.run(a.encode("gzip"))
+    response_cache.resize("a", a)
+    assert response_cache.entries() == [b]
+    assert response_cache.size == b.size
+    # entries not in the cache are not counted
+    response_cache.resize("a", a)
+    assert response_cache.size == b.size
+    # replacing an entry counts only the new one
+    response_cache.put(1, "b", _entry(b"b" * 10))
+    assert response_cache.size == 10
+    response_cache.clear()
+    assert response_cache.size == 0
+
+
+def test_response_cache_namespaces():
+    response_cache = cache.ResponseCache()
+    a, v = _entry(b"a"), _entry(b"v")
+    response_cache.get(1, "a", "sites")
+    response_cache.put(1, "a", a, "sites")
+    response_cache.get(5, "a", "vos")
+    response_cache.put(5, "a", v, "vos")
+    # a new generation of the VOs keeps the sites
+    assert response_cache.get(6, "a", "vos") is None
+    assert response_cache.get(1, "a", "sites") is a
+    assert response_cache.size == 1
+
+
+def test_response_cache_single_flight():
+    response_cache = cache.ResponseCache()
+    calls = []
+
+    async def render(status=200):
+        calls.append(status)
+        await asyncio.sleep(0.01)
+        return cache.CachedResponse(status, [], b"foo")
+
+    async def requests(*renders):
+        # lookups always happen before rendering
+        for g, k, _ in renders:
+            response_cache.get(g, k)
+        return await asyncio.gather(
+            *[response_cache.single_flight(g, k, r) for g, k, r in renders]
+        )
+
+    entries = asyncio.run(
+        requests((1, "a", render), (1, "a", render), (1, "b", render))
+    )
+    assert entries[0] is entries[1]
+    assert entries[0] is not entries[2]
+    assert len(calls) == 2
+    assert response_cache.coalesced[""] == 1
+    assert response_cache.get(1, "a") is entries[0]
+    # a new generation is rendered on its own
+    asyncio.run(requests((2, "c", render), (2, "c", render)))
+    asyncio.run(requests((3, "c", render)))
+    assert len(calls) == 4
+    # errors are not cached
+    asyncio.run(requests((3, "d", lambda: render(500)), (3, "d", render)))
+    assert calls[4:] == [500]
+    assert response_cache.get(3, "d") is None
+
+
+def test_response_cache_single_flight_error():
+    response_cache = cache.ResponseCache()
+
+    async def render():
+        await asyncio.sleep(0.01)
+        raise ValueError("boom")
+
+    async def requests():
+        return await asyncio.gather(
+            response_cache.single_flight(0, "a", render),
+            response_cache.single_flight(0, "a", render),
+            return_exceptions=True,
+        )
+
+    errors = asyncio.run(requests())
+    assert all(isinstance(e, ValueError) for e in errors)
+    assert response_cache.coalesced[""] == 1
+    assert not response_cache._in_flight
+
+
+def test_cached_response_middleware():
+    calls = []
+    generation = [0]
+
+    def endpoint(request):
+        calls.append(request.url.path)
+        return JSONResponse(["x" * 100] * 10)
+
+    def missing(request):
+        calls.append(request.url.path)
+        return JSONResponse({"detail": "Not found"}, status_code=404)
+
+    app = Starlette(
+        routes=[Route("/cached/", endpoint), Route("/cached/missing", missing)]
+    )
+    response_cache = cache.ResponseCache()
+    app.add_middleware(
+        cache.CachedResponseMiddleware,
+        cache=response_cache,
+        generation=lambda: generation[0],
+        paths=["/cached/"],
+        routes=app.router.routes,
+        min_size=100,
+    )
+    client = TestClient(app)
+    response = client.get("/cached/", headers={"accept-encoding": "gzip"})
+    assert response.headers["content-encoding"] == "gzip"
+    assert response.json() == ["x" * 100] * 10
+    response = client.get("/cached/", headers={"accept-encoding": "identity"})
+    assert "content-encoding" not in response.headers
+    assert response.json() == ["x" * 100] * 10
+    assert calls == ["/cached/"]
+    assert response_cache.hits == {"/cached/": 1}
+    assert response_cache.misses == {"/cached/": 1}
+    # new generation renders again
+    generation[0] = 1
+    client.get("/cached/")
+    assert calls == ["/cached/", "/cached/"]
+    # errors are not cached
+    assert client.get("/cached/missing").status_code == 404
+    assert client.get("/cached/missing").status_code == 404
+    assert calls[2:] == ["/cached/missing", "/cached/missing"]
+    # streamed responses are not cached
+    client.get("/cached/", headers={"accept": "application/x-ndjson"})
+    assert len(calls) == 5
+
+
+def test_cached_response_middleware_per_host():
+    app = Starlette(
+        routes=[Route("/", lambda request: JSONResponse(str(request.base_url)))]
+    )
+    app.add_middleware(
+        cache.CachedResponseMiddleware,
+        cache=cache.ResponseCache(),
+        generation=lambda: 0,
+        paths=["/"],
+    )
+    client = TestClient(app)
+    assert client.get("/").json() == "http://testserver/"
+    assert client.get("/", headers={"host": "example.com"}).json() == (
+        "http://example.com/"
+    )
+
+
+def test_cached_response_middleware_lifespan():
+    started = []
+
+    @contextlib.asynccontextmanager
+    async def lifespan(app):
+        started.append(True)
+        yield
+
+    app = Starlette(lifespan=lifespan)
+    app.add_middleware(
+        cache.CachedResponseMiddleware,
+        cache=cache.ResponseCache(),
+        generation=lambda: 0,
+        paths=["/"],
+    )
+    with TestClient(app):
+        assert started == [True]
+
+
+def test_cached_response_middleware_generations():
+    calls = []
+
+    def endpoint(request):
+        calls.append(request.url.path)
+        return JSONResponse(request.url.path)
+
+    app = Starlette(routes=[Route("/sites/", endpoint), Route("/vos/", endpoint)])
+    generations = {"sites": 0, "vos": 0}
+    app.add_middleware(
+        cache.CachedResponseMiddleware,
+        cache=cache.ResponseCache(),
+        generation={
+            "/sites/": lambda: generations["sites"],
+            "/vos/": lambda: generations["vos"],
+        },
+    )
+    client = TestClient(app)
+    for _ in range(2):
+        assert client.get("/sites/").json() == "/sites/"
+        assert client.get("/vos/").json() == "/vos/"
+    generations["vos"] = 1
+    client.get("/sites/")
+    client.get("/vos/")
+    assert calls == ["/sites/", "/vos/", "/vos/"]
+
+
+def test_cached_response_middleware_key():
+    calls = []
+    app = FastAPI()
+
+    @app.get("/items/")
+    def items(request: Request, vo: str = "", limit: int = 0, accept: str = Header("")):
+        calls.append(str(request.url.query))
+        return "msgpack" if "application/msgpack" in accept else "json"
+
+    app.add_middleware(
+        cache.CachedResponseMiddleware,
+        cache=cache.ResponseCache(),
+        generation=lambda: 0,
+        paths=["/items/"],
+        routes=app.router.routes,
+        media_types=["application/msgpack"],
+    )
+    client = TestClient(app)
+    for query in [
+        "vo=a&limit=1",
+        "limit=1&vo=a",
+        "limit=1&x=1&vo=a",
+        "vo=a&limit=1&x=2",
+    ]:
+        assert client.get(f"/items/?{query}").json() == "json"
+    # rendered only with the parameters that are read
+    assert calls == ["limit=1&vo=a"]
+    for accept in ["application/json", "*/*", "application/json, text/plain"]:
+        assert client.get("/items/", headers={"accept": accept}).json() == "json"
+    accept = {"accept": "application/msgpack"}
+    assert client.get("/items/", headers=accept).json() == "msgpack"
+    assert len(calls) == 3
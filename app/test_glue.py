@@ -1,16 +1,23 @@
 """Testing our glue component"""
 
+import asyncio
 import datetime
 import json
+import threading
 from http import HTTPStatus
 from unittest import mock
 
 import httpx
 import pytest
+from prometheus_client import REGISTRY
 
 from . import glue
 
 
+def _sample(name, **labels):
+    return REGISTRY.get_sample_value(name, labels) or 0
+
+
 def test_gluesite_object(site):
     site = site
     # supports a VO?
@@ -73,6 +80,72 @@ def test_vo_store_get_vos(ops_portal):
     assert vos == vo_store.get_vos()
 
 
+def test_vo_disciplines():
+    vo = glue.VO(serial="1", name="foo", disciplines=[{"id": 2, "name": "x"}, "3"])
+    assert vo.disciplines == ["2", "3"]
+    assert glue.VO(serial="1", name="foo", disciplines=None).disciplines == []
+    vo = glue.VO(serial="1", name="foo", disciplines=[{"name": "x"}, "3"])
+    assert vo.disciplines == ["3"]
+
+
+def test_vo_index():
+    disciplines = [
+        glue.Discipline(id="1", name="Sciences", order=2),
+        glue.Discipline(id="2", name="Physics", parent="1", order=2),
+        glue.Discipline(id="3", name="Maths", parent="1", order=1),
+        glue.Discipline(id="4", name="Arts", order=1),
+        # unknown parent
+        glue.Discipline(id="5", name="Other", parent="9", order=3),
+        # loop
+        glue.Discipline(id="6", name="A", parent="7", order=1),
+        glue.Discipline(id="7", name="B", parent="6", order=1),
+    ]
+    vos = [
+        glue.VO(serial=1, name="zeta", disciplines=["2"]),
+        glue.VO(serial=2, name="alpha", disciplines=["2", "3"]),
+        glue.VO(serial=3, name="beta", disciplines=["1", "8"]),
+    ]
+    index = glue.VOIndex(vos, disciplines)
+    assert index.vo_names == ["alpha", "beta", "zeta"]
+    assert [node.id for node in index.tree] == ["4", "1", "5"]
+    sciences = index.tree[1]
+    assert sciences.vos == ["beta"]
+    assert [(node.name, node.vos) for node in sciences.children] == [
+        ("Maths", ["alpha"]),
+        ("Physics", ["alpha", "zeta"]),
+    ]
+    assert index.vos["1"] == ["alpha", "beta", "zeta"]
+    assert index.vos["4"] == []
+    assert "6" not in index.vos
+    assert "8" not in index.vos
+
+
+def test_vo_store_index(ops_portal, disciplines_json):
+    ops_portal["data"][0]["disciplines"] = [{"id": "1"}]
+    test_client = httpx.Client(
+        transport=httpx.MockTransport(
+            lambda request: httpx.Response(
+                HTTPStatus.OK, content=json.dumps(ops_portal)
+            )
+        )
+    )
+    vo_store = glue.VOStore(
+        ops_portal_url="https://example.com",
+        vo_disciplines_file="foo.json",
+        httpx_client=test_client,
+    )
+    with mock.patch("builtins.open", mock.mock_open(read_data=disciplines_json)):
+        assert vo_store.get_vo_names() == ["alice", "vo.epos-eric.eu"]
+    assert vo_store.get_discipline_vos("1") == ["alice"]
+    assert vo_store.get_discipline_vos("2") is None
+    assert [node.vos for node in vo_store.get_discipline_tree()] == [["alice"]]
+    generation = vo_store.generation
+    ops_portal["data"][1]["disciplines"] = [{"id": "1"}]
+    vo_store.update_vos()
+    assert vo_store.generation == generation + 1
+    assert vo_store.get_discipline_vos("1") == ["alice", "vo.epos-eric.eu"]
+
+
 def test_vo_store_get_vos_failure():
     test_client = httpx.Client(
         transport=httpx.MockTransport(
@@ -82,19 +155,71 @@ def test_vo_store_get_vos_failure():
     vo_store = glue.VOStore(
         ops_portal_url="https://example.com", httpx_client=test_client
     )
+    errors = _sample("cloud_info_upstream_errors_total", service="ops_portal")
     assert [] == vo_store.get_vos()
+    assert [] == vo_store.get_vo_names()
+    generation = vo_store.generation
+    assert vo_store.get_discipline_tree() == []
+    # not retried until the retry period is over
+    assert (
+        _sample("cloud_info_upstream_errors_total", service="ops_portal") == errors + 1
+    )
+    vo_store._last_update -= vo_store._retry_period
+    assert [] == vo_store.get_vos()
+    assert (
+        _sample("cloud_info_upstream_errors_total", service="ops_portal") == errors + 2
+    )
+    assert vo_store.generation == generation
+
+
+def test_vo_store_update_vos_generation(ops_portal):
+    status = [HTTPStatus.OK]
+    test_client = httpx.Client(
+        transport=httpx.MockTransport(
+            lambda request: httpx.Response(status[0], content=json.dumps(ops_portal))
+        )
+    )
+    vo_store = glue.VOStore(
+        ops_portal_url="https://example.com", httpx_client=test_client
+    )
+    vo_store.update_vos()
+    generation = vo_store.generation
+    # same VOs
+    vo_store.update_vos()
+    assert vo_store.generation == generation
+    # failures keep the last VOs
+    status[0] = HTTPStatus.SERVICE_UNAVAILABLE
+    vo_store.update_vos()
+    assert vo_store.generation == generation
+    assert len(vo_store.get_vos()) == 2
+    status[0] = HTTPStatus.OK
+    ops_portal["data"].pop()
+    vo_store.update_vos()
+    assert vo_store.generation == generation + 1
+    assert [vo.name for vo in vo_store.get_vos()] == ["alice"]
+    # invalid VOs are skipped
+    ops_portal["data"].append({"name": "no-serial"})
+    vo_store.update_vos()
+    assert vo_store.generation == generation + 1
+    # invalid responses keep the last VOs
+    ops_portal["data"] = None
+    vo_store.update_vos()
+    assert vo_store.generation == generation + 1
+    assert [vo.name for vo in vo_store.get_vos()] == ["alice"]
 
 
 def test_vo_store_get_disciplines(disciplines_json, discipline):
+    vo_store = glue.VOStore(vo_disciplines_file="foo.json")
+    # only read when needed
     with mock.patch("builtins.open", mock.mock_open(read_data=disciplines_json)):
-        vo_store = glue.VOStore(vo_disciplines_file="foo.json")
+        assert [glue.Discipline(**discipline)] == vo_store.get_disciplines()
     assert [glue.Discipline(**discipline)] == vo_store.get_disciplines()
 
 
 def test_vo_store_get_disciplines_bad_json():
+    vo_store = glue.VOStore(vo_disciplines_file="foo.json")
     with mock.patch("builtins.open", mock.mock_open(read_data="")):
-        vo_store = glue.VOStore(vo_disciplines_file="foo.json")
-    assert [] == vo_store.get_disciplines()
+        assert [] == vo_store.get_disciplines()
 
 
 def test_gocdb_info(gocdb):
@@ -209,20 +334,25 @@ def test_get_mp_image_data(glue_image):
 
 def test_load_bad_json_site_file():
     site_store = glue.FileSiteStore()
-    with mock.patch("builtins.open", mock.mock_open(read_data="xxx")) as m_open:
-        site = site_store._load_site_file("foo")
-        m_open.assert_called_with("foo")
+    failures = _sample("cloud_info_site_parse_failures_total", source="file")
+    with mock.patch("builtins.open", mock.mock_open(read_data=b"xxx")) as m_open:
+        site, _ = site_store._read_site_file("foo")
+        m_open.assert_called_with("foo", "rb")
     assert site is None
+    assert (
+        _sample("cloud_info_site_parse_failures_total", source="file") == failures + 1
+    )
 
 
 def test_load_json_site_file(site_info_json):
     site_store = glue.FileSiteStore(check_glue_validity=False)
     with mock.patch(
-        "builtins.open", mock.mock_open(read_data=site_info_json)
+        "builtins.open", mock.mock_open(read_data=site_info_json.encode())
     ) as m_open:
-        site = site_store._load_site_file("foo")
-        m_open.assert_called_with("foo")
+        site, valid_until = site_store._read_site_file("foo")
+        m_open.assert_called_with("foo", "rb")
     assert site.name == "BIFI"
+    assert valid_until is None
 
 
 def test_glue_site_load_duplicated(site):
@@ -231,3 +361,450 @@ def test_glue_site_load_duplicated(site):
     duplicated.gocdb_id = "0G"
     sites = site_store._clean_up_duplicated_sites({site.name: [duplicated, site]})
     assert set([s.name for s in sites]) == set(["BIFI", "BIFI-0G"])
+
+
+def test_expiry_queue():
+    site_store = glue.SiteStore()
+    now = datetime.datetime.now(datetime.UTC)
+    site_store._schedule_expiry("a", now + datetime.timedelta(seconds=10))
+    site_store._schedule_expiry("b", now - datetime.timedelta(seconds=10))
+    site_store._schedule_expiry("c", now - datetime.timedelta(seconds=5))
+    # rescheduled, old entry should be ignored
+    site_store._schedule_expiry("c", now + datetime.timedelta(seconds=5))
+    site_store._cancel_expiry("a")
+    assert site_store._pop_expired(now) == ["b"]
+    assert site_store._next_expiry() == now + datetime.timedelta(seconds=5)
+    assert site_store._pop_expired(now + datetime.timedelta(seconds=60)) == ["c"]
+    assert site_store._next_expiry() is None
+
+
+def test_file_site_store_expire_and_readmit(tmp_path, site_info):
+    site_info["CloudComputingService"][0]["CreationTime"] = datetime.datetime.now(
+        datetime.UTC
+    ).isoformat()
+    site_file = tmp_path / "bifi.json"
+    site_file.write_text(json.dumps(site_info))
+    other_file = tmp_path / "other.json"
+    other_info = json.loads(json.dumps(site_info))
+    other_info["CloudComputingService"][0]["Associations"]["AdminDomain"] = ["OTHER"]
+    other_file.write_text(json.dumps(other_info))
+    with mock.patch("app.glue.SiteStore._get_gocdb_hostname") as goc_hostname:
+        goc_hostname.return_value = "foo"
+        site_store = glue.FileSiteStore(cloud_info_dir=str(tmp_path))
+        asyncio.run(site_store._load_sites())
+        assert set(s.name for s in site_store.get_sites()) == {"BIFI", "OTHER"}
+        # site info expires
+        later = datetime.datetime.now(datetime.UTC) + datetime.timedelta(hours=2)
+        expired = site_store._pop_expired(later)
+        assert set(expired) == {str(site_file), str(other_file)}
+        asyncio.run(site_store._expire_sites([str(site_file)]))
+        assert [s.name for s in site_store.get_sites()] == ["OTHER"]
+        # new file arrives, only that one is parsed
+        with mock.patch.object(
+            site_store, "_read_site_file", wraps=site_store._read_site_file
+        ) as m_read:
+            asyncio.run(site_store._update_site_files([str(site_file)]))
+            m_read.assert_called_once_with(str(site_file), None)
+        assert set(s.name for s in site_store.get_sites()) == {"BIFI", "OTHER"}
+        # file removed
+        site_file.unlink()
+        asyncio.run(site_store._update_site_files([str(site_file)]))
+        assert [s.name for s in site_store.get_sites()] == ["OTHER"]
+
+
+def test_file_site_store_ignore_other_files(tmp_path, site_info):
+    (tmp_path / "bifi.json").write_text(json.dumps(site_info))
+    with mock.patch("app.glue.SiteStore._get_gocdb_hostname") as goc_hostname:
+        goc_hostname.return_value = "foo"
+        site_store = glue.FileSiteStore(
+            cloud_info_dir=str(tmp_path), check_glue_validity=False
+        )
+        asyncio.run(site_store._load_sites())
+        generation = site_store.generation
+        (tmp_path / "sites.db").write_text("")
+        asyncio.run(
+            site_store._update_site_files(
+                [str(tmp_path / "sites.db"), str(tmp_path / ".bifi.json.swp")]
+            )
+        )
+        assert site_store.generation == generation
+        assert [s.name for s in site_store.get_sites()] == ["BIFI"]
+
+
+def test_file_site_store_directory_changes(tmp_path, site_info):
+    (tmp_path / "a").mkdir()
+    (tmp_path / "a" / "bifi.json").write_text(json.dumps(site_info))
+    with mock.patch("app.glue.SiteStore._get_gocdb_hostname") as goc_hostname:
+        goc_hostname.return_value = "foo"
+        site_store = glue.FileSiteStore(
+            cloud_info_dir=str(tmp_path), check_glue_validity=False
+        )
+        asyncio.run(site_store._load_sites())
+        # a directory moved, only reported as such
+        (tmp_path / "a").rename(tmp_path / "b")
+        asyncio.run(
+            site_store._update_site_files([str(tmp_path / "a"), str(tmp_path / "b")])
+        )
+        assert list(site_store._site_files) == [str(tmp_path / "b" / "bifi.json")]
+        assert [s.name for s in site_store.get_sites()] == ["BIFI"]
+        # and removed
+        (tmp_path / "b" / "bifi.json").unlink()
+        (tmp_path / "b").rmdir()
+        asyncio.run(site_store._update_site_files([str(tmp_path / "b")]))
+        assert site_store.get_sites() == []
+
+
+def test_file_site_store_expired_not_failed(tmp_path, site_info):
+    site_file = tmp_path / "bifi.json"
+    site_file.write_text(json.dumps(site_info))
+    site_store = glue.FileSiteStore(cloud_info_dir=str(tmp_path), quarantine_after=1)
+    failures = _sample("cloud_info_site_parse_failures_total", source="file")
+    with mock.patch.object(
+        site_store, "_get_valid_until", wraps=site_store._get_valid_until
+    ) as m_valid_until:
+        asyncio.run(site_store._load_sites())
+        m_valid_until.assert_called_once()
+    assert site_store.get_sites() == []
+    assert _sample("cloud_info_site_parse_failures_total", source="file") == failures
+    stat = site_file.stat()
+    assert not site_store.quarantine.holds(
+        str(site_file), (stat.st_size, stat.st_mtime_ns)
+    )
+
+
+def test_file_site_store_quarantine(tmp_path, site_info):
+    site_file = tmp_path / "bifi.json"
+    site_file.write_text("xxx")
+    with mock.patch("app.glue.SiteStore._get_gocdb_hostname") as goc_hostname:
+        goc_hostname.return_value = "foo"
+        site_store = glue.FileSiteStore(
+            cloud_info_dir=str(tmp_path), check_glue_validity=False
+        )
+        with mock.patch.object(
+            site_store, "_read_site_file", wraps=site_store._read_site_file
+        ) as m_read:
+            for _ in range(3):
+                asyncio.run(site_store._load_sites())
+            # not parsed again after failing twice
+            assert m_read.call_count == 2
+        assert site_store.quarantine.quarantined() == [str(site_file)]
+        # until fixed
+        site_file.write_text(json.dumps(site_info))
+        asyncio.run(site_store._update_site_files([str(site_file)]))
+        assert [s.name for s in site_store.get_sites()] == ["BIFI"]
+        assert site_store.quarantine.quarantined() == []
+
+
+def test_file_site_store_limits(tmp_path, site_info):
+    (tmp_path / "bifi.json").write_text(json.dumps(site_info))
+    with mock.patch("app.glue.SiteStore._get_gocdb_hostname") as goc_hostname:
+        goc_hostname.return_value = "foo"
+        site_store = glue.FileSiteStore(
+            cloud_info_dir=str(tmp_path), check_glue_validity=False, max_site_objects=5
+        )
+        asyncio.run(site_store._load_sites())
+        assert site_store.get_sites() == []
+        site_store.parser.max_objects = 0
+        site_store.parser.max_size = 100
+        asyncio.run(site_store._load_sites())
+        assert site_store.get_sites() == []
+
+
+def test_expire_loop_removes_sites():
+    async def run():
+        site_store = glue.SiteStore()
+        with mock.patch.object(site_store, "_expire_sites") as m_expire:
+            site_store._schedule_expiry(
+                "bifi",
+                datetime.datetime.now(datetime.UTC)
+                + datetime.timedelta(milliseconds=50),
+            )
+            task = asyncio.create_task(site_store._expire_loop())
+            await asyncio.sleep(0.2)
+            task.cancel()
+            m_expire.assert_called_once_with(["bifi"])
+
+    asyncio.run(run())
+
+
+def test_site_snapshot(site, another_site):
+    snapshot = glue.SiteSnapshot([site, another_site], generation=3)
+    assert snapshot.generation == 3
+    assert snapshot.get_sites() == [site, another_site]
+    assert snapshot.get_sites("access") == [another_site]
+    assert snapshot.get_sites("foo") == []
+    assert snapshot.get_site_by_name("FAKE") == another_site
+    assert snapshot.get_site_by_goc_id("12249G0") == site
+    assert [i.id for _, i in snapshot.get_images()] == [
+        "06c8bfac-0f93-48da-b0eb-4fbad3356f73",
+        "06c8bfac-0f93-48da-b03b-8f8ad3356f73",
+        "foobar",
+    ]
+    assert [i.id for _, i in snapshot.get_images("access", True)] == [
+        "06c8bfac-0f93-48da-b03b-8f8ad3356f73"
+    ]
+    # indexes are only built once
+    assert snapshot.get_images() is snapshot.get_images()
+
+
+def test_snapshot_generation(site):
+    site_store = glue.FileSiteStore()
+    generation = site_store.generation
+    assert site_store.generation == generation
+    site_store._site_store = [site]
+    assert site_store.generation == generation + 1
+    assert site_store.get_site_by_name("BIFI") == site
+
+
+def test_image_index(site, another_site):
+    index = glue.SiteSnapshot([site, another_site]).image_index()
+
+    def ids(images):
+        return [image.id for _, image in images]
+
+    assert ids(index.search({"vo": "access"})) == [
+        "06c8bfac-0f93-48da-b03b-8f8ad3356f73",
+        "foobar",
+    ]
+    assert ids(index.search({"egi_id": "EGI.*"})) == [
+        "06c8bfac-0f93-48da-b0eb-4fbad3356f73",
+        "06c8bfac-0f93-48da-b03b-8f8ad3356f73",
+    ]
+    assert ids(index.search({"egi_id": "egi.*", "vo": "ops"})) == [
+        "06c8bfac-0f93-48da-b0eb-4fbad3356f73"
+    ]
+    assert ids(index.search({"name": "another fake image"})) == ["foobar"]
+    assert ids(index.search({}, "fake image")) == [
+        "06c8bfac-0f93-48da-b03b-8f8ad3356f73",
+        "foobar",
+    ]
+    assert ids(index.search({"version": "0.0*"}, "another")) == ["foobar"]
+    assert index.search({"mpuri": "foo"}) == []
+    assert len(index.search({})) == 3
+
+
+def test_image_index_clean_name(site):
+    site.shares[0].images[0].name = "Image for Ubuntu 22.04 [Ubuntu/22.04/KVM]"
+    index = glue.SiteSnapshot([site]).image_index()
+    assert len(index.search({"name": "ubuntu 22.04"})) == 1
+    assert len(index.search({"name": "Ubuntu*"})) == 1
+
+
+def test_create_site_instance_resources(site_info):
+    instance_info = site_info["CloudComputingInstanceType"][0]
+    instance_info["Associations"]["CloudComputingVirtualAccelerator"] = "acc1"
+    site_info["CloudComputingVirtualAccelerator"] = [
+        {"ID": "acc1", "Type": "GPU", "Vendor": "NVIDIA", "Model": "A100", "Number": 2}
+    ]
+    with mock.patch("app.glue.SiteStore._get_gocdb_hostname") as goc_hostname:
+        goc_hostname.return_value = "foo"
+        site_store = glue.SiteStore(check_glue_validity=False)
+        site = site_store.create_site(site_info)
+    assert site.shares[0].instancetypes == [
+        glue.GlueInstanceType(
+            name="m1.tiny",
+            cpu=1,
+            ram=512,
+            disk=1,
+            accelerator_type="GPU",
+            accelerator_vendor="NVIDIA",
+            accelerator_model="A100",
+            accelerator_count=2,
+        )
+    ]
+    snapshot = glue.SiteSnapshot([site])
+    assert len(snapshot.find_flavors(min_cpu=1, accelerator=True)) == 1
+    assert snapshot.find_flavors(min_cpu=2) == []
+    assert snapshot.find_flavors(accelerator=False) == []
+
+
+def test_diff_sites(site, another_site):
+    changed_site = glue.GlueSite(**site.model_dump())
+    changed_site.shares[0].images[0].version = "new"
+    changes = glue.diff_sites([site, another_site], [changed_site], 2)
+    assert changes.generation == 2
+    assert changes.sites == glue.ChangeSet(removed=["FAKE"], changed=["BIFI"])
+    assert changes.shares == glue.ChangeSet(
+        removed=["FAKE/access"], changed=["BIFI/ops"]
+    )
+    assert changes.images == glue.ChangeSet(
+        removed=[
+            "FAKE/access/06c8bfac-0f93-48da-b03b-8f8ad3356f73",
+            "FAKE/access/foobar",
+        ],
+        changed=["BIFI/ops/06c8bfac-0f93-48da-b0eb-4fbad3356f73"],
+    )
+
+
+def test_site_store_changes(site, another_site):
+    site_store = glue.FileSiteStore(change_history_size=2)
+    generation = site_store.generation
+    site_store._site_store = [site]
+    site_store.snapshot()
+    site_store._site_store = [site, another_site]
+    assert site_store.generation == generation + 2
+    changes = site_store.get_changes(generation)
+    assert [c.sites.added for c in changes] == [["BIFI"], ["FAKE"]]
+    assert site_store.get_changes(generation + 2) == []
+    site_store._site_store = [another_site]
+    assert site_store.generation == generation + 3
+    # only last 2 changes are kept
+    assert site_store.get_changes(generation) is None
+    assert site_store.get_changes(generation + 3) == []
+    assert site_store.get_changes(generation + 4) is None
+    assert [c.sites.removed for c in site_store.get_changes(generation + 1)] == [
+        [],
+        ["BIFI"],
+    ]
+
+
+def test_snapshot_warm(site, another_site):
+    snapshot = glue.SiteSnapshot([site, another_site])
+    snapshot.warm()
+    with mock.patch.object(glue, "ImageIndex") as m_index:
+        snapshot.image_index()
+        m_index.assert_not_called()
+    build = mock.Mock()
+    for vo_name in ["", "ops", "access"]:
+        assert snapshot.cached(("images", vo_name or None, True), build)
+        assert snapshot.cached(("flavors", vo_name or None, False), build)
+    build.assert_not_called()
+
+
+def test_snapshot_unknown_vo_not_cached(site):
+    snapshot = glue.SiteSnapshot([site])
+    cached = len(snapshot.cached_items())
+    for i in range(10):
+        assert snapshot.get_images(f"unknown{i}") == []
+        assert snapshot.get_flavors(f"unknown{i}") == ([], [])
+    assert len(snapshot.cached_items()) == cached
+    snapshot.get_images("ops")
+    assert len(snapshot.cached_items()) == cached + 1
+
+
+def test_site_store_publish_warmed(site, another_site):
+    site_store = glue.FileSiteStore()
+    site_store._site_store = [site]
+    current = site_store.snapshot()
+    seen = []
+
+    def warmer(snapshot):
+        # the new snapshot is not visible until it's warmed up
+        seen.append((snapshot.generation, site_store._snapshot is current))
+        snapshot.cached("warmed", lambda: True)
+
+    def failing_warmer(snapshot):
+        raise ValueError("boom")
+
+    site_store.warmers.extend([failing_warmer, warmer])
+    site_store._site_files = {"bifi": site, "fake": another_site}
+    asyncio.run(site_store._publish_sites())
+    snapshot = site_store.snapshot()
+    assert seen == [(current.generation + 1, True)]
+    assert snapshot.generation == current.generation + 1
+    assert snapshot.cached("warmed", lambda: False)
+    assert [s.name for s in snapshot.get_sites()] == ["BIFI", "FAKE"]
+    assert [c.sites.added for c in site_store.get_changes(current.generation)] == [
+        ["FAKE"]
+    ]
+
+
+def test_site_store_publish_threads(site, another_site):
+    site_store = glue.FileSiteStore()
+    site_store._site_store = [site]
+    current = site_store.snapshot()
+    site_store.warmers.append(lambda snapshot: snapshot.cached("warmed", lambda: 1))
+    set_snapshot = site_store._set_snapshot
+    seen = []
+    threads = []
+
+    def swap(snapshot, changes=None):
+        set_snapshot(snapshot, changes)
+        # a request in a worker thread right when the snapshot is swapped
+        thread = threading.Thread(target=lambda: seen.append(site_store.snapshot()))
+        thread.start()
+        thread.join(0.1)
+        threads.append(thread)
+
+    with mock.patch.object(site_store, "_set_snapshot", swap):
+        site_store._site_files = {"bifi": site, "fake": another_site}
+        asyncio.run(site_store._publish_sites())
+    threads[0].join()
+    snapshot = site_store.snapshot()
+    assert snapshot.generation == current.generation + 1
+    assert seen == [snapshot]
+    assert snapshot.cached("warmed", lambda: 0) == 1
+
+
+def test_s3_site_store_update(site_info_json):
+    requests = []
+
+    def handler(request):
+        requests.append(request.url.path)
+        if request.url.path.endswith("bifi.json"):
+            return httpx.Response(HTTPStatus.OK, content=site_info_json)
+        listing = [{"name": "bifi.json", "last_modified": "2025-01-01"}]
+        return httpx.Response(HTTPStatus.OK, content=json.dumps(listing))
+
+    test_client = httpx.Client(transport=httpx.MockTransport(handler))
+    with mock.patch("app.glue.SiteStore._get_gocdb_hostname") as goc_hostname:
+        goc_hostname.return_value = "foo"
+        site_store = glue.S3SiteStore(
+            s3_url="https://example.com/",
+            httpx_client=test_client,
+            check_glue_validity=False,
+        )
+        asyncio.run(site_store._update_sites())
+        assert [s.name for s in site_store.get_sites()] == ["BIFI"]
+        generation = site_store.generation
+        # not modified, no need to get it again
+        asyncio.run(site_store._update_sites())
+        assert requests == ["/", "/bifi.json", "/"]
+        assert [s.name for s in site_store.get_sites()] == ["BIFI"]
+        assert site_store.generation == generation
+
+
+def test_s3_site_store_quarantine(site_info_json):
+    requests = []
+    listing = [
+        {"name": "bad.json", "last_modified": "2025-01-01", "bytes": 3},
+        {"name": "large.json", "last_modified": "2025-01-01", "bytes": 10**9},
+    ]
+
+    def handler(request):
+        requests.append(request.url.path)
+        if request.url.path.endswith("bad.json"):
+            return httpx.Response(HTTPStatus.OK, content="xxx")
+        return httpx.Response(HTTPStatus.OK, content=json.dumps(listing))
+
+    test_client = httpx.Client(transport=httpx.MockTransport(handler))
+    site_store = glue.S3SiteStore(
+        s3_url="https://example.com/",
+        httpx_client=test_client,
+        max_site_file_size=2**20,
+    )
+    for _ in range(3):
+        asyncio.run(site_store._update_sites())
+    # too large files are not downloaded, failing ones only until quarantined
+    assert requests == ["/", "/bad.json", "/", "/bad.json", "/"]
+    assert site_store.quarantine.quarantined() == ["bad.json", "large.json"]
+
+
+def test_s3_site_store_expired_not_failed(site_info_json):
+    listing = [{"name": "bifi.json", "last_modified": "2025-01-01"}]
+
+    def handler(request):
+        if request.url.path.endswith("bifi.json"):
+            return httpx.Response(HTTPStatus.OK, content=site_info_json)
+        return httpx.Response(HTTPStatus.OK, content=json.dumps(listing))
+
+    site_store = glue.S3SiteStore(
+        s3_url="https://example.com/",
+        httpx_client=httpx.Client(transport=httpx.MockTransport(handler)),
+    )
+    failures = _sample("cloud_info_site_parse_failures_total", source="s3")
+    for _ in range(3):
+        asyncio.run(site_store._update_sites())
+    assert site_store.get_sites() == []
+    assert _sample("cloud_info_site_parse_failures_total", source="s3") == failures
+    assert site_store.quarantine.quarantined() == []
@@ -1,24 +1,63 @@
 """Testing our glue component"""
 
+import asyncio
+import json
+import threading
 from unittest import mock
 
 import pytest
 import yaml
-from fastapi import HTTPException
+from fastapi import FastAPI, HTTPException
 from fastapi.testclient import TestClient
 
-from .glue import VO, Discipline
-from .main import _get_site, app, site_store, vo_store
+from . import cache, glue, sqlite_store
+from .glue import VO, Discipline, VOIndex
+from .main import (
+    _generation_events,
+    _get_site,
+    _lookup_route,
+    app,
+    response_cache,
+    settings,
+    site_store,
+    vo_store,
+    warm_snapshot,
+)
 
 client = TestClient(app)
 
 
+@pytest.fixture(autouse=True)
+def clear_response_cache():
+    # mocked stores do not always move to a new generation
+    response_cache.clear()
+
+
+def test_get_health():
+    response = client.get("/health")
+    assert response.status_code == 200
+    assert response.json() == {"status": "ok"}
+
+
+def test_get_metrics(site):
+    with mock.patch.object(site_store, "_sites") as m_sites:
+        m_sites.return_value = [site]
+        client.get("/site/BIFI/")
+        response = client.get("/metrics")
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/plain")
+    assert 'cloud_info_objects{kind="sites"} 1.0' in response.text
+    assert (
+        'cloud_info_request_duration_seconds_count{method="GET",'
+        'route="/site/{site_name}/",status="200"}'
+    ) in response.text
+
+
 def test_get_vos():
-    with mock.patch.object(vo_store, "get_vos") as m_get_vos:
-        m_get_vos.return_value = [
-            VO(serial=1, name="foo"),
-            VO(serial=2, name="bar"),
-        ]
+    with mock.patch.object(vo_store, "_get_index") as m_get_index:
+        m_get_index.return_value = VOIndex(
+            [VO(serial=1, name="foo"), VO(serial=2, name="bar")]
+        )
         response = client.get("/vos/")
         assert response.status_code == 200
         assert response.json() == ["bar", "foo"]
@@ -32,9 +71,57 @@ def test_get_disciplines(discipline):
         assert response.json() == [discipline]
 
 
+def test_get_discipline_tree_and_vos(discipline):
+    child = {"id": "2", "name": "bar", "parent": "1", "order": 0}
+    index = VOIndex(
+        [VO(serial=1, name="foo", disciplines=["2"])],
+        [Discipline(**discipline), Discipline(**child)],
+    )
+    with mock.patch.object(vo_store, "_get_index") as m_get_index:
+        m_get_index.return_value = index
+        response = client.get("/disciplines/tree")
+        assert response.status_code == 200
+        assert response.json() == [
+            {
+                "id": "1",
+                "name": "foo",
+                "vos": [],
+                "children": [
+                    {"id": "2", "name": "bar", "vos": ["foo"], "children": []}
+                ],
+            }
+        ]
+        response = client.get("/disciplines/1/vos")
+        assert response.status_code == 200
+        assert response.json() == ["foo"]
+        response = client.get("/disciplines/3/vos")
+        assert response.status_code == 404
+
+
+def test_lookup_route(tmp_path):
+    test_app = FastAPI()
+    threads = []
+
+    def get_item(item: int, flag: bool = False) -> dict:
+        threads.append(threading.current_thread().name)
+        return {"item": item, "flag": flag}
+
+    test_app.get("/items/{item}")(_lookup_route(get_item))
+    # in the threadpool with SQLite snapshots
+    sqlite_site_store = sqlite_store.SQLiteSiteStore(sqlite_db=str(tmp_path / "db"))
+    with mock.patch("app.main.site_store", sqlite_site_store):
+        test_app.get("/sqlite/{item}")(_lookup_route(get_item))
+    test_client = TestClient(test_app)
+    response = test_client.get("/items/3", params={"flag": "true"})
+    assert response.json() == {"item": 3, "flag": True}
+    assert test_client.get("/sqlite/3").json() == {"item": 3, "flag": False}
+    assert threads[0] != threads[1]
+    assert threads[1].startswith("AnyIO worker thread")
+
+
 def test_get_sites_summary(site):
-    with mock.patch.object(site_store, "get_sites") as m_get_sites:
-        m_get_sites.return_value = [site]
+    with mock.patch.object(site_store, "_sites") as m_sites:
+        m_sites.return_value = [site]
         response = client.get("/sites/", params={"include_projects": "true"})
         assert response.status_code == 200
         assert response.json() == [
@@ -47,14 +134,20 @@ def test_get_sites_summary(site):
                 "projects": [{"id": "038db3eeca5c4960a443a89b92373cd2", "name": "ops"}],
             }
         ]
-        m_get_sites.assert_called()
+        m_sites.assert_called()
 
 
 def test_get_sites_no_name(site, bifi_summary):
-    with mock.patch.object(site_store, "get_sites") as m_get_sites:
-        m_get_sites.return_value = [site]
+    with mock.patch.object(site_store, "_sites") as m_sites:
+        m_sites.return_value = [site]
+        response = client.get("/sites/", params={"vo_name": "ops"})
+        assert response.status_code == 200
+        assert response.json() == [bifi_summary]
         response = client.get("/sites/", params={"vo_name": "foo"})
         assert response.status_code == 200
+        assert response.json() == []
+        response = client.get("/sites/")
+        assert response.status_code == 200
         assert response.json() == [bifi_summary]
 
 
@@ -156,32 +249,45 @@ def test_get_site_vo_project(site):
 
 
 def test_get_all_images(site, another_site, images):
-    with mock.patch.object(site_store, "get_sites") as m_get_sites:
-        m_get_sites.return_value = [site, another_site]
+    with mock.patch.object(site_store, "_sites") as m_sites:
+        m_sites.return_value = [site, another_site]
         response = client.get("/images")
         assert response.status_code == 200
         assert response.json() == images
 
 
 def test_get_all_vo_images(site, images):
-    with mock.patch.object(site_store, "get_sites") as m_get_sites:
-        m_get_sites.return_value = [site]
+    with mock.patch.object(site_store, "_sites") as m_sites:
+        m_sites.return_value = [site]
         response = client.get("/images", params={"vo_name": "ops"})
         assert response.status_code == 200
         assert response.json() == [images[0]]
 
 
+def test_unknown_vos_not_cached(site):
+    with mock.patch.object(site_store, "_sites") as m_sites:
+        m_sites.return_value = [site]
+        snapshot = site_store.snapshot()
+        for i in range(10):
+            params = {"vo_name": f"unknown{i}"}
+            for path in ["/sites/", "/flavors/", "/fedcloudclient/sites.yaml"]:
+                assert client.get(path, params=params).status_code == 200
+            params["fields"] = "id"
+            assert client.get("/images/", params=params).status_code == 200
+        assert not [key for key, _ in snapshot.cached_items() if "unknown0" in key]
+
+
 def test_get_images_non_egi(site, another_site, more_images):
-    with mock.patch.object(site_store, "get_sites") as m_get_sites:
-        m_get_sites.return_value = [site, another_site]
+    with mock.patch.object(site_store, "_sites") as m_sites:
+        m_sites.return_value = [site, another_site]
         response = client.get("/images", params={"only_egi_images": False})
         assert response.status_code == 200
         assert response.json() == more_images
 
 
 def test_get_fedcloud_sites(site, another_site):
-    with mock.patch.object(site_store, "get_sites") as m_get_sites:
-        m_get_sites.return_value = [site, another_site]
+    with mock.patch.object(site_store, "_sites") as m_sites:
+        m_sites.return_value = [site, another_site]
         response = client.get("/fedcloudclient/")
         assert response.status_code == 200
         assert response.json() == [
@@ -191,9 +297,9 @@ def test_get_fedcloud_sites(site, another_site):
 
 
 def test_get_fedcloud_site(site):
-    with mock.patch.object(site_store, "get_site_by_name") as m_get_site:
-        m_get_site.return_value = site
-        response = client.get("/fedcloudclient/foo")
+    with mock.patch.object(site_store, "_sites") as m_sites:
+        m_sites.return_value = [site]
+        response = client.get("/fedcloudclient/BIFI")
         assert response.status_code == 200
         expected_site = {
             "endpoint": "https://colossus.cesar.unizar.es:5000/v3",
@@ -206,3 +312,403 @@ def test_get_fedcloud_site(site):
             ],
         }
         assert yaml.safe_load(response.text) == expected_site
+        response = client.get("/fedcloudclient/foo")
+        assert response.status_code == 404
+
+
+def test_get_fedcloud_all_sites(site, another_site):
+    with mock.patch.object(site_store, "_sites") as m_sites:
+        m_sites.return_value = [site, another_site]
+        response = client.get("/fedcloudclient/sites.yaml")
+        assert response.status_code == 200
+        assert response.headers["content-type"] == "application/yaml"
+        assert yaml.safe_load(response.text) == [
+            {
+                "endpoint": "https://colossus.cesar.unizar.es:5000/v3",
+                "gocdb": "BIFI",
+                "vos": [
+                    {
+                        "name": "ops",
+                        "auth": {"project_id": "038db3eeca5c4960a443a89b92373cd2"},
+                    }
+                ],
+            },
+            {
+                "endpoint": "https://example.com/v3",
+                "gocdb": "FAKE",
+                "vos": [{"name": "access", "auth": {"project_id": "foobar"}}],
+            },
+        ]
+        response = client.get(
+            "/fedcloudclient/sites.yaml", params={"vo_name": "access"}
+        )
+        assert [s["gocdb"] for s in yaml.safe_load(response.text)] == ["FAKE"]
+        response = client.get("/fedcloudclient/sites.yaml", params={"vo_name": "foo"})
+        assert yaml.safe_load(response.text) == []
+
+
+def test_warm_snapshot(site, another_site):
+    snapshot = glue.SiteSnapshot([site, another_site], generation=1)
+    assert warm_snapshot in site_store.warmers
+    site_store.warm_snapshot(snapshot)
+    with (
+        mock.patch.object(site_store, "_snapshot", snapshot),
+        mock.patch.object(site_store, "_sites", return_value=snapshot.source),
+        mock.patch("yaml.dump") as m_dump,
+        mock.patch("app.main._site_views") as m_views,
+    ):
+        response = client.get("/fedcloudclient/sites.yaml", params={"vo_name": "ops"})
+        assert [s["gocdb"] for s in yaml.safe_load(response.text)] == ["BIFI"]
+        response = client.get("/sites/", params={"vo_name": "access"})
+        assert [s["name"] for s in response.json()] == ["FAKE"]
+        assert len(client.get("/fedcloudclient/").json()) == 2
+        m_dump.assert_not_called()
+        m_views.assert_not_called()
+
+
+def test_sqlite_snapshot_routes(tmp_path, site, another_site, images):
+    db = str(tmp_path / "sites.db")
+    sqlite_store.write_sites_db(db, [site, another_site], 1)
+    snapshot = sqlite_store.SQLiteSnapshot(db)
+    with (
+        mock.patch.object(site_store, "_snapshot", snapshot),
+        mock.patch.object(site_store, "_sites", return_value=snapshot.source),
+    ):
+        response = client.get("/sites/", params={"vo_name": "access"})
+        assert [s["name"] for s in response.json()] == ["FAKE"]
+        response = client.get("/site/BIFI/ops/images")
+        assert response.json() == [images[0]]
+        response = client.get("/images/", params={"vo_name": "ops"})
+        assert response.json() == [images[0]]
+        response = client.get("/fedcloudclient/sites.yaml", params={"vo_name": "ops"})
+        assert [s["gocdb"] for s in yaml.safe_load(response.text)] == ["BIFI"]
+
+
+def test_get_images_paginated(site, another_site, more_images):
+    with mock.patch.object(site_store, "_sites") as m_sites:
+        m_sites.return_value = [site, another_site]
+        params = {"only_egi_images": False, "limit": 2}
+        response = client.get("/images/", params=params)
+        assert response.status_code == 200
+        assert response.json() == more_images[:2]
+        next_page = response.links["next"]["url"]
+        response = client.get(next_page)
+        assert response.status_code == 200
+        assert response.json() == more_images[2:]
+        assert "next" not in response.links
+        # new generation invalidates the cursor
+        m_sites.return_value = [site, another_site]
+        response = client.get(next_page)
+        assert response.status_code == 410
+
+
+def test_get_images_bad_cursor():
+    response = client.get("/images/", params={"cursor": "foo"})
+    assert response.status_code == 400
+
+
+def test_get_sites_ndjson(site, another_site, bifi_summary):
+    with mock.patch.object(site_store, "_sites") as m_sites:
+        m_sites.return_value = [site, another_site]
+        response = client.get(
+            "/sites/",
+            params={"limit": 1},
+            headers={"accept": "application/x-ndjson"},
+        )
+        assert response.status_code == 200
+        assert response.headers["content-type"] == "application/x-ndjson"
+        assert [json.loads(line) for line in response.text.splitlines()] == [
+            bifi_summary
+        ]
+        assert "next" in response.links
+
+
+def test_get_site_images_ndjson(site, images):
+    with mock.patch.object(site_store, "get_site_by_name") as m_get_site:
+        m_get_site.return_value = site
+        response = client.get(
+            "/site/foo/images", headers={"accept": "application/x-ndjson"}
+        )
+        assert response.status_code == 200
+        assert [json.loads(line) for line in response.text.splitlines()] == [images[0]]
+
+
+def test_get_images_fields(site, another_site):
+    with mock.patch.object(site_store, "_sites") as m_sites:
+        m_sites.return_value = [site, another_site]
+        response = client.get("/images/", params={"fields": "id,endpoint"})
+        assert response.status_code == 200
+        assert response.json() == [
+            {
+                "id": "06c8bfac-0f93-48da-b0eb-4fbad3356f73",
+                "endpoint": "https://colossus.cesar.unizar.es:5000/v3",
+            },
+            {
+                "id": "06c8bfac-0f93-48da-b03b-8f8ad3356f73",
+                "endpoint": "https://example.com/v3",
+            },
+        ]
+        response = client.get("/images/", params={"fields": "id,foo"})
+        assert response.status_code == 400
+
+
+def test_get_sites_fields(site, another_site):
+    with mock.patch.object(site_store, "_sites") as m_sites:
+        m_sites.return_value = [site, another_site]
+        response = client.get(
+            "/sites/",
+            params={"fields": "name,url", "limit": 1},
+            headers={"accept": "application/x-ndjson"},
+        )
+        assert response.status_code == 200
+        assert [json.loads(line) for line in response.text.splitlines()] == [
+            {"name": "BIFI", "url": "https://colossus.cesar.unizar.es:5000/v3"}
+        ]
+
+
+def test_get_site_vo_images_fields(site):
+    with mock.patch.object(site_store, "get_site_by_name") as m_get_site:
+        m_get_site.return_value = site
+        response = client.get("/site/foo/ops/images", params={"fields": "id,egi_id"})
+        assert response.status_code == 200
+        assert response.json() == [
+            {
+                "id": "06c8bfac-0f93-48da-b0eb-4fbad3356f73",
+                "egi_id": "egi.small.ubuntu.16.04.for.monitoring",
+            }
+        ]
+
+
+def test_get_images_msgpack(site, another_site, images):
+    msgpack = pytest.importorskip("msgpack")
+    with mock.patch.object(site_store, "_sites") as m_sites:
+        m_sites.return_value = [site, another_site]
+        response = client.get("/images/", headers={"accept": "application/msgpack"})
+        assert response.status_code == 200
+        assert response.headers["content-type"] == "application/msgpack"
+        assert msgpack.unpackb(response.content) == images
+
+
+def test_get_images_compressed(site, another_site, images):
+    with (
+        mock.patch.object(site_store, "_sites") as m_sites,
+        mock.patch.object(response_cache, "put", wraps=response_cache.put) as m_put,
+    ):
+        m_sites.return_value = [site, another_site] * 10
+        response = client.get("/images/", headers={"accept-encoding": "gzip"})
+        assert response.status_code == 200
+        assert response.headers["content-encoding"] == "gzip"
+        assert response.json() == images * 10
+        # br only with the brotli extra installed, gzip otherwise
+        response = client.get("/images/", headers={"accept-encoding": "br, gzip"})
+        assert response.headers["content-encoding"] == cache.supported_encodings()[0]
+        assert response.json() == images * 10
+        m_put.assert_called_once()
+
+
+def test_get_images_unread_params(site, another_site, images):
+    with (
+        mock.patch.object(site_store, "_sites") as m_sites,
+        mock.patch.object(response_cache, "put", wraps=response_cache.put) as m_put,
+    ):
+        m_sites.return_value = [site, another_site]
+        for query in ["x=1", "x=2"]:
+            assert client.get(f"/images/?{query}").json() == images
+        all_images = client.get("/images/?x=1&only_egi_images=false").json()
+        assert client.get("/images/?only_egi_images=false").json() == all_images
+        # only_egi_images is read by the route, x is not
+        assert m_put.call_count == 2
+
+
+def test_lookup_sites(site, another_site, images):
+    with mock.patch.object(site_store, "_sites") as m_sites:
+        m_sites.return_value = [site, another_site]
+        response = client.post(
+            "/sites/lookup",
+            json={
+                "items": [
+                    {"site_name": "BIFI", "vo_name": "ops"},
+                    {"site_name": "BIFI", "vo_name": "access"},
+                ],
+                "vo_name": "access",
+                "site_names": ["FAKE", "foo"],
+            },
+        )
+        assert response.status_code == 200
+        assert response.json() == [
+            {
+                "site_name": "BIFI",
+                "vo_name": "ops",
+                "project": {"id": "038db3eeca5c4960a443a89b92373cd2", "name": "ops"},
+                "images": [images[0]],
+            },
+            {
+                "site_name": "BIFI",
+                "vo_name": "access",
+                "error": "VO access not supported by Site BIFI",
+            },
+            {
+                "site_name": "FAKE",
+                "vo_name": "access",
+                "project": {"id": "foobar", "name": "access"},
+                "images": [images[1]],
+            },
+            {"site_name": "foo", "vo_name": "access", "error": "Site foo not found"},
+        ]
+
+
+def test_lookup_sites_no_vo():
+    response = client.post("/sites/lookup", json={"site_names": ["BIFI"]})
+    assert response.status_code == 422
+
+
+def test_get_sites_include(site, another_site, images, bifi_summary):
+    with mock.patch.object(site_store, "_sites") as m_sites:
+        m_sites.return_value = [site, another_site]
+        response = client.get(
+            "/sites/",
+            params={"vo_name": "ops", "include": "images,instancetypes"},
+        )
+        assert response.status_code == 200
+        assert response.json() == [
+            dict(
+                bifi_summary,
+                images=[images[0]],
+                instancetypes=[
+                    {
+                        "name": "m1.tiny",
+                        "cpu": 1,
+                        "ram": 512,
+                        "disk": 1,
+                        "accelerator_type": "",
+                        "accelerator_vendor": "",
+                        "accelerator_model": "",
+                        "accelerator_count": 0,
+                    }
+                ],
+            )
+        ]
+        response = client.get(
+            "/sites/",
+            params={"vo_name": "access", "fields": "name,images"},
+        )
+        assert response.json() == [{"name": "FAKE", "images": [images[1]]}]
+        response = client.get("/sites/", params={"include": "foo"})
+        assert response.status_code == 400
+
+
+def test_get_sites_include_projects_of_vo(site, another_site):
+    both = site.model_copy(update={"shares": site.shares + another_site.shares})
+    with mock.patch.object(site_store, "_sites") as m_sites:
+        m_sites.return_value = [both]
+        response = client.get(
+            "/sites/", params={"vo_name": "access", "fields": "name,projects"}
+        )
+        assert response.json() == [
+            {"name": "BIFI", "projects": [{"id": "foobar", "name": "access"}]}
+        ]
+        response = client.get("/sites/", params={"fields": "name,projects"})
+        assert [p["name"] for p in response.json()[0]["projects"]] == [
+            "ops",
+            "access",
+        ]
+
+
+def test_search_images(site, another_site, more_images):
+    with mock.patch.object(site_store, "_sites") as m_sites:
+        m_sites.return_value = [site, another_site]
+        response = client.get("/images/search", params={"q": "fake"})
+        assert response.status_code == 200
+        assert response.json() == [more_images[1]]
+        response = client.get(
+            "/images/search", params={"q": "fake", "only_egi_images": False}
+        )
+        assert response.json() == more_images[1:]
+        response = client.get(
+            "/images/search", params={"egi_id": "egi.small*", "fields": "id"}
+        )
+        assert response.json() == [{"id": more_images[0]["id"]}]
+
+
+def test_get_flavors(site, another_site):
+    gpu_flavor = glue.GlueInstanceType(
+        name="g1.large",
+        cpu=8,
+        ram=32768,
+        disk=40,
+        accelerator_type="GPU",
+        accelerator_count=1,
+    )
+    another_site.shares[0].instancetypes.append(gpu_flavor)
+    with mock.patch.object(site_store, "_sites") as m_sites:
+        m_sites.return_value = [site, another_site]
+        response = client.get("/flavors/", params={"fields": "name,site"})
+        assert response.status_code == 200
+        assert response.json() == [
+            {"name": "m1.small", "site": "FAKE"},
+            {"name": "m1.tiny", "site": "BIFI"},
+            {"name": "g1.large", "site": "FAKE"},
+        ]
+        response = client.get("/flavors/", params={"min_cpu": 8, "gpu": True})
+        assert response.json() == [
+            dict(
+                gpu_flavor.model_dump(),
+                site="FAKE",
+                endpoint="https://example.com/v3",
+                vo="access",
+                project_id="foobar",
+            )
+        ]
+        response = client.get(
+            "/flavors/", params={"vo_name": "ops", "gpu": False, "fields": "name"}
+        )
+        assert response.json() == [{"name": "m1.tiny"}]
+        response = client.get("/flavors/", params={"min_ram": 1024, "gpu": False})
+        assert response.json() == []
+
+
+def test_get_changes(site):
+    generation = site_store.generation
+    with mock.patch.object(site_store, "_sites") as m_sites:
+        m_sites.return_value = [site]
+        response = client.get("/changes/", params={"since": generation})
+        assert response.status_code == 200
+        assert response.json()["generation"] == generation + 1
+        assert response.json()["changes"][0]["sites"]["added"] == ["BIFI"]
+        response = client.get("/changes/", params={"since": generation + 5})
+        assert response.status_code == 410
+
+
+def test_changes_stream():
+    async def first_event():
+        request = mock.MagicMock()
+        request.is_disconnected = mock.AsyncMock(return_value=False)
+        events = _generation_events(request)
+        event = await anext(events)
+        await events.aclose()
+        return event
+
+    generation = site_store.generation
+    assert asyncio.run(first_event()) == (
+        f"id: {generation}\nevent: generation\n"
+        f'data: {{"generation": {generation}}}\n\n'
+    )
+
+
+def test_get_memory(site):
+    assert client.get("/admin/memory").status_code == 404
+    with (
+        mock.patch.object(settings, "admin_token", "secret"),
+        mock.patch.object(site_store, "_sites") as m_sites,
+    ):
+        m_sites.return_value = [site]
+        response = client.get("/admin/memory", headers={"X-Admin-Token": "wrong"})
+        assert response.status_code == 403
+        response = client.get(
+            "/admin/memory?collect=true", headers={"X-Admin-Token": "secret"}
+        )
+    assert response.status_code == 200
+    report = response.json()
+    assert report["by_site"][0]["name"] == "BIFI"
+    assert report["generation"] in report["live_generations"]
+    assert report["reload_diff"] is None
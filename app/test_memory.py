@@ -0,0 +1,55 @@
+"""Testing the memory accounting"""
+
+import gc
+import tracemalloc
+
+from . import glue, memory
+
+
+def test_memory_counter(site):
+    counter = memory.MemoryCounter()
+    size = counter.measure([site, site], "sites")
+    assert counter.objects["GlueSite"] == 1
+    assert counter.objects["GlueImage"] == len(site.shares[0].images)
+    assert size == sum(counter.bytes.values())
+    # already counted
+    assert counter.measure(site, "sites") == 0
+
+
+def test_snapshot_usage(site, another_site):
+    snapshot = glue.SiteSnapshot([site, another_site], generation=4)
+    snapshot.get_images("ops")
+    usage = memory.snapshot_usage(snapshot, top=1)
+    assert usage["generation"] == 4
+    types = {t["name"]: t for t in usage["by_type"]}
+    assert {"GlueSite", "GlueShare", "GlueImage", "SiteSnapshot"} <= set(types)
+    assert types["GlueSite"]["objects"] == 2
+    assert usage["total_bytes"] == sum(t["bytes"] for t in usage["by_type"])
+    assert len(usage["by_site"]) == 1
+    assert usage["by_vo"][0]["bytes"] > 0
+    assert usage["by_cache_entry"][0]["name"] == "('images', 'ops', False)"
+
+
+def test_live_generations(site):
+    snapshot = glue.SiteSnapshot([site], generation=1234)
+    assert 1234 in memory.live_generations()
+    del snapshot
+    gc.collect()
+    assert 1234 not in memory.live_generations()
+
+
+def test_reload_memory_diff():
+    memory_diff = memory.ReloadMemoryDiff()
+    memory_diff.start()
+    try:
+        memory_diff.take(1)
+        assert memory_diff.diff() is None
+        kept = [bytearray(1024) for _ in range(100)]
+        memory_diff.take(2)
+        diff = memory_diff.diff(top=5)
+    finally:
+        tracemalloc.stop()
+    assert (diff["from_generation"], diff["to_generation"]) == (1, 2)
+    assert diff["size_diff"] >= 100 * 1024
+    assert any("test_memory.py" in stat["location"] for stat in diff["top"])
+    del kept
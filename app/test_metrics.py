@@ -0,0 +1,67 @@
+"""Testing the metrics"""
+
+from prometheus_client import REGISTRY, CollectorRegistry
+from starlette.applications import Starlette
+from starlette.responses import JSONResponse
+from starlette.routing import Route
+from starlette.testclient import TestClient
+
+from . import admission, cache, glue, metrics
+
+
+def _requests(route, status="200"):
+    return REGISTRY.get_sample_value(
+        "cloud_info_request_duration_seconds_count",
+        {"method": "GET", "route": route, "status": status},
+    )
+
+
+def test_metrics_middleware():
+    app = Starlette(routes=[Route("/item/{name}", lambda request: JSONResponse("ok"))])
+    app.add_middleware(
+        cache.CachedResponseMiddleware,
+        cache=cache.ResponseCache(),
+        generation=lambda: 0,
+        paths=["/item/"],
+    )
+    app.add_middleware(metrics.MetricsMiddleware, routes=app.router.routes)
+    client = TestClient(app)
+    before = _requests("/item/{name}") or 0
+    client.get("/item/foo")
+    # served from the cache, not routed
+    client.get("/item/foo")
+    client.get("/item/bar")
+    assert _requests("/item/{name}") == before + 3
+    client.get("/nothing")
+    assert _requests("unmatched", "404") >= 1
+
+
+def test_state_collector(site, another_site):
+    site_store = glue.SiteStore()
+    site_store._snapshot = glue.SiteSnapshot([site, another_site], generation=3)
+    site_store._sites = lambda: site_store._snapshot.source
+    response_cache = cache.ResponseCache()
+    response_cache.get(0, "a", route="/sites/")
+    response_cache.get(0, "a", route="/sites/")
+    response_cache.get(0, "b", route="/images/")
+    registry = CollectorRegistry()
+    registry.register(
+        metrics.StateCollector(
+            site_store, response_cache, admission.AdmissionController(limit=1)
+        )
+    )
+    assert registry.get_sample_value("cloud_info_generation") == 3
+    assert registry.get_sample_value("cloud_info_objects", {"kind": "sites"}) == 2
+    assert registry.get_sample_value("cloud_info_objects", {"kind": "shares"}) == 2
+    assert registry.get_sample_value("cloud_info_objects", {"kind": "images"}) == 3
+    assert registry.get_sample_value("cloud_info_quarantined_sites") == 0
+    for route, misses in [("/sites/", 2), ("/images/", 1)]:
+        assert (
+            registry.get_sample_value(
+                "cloud_info_response_cache_requests_total",
+                {"route": route, "result": "miss"},
+            )
+            == misses
+        )
+    assert registry.get_sample_value("cloud_info_active_requests") == 0
+    assert registry.get_sample_value("cloud_info_response_cache_bytes") == 0
@@ -0,0 +1,90 @@
+"""Testing the bounded parsing of the site information"""
+
+import json
+import os
+
+import pytest
+
+from . import parsing
+
+
+def test_decode_limits():
+    parser = parsing.SiteParser(max_size=100, max_objects=3)
+    assert parser.decode('{"Share": [1, 2], "Other": {}}') == {
+        "Share": [1, 2],
+        "Other": {},
+    }
+    with pytest.raises(parsing.SiteFileError, match="Size"):
+        parser.decode(json.dumps({"Share": ["x" * 100]}))
+    with pytest.raises(parsing.SiteFileError, match="4 GLUE objects"):
+        parser.decode('{"Share": [1, 2], "Image": [3, 4]}')
+    with pytest.raises(parsing.SiteFileError, match="Invalid JSON"):
+        parser.decode('{"Share": [1, 2')
+    with pytest.raises(parsing.SiteFileError, match="not a JSON object"):
+        parser.decode("[]")
+    # too deep
+    with pytest.raises(parsing.SiteFileError):
+        parsing.SiteParser().decode("[" * 100000)
+
+
+def test_decode_timeout():
+    # only checked once decoded in the calling thread
+    parser = parsing.SiteParser(timeout=1e-9)
+    with pytest.raises(parsing.SiteFileError, match="Took"):
+        parser.decode("{}")
+
+
+def test_read_file_limit(tmp_path):
+    path = tmp_path / "site.json"
+    path.write_text(json.dumps({"Share": ["x" * 1000]}))
+    assert parsing.SiteParser().read_file(path) == {"Share": ["x" * 1000]}
+    with pytest.raises(parsing.SiteFileError, match="Size"):
+        parsing.SiteParser(max_size=100).read_file(path)
+    # the limit is in bytes, not characters
+    path.write_text(json.dumps({"Share": ["é" * 60]}, ensure_ascii=False))
+    with pytest.raises(parsing.SiteFileError, match="Size"):
+        parsing.SiteParser(max_size=100).read_file(path)
+    path.write_bytes(b'{"Share": ["\xff"]}')
+    with pytest.raises(parsing.SiteFileError, match="Invalid JSON"):
+        parsing.SiteParser().read_file(path)
+
+
+def test_read_files_in_workers(tmp_path):
+    good = tmp_path / "good.json"
+    good.write_text('{"Share": []}')
+    bad = tmp_path / "bad.json"
+    bad.write_text("xxx")
+    # reading a pipe with no writer never ends
+    stuck = str(tmp_path / "stuck.json")
+    os.mkfifo(stuck)
+    other = tmp_path / "other.json"
+    other.write_text('{"Share": [1]}')
+    parser = parsing.SiteParser(timeout=2, workers=1)
+    try:
+        results = parser.read_files([str(good), str(bad), stuck, str(other)])
+    finally:
+        parser.close()
+    assert results[str(good)] == {"Share": []}
+    assert isinstance(results[str(bad)], parsing.SiteFileError)
+    assert "limit of 2 s" in str(results[stuck])
+    # sent again to a new worker
+    assert results[str(other)] == {"Share": [1]}
+
+
+def test_quarantine():
+    quarantine = parsing.Quarantine(after=2)
+    quarantine.failed("a", 1)
+    assert not quarantine.holds("a", 1)
+    quarantine.failed("a", 1)
+    assert quarantine.holds("a", 1)
+    assert quarantine.quarantined() == ["a"]
+    # changed, tried again
+    assert not quarantine.holds("a", 2)
+    quarantine.failed("a", 2)
+    assert not quarantine.holds("a", 2)
+    quarantine.release("a")
+    assert quarantine.quarantined() == []
+    # disabled
+    quarantine = parsing.Quarantine(after=0)
+    quarantine.failed("a", 1)
+    assert not quarantine.holds("a", 1)
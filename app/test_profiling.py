@@ -0,0 +1,147 @@
+"""Testing the profiling"""
+
+import asyncio
+import glob
+import json
+import os
+import pstats
+import time
+
+from starlette.applications import Starlette
+from starlette.responses import JSONResponse
+from starlette.routing import Route
+from starlette.testclient import TestClient
+
+from . import cache, glue, profiling
+
+
+def _busy(seconds):
+    end = time.perf_counter() + seconds
+    while time.perf_counter() < end:
+        pass
+
+
+def _profiles(profiler):
+    profiler.flush()
+    profiles = []
+    for path in sorted(glob.glob(os.path.join(profiler.directory, "*.json"))):
+        with open(path) as f:
+            profiles.append(json.load(f))
+    return profiles
+
+
+def test_profiler_collapsed(tmp_path):
+    profiler = profiling.Profiler(
+        directory=str(tmp_path),
+        reload_sample_rate=1,
+        interval=0.001,
+        generation=lambda: 7,
+    )
+    with profiler.profile("reload", "busy", files=3) as info:
+        assert info is not None
+        _busy(0.05)
+    [profile] = _profiles(profiler)
+    assert profile["kind"] == "reload"
+    assert profile["files"] == 3
+    assert profile["generation"] == 7
+    assert profile["samples"] > 0
+    with open(tmp_path / f"{profile['id']}.collapsed") as f:
+        lines = f.read().splitlines()
+    assert any("_busy (app/test_profiling.py" in line for line in lines)
+    stack, count = lines[0].rsplit(" ", 1)
+    assert int(count) > 0
+
+
+def test_profiler_cprofile(tmp_path):
+    profiler = profiling.Profiler(directory=str(tmp_path), output_format="cprofile")
+    with profiler.profile("request", "/busy", force=True):
+        _busy(0.01)
+    [profile] = _profiles(profiler)
+    stats = pstats.Stats(str(tmp_path / f"{profile['id']}.prof"))
+    assert any(func[2] == "_busy" for func in stats.stats)
+
+
+def test_profiler_bounded(tmp_path):
+    profiler = profiling.Profiler(directory=str(tmp_path), max_files=2)
+    # not sampled
+    with profiler.profile("request", "/") as info:
+        assert info is None
+    with profiler.profile("request", "/", force=True) as info:
+        # only one at a time
+        with profiler.profile("request", "/", force=True) as other:
+            assert other is None
+    assert profiler.skipped == 1
+    for _ in range(3):
+        with profiler.profile("request", "/", force=True):
+            pass
+    profiler.flush()
+    assert profiler.profiles == 4
+    assert len(os.listdir(tmp_path)) == 4
+    # disabled without a directory
+    with profiling.Profiler().profile("request", "/", force=True) as info:
+        assert info is None
+
+
+def test_profiling_middleware(tmp_path):
+    profiler = profiling.Profiler(directory=str(tmp_path), token="secret")
+
+    def endpoint(request):
+        return JSONResponse("ok")
+
+    app = Starlette(routes=[Route("/item/{name}", endpoint)])
+    app.add_middleware(profiling.ProfilingMiddleware, profiler=profiler)
+    client = TestClient(app)
+    assert "x-profile-id" not in client.get("/item/foo").headers
+    response = client.get("/item/foo", headers={"X-Profile": "wrong"})
+    assert "x-profile-id" not in response.headers
+    response = client.get("/item/foo?q=1", headers={"X-Profile": "secret"})
+    [profile] = _profiles(profiler)
+    assert response.headers["x-profile-id"] == profile["id"]
+    assert profile["route"] == "/item/{name}"
+    assert profile["path_params"] == {"name": "foo"}
+    assert profile["query"] == "q=1"
+    assert profile["status"] == 200
+
+
+def test_profiling_middleware_cached(tmp_path):
+    profiler = profiling.Profiler(directory=str(tmp_path), token="secret")
+    calls = []
+
+    def endpoint(request):
+        calls.append(request.url.path)
+        return JSONResponse("ok")
+
+    app = Starlette(routes=[Route("/item/{name}", endpoint)])
+    app.add_middleware(profiling.ProfilingMiddleware, profiler=profiler)
+    app.add_middleware(
+        cache.CachedResponseMiddleware,
+        cache=cache.ResponseCache(),
+        generation=lambda: 0,
+        paths=["/item/"],
+        bypass=profiler.requested,
+    )
+    client = TestClient(app)
+    client.get("/item/foo")
+    # profiled even if cached, and its id is not kept with the response
+    response = client.get("/item/foo", headers={"X-Profile": "secret"})
+    [profile] = _profiles(profiler)
+    assert response.headers["x-profile-id"] == profile["id"]
+    assert "x-profile-id" not in client.get("/item/foo").headers
+    assert len(calls) == 2
+    # sampled requests are cached without their profile id
+    profiler.sample_rates["request"] = 1
+    assert "x-profile-id" not in client.get("/item/bar").headers
+    assert len(_profiles(profiler)) == 2
+    profiler.sample_rates["request"] = 0
+    assert "x-profile-id" not in client.get("/item/bar").headers
+    assert len(calls) == 3
+
+
+def test_site_store_reload_profile(tmp_path):
+    site_store = glue.FileSiteStore(cloud_info_dir=str(tmp_path / "info"))
+    site_store.profiler = profiling.Profiler(
+        directory=str(tmp_path / "profiles"), reload_sample_rate=1
+    )
+    asyncio.run(site_store._load_sites())
+    [profile] = _profiles(site_store.profiler)
+    assert profile["name"] == "_load_sites"
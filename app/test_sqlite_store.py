@@ -0,0 +1,120 @@
+"""Testing the SQLite site store"""
+
+import asyncio
+from unittest import mock
+
+from . import glue, sqlite_store
+
+
+def test_sqlite_snapshot(tmp_path, site, another_site):
+    db = str(tmp_path / "sites.db")
+    sites = [site, another_site]
+    sqlite_store.write_sites_db(db, sites, 3)
+    snapshot = sqlite_store.SQLiteSnapshot(db)
+    expected = glue.SiteSnapshot(sites)
+    assert snapshot.generation == 3
+    assert snapshot.get_sites() == sites
+    assert snapshot.get_sites("access") == [another_site]
+    assert snapshot.get_sites("foo") == []
+    assert snapshot.get_site_by_name("BIFI") == site
+    assert snapshot.get_site_by_name("foo") is None
+    assert snapshot.get_site_by_goc_id(another_site.gocdb_id) == another_site
+    assert snapshot.vo_names() == ["ops", "access"]
+    for vo_name in ["", "ops", "access"]:
+        for flag in (True, False):
+            assert [i for _, i in snapshot.get_images(vo_name, flag)] == [
+                i for _, i in expected.get_images(vo_name, flag)
+            ]
+            assert [
+                (s.url, share.project_id, it)
+                for s, share, it in snapshot.get_flavors(vo_name, flag)[1]
+            ] == [
+                (s.url, share.project_id, it)
+                for s, share, it in expected.get_flavors(vo_name, flag)[1]
+            ]
+    assert [f[2].name for f in snapshot.find_flavors(min_cpu=1)] == ["m1.tiny"]
+
+
+def test_sqlite_snapshot_no_details(tmp_path, site):
+    db = str(tmp_path / "sites.db")
+    sqlite_store.write_sites_db(db, [site], 1)
+    snapshot = sqlite_store.SQLiteSnapshot(db)
+    (summary,) = snapshot.get_sites("ops", details=False)
+    assert summary.summary(include_projects=True) == site.summary(include_projects=True)
+    assert summary.vo_share("ops").images == []
+    assert snapshot.get_sites("ops") == [site]
+
+
+def test_sqlite_snapshot_unknown_vo_not_cached(tmp_path, site):
+    db = str(tmp_path / "sites.db")
+    sqlite_store.write_sites_db(db, [site], 1)
+    snapshot = sqlite_store.SQLiteSnapshot(db)
+    snapshot.get_sites("unknown")
+    keys = [key for key, _ in snapshot.cached_items()]
+    for i in range(10):
+        assert snapshot.get_sites(f"unknown{i}") == []
+    assert [key for key, _ in snapshot.cached_items()] == keys
+
+
+def test_sqlite_snapshot_bounded_cache(tmp_path, site):
+    db = str(tmp_path / "sites.db")
+    sqlite_store.write_sites_db(db, [site], 1)
+    snapshot = sqlite_store.SQLiteSnapshot(db, cache_bytes=25000)
+    for key in "abc":
+        snapshot.cached(key, lambda: b"x" * 10000)
+    assert [key for key, _ in snapshot.cached_items()] == ["b", "c"]
+    assert snapshot._cache_used < 25000
+    assert snapshot.cached("a", lambda: "new a") == "new a"
+    # larger than the whole cache, still kept until something else is
+    snapshot.cached("d", lambda: b"x" * 30000)
+    assert [key for key, _ in snapshot.cached_items()] == ["d"]
+
+
+def test_sqlite_snapshot_site_by_name_cached(tmp_path, site):
+    db = str(tmp_path / "sites.db")
+    sqlite_store.write_sites_db(db, [site], 1)
+    snapshot = sqlite_store.SQLiteSnapshot(db)
+    assert not snapshot.warm_every_vo
+    with mock.patch.object(
+        snapshot, "_load_sites", wraps=snapshot._load_sites
+    ) as m_load_sites:
+        assert snapshot.get_site_by_name("BIFI") == site
+        assert snapshot.get_site_by_name("BIFI") == site
+        assert m_load_sites.call_count == 1
+
+
+def test_sqlite_snapshot_isolation(tmp_path, site, another_site):
+    db = str(tmp_path / "sites.db")
+    sqlite_store.write_sites_db(db, [site], 1)
+    snapshot = sqlite_store.SQLiteSnapshot(db)
+    sqlite_store.write_sites_db(db, [another_site], 2)
+    assert snapshot.get_site_by_name("BIFI") == site
+    assert snapshot.get_site_by_name("FAKE") is None
+    assert sqlite_store.SQLiteSnapshot(db).get_sites() == [another_site]
+
+
+def test_sqlite_site_store(tmp_path, site, another_site):
+    db = str(tmp_path / "sites.db")
+    writer = sqlite_store.SQLiteSiteStore(sqlite_db=db)
+    reader = sqlite_store.SQLiteSiteStore(sqlite_db=db, sqlite_readonly=True)
+    assert reader.get_sites() == []
+    writer._site_files = {"bifi": site}
+    asyncio.run(writer._publish_sites())
+    assert writer.get_sites() == [site]
+    asyncio.run(reader._publish(None))
+    assert reader.generation == writer.generation
+    assert reader.get_sites() == [site]
+    # nothing new, nothing published
+    generation = reader.generation
+    asyncio.run(reader._publish(None))
+    assert reader.generation == generation
+    writer._site_files["fake"] = another_site
+    asyncio.run(writer._publish_sites())
+    asyncio.run(reader._publish(None))
+    assert reader.get_sites() == [site, another_site]
+    assert [c.sites.added for c in reader.get_changes(generation)] == [["FAKE"]]
+    # a new writer keeps counting from the database generation
+    new_writer = sqlite_store.SQLiteSiteStore(sqlite_db=db)
+    asyncio.run(new_writer._load_db())
+    assert new_writer.generation == writer.generation
+    assert new_writer.get_sites() == [site, another_site]
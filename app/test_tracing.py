@@ -0,0 +1,70 @@
+"""Testing the reload tracing"""
+
+import asyncio
+import json
+import logging
+import time
+from unittest import mock
+
+from . import glue, tracing
+
+
+def test_reload_trace_phases():
+    reload_trace = tracing.ReloadTrace("file", "load", slowest=2)
+    with reload_trace.phase("outer"):
+        time.sleep(0.02)
+        with reload_trace.phase("inner"):
+            time.sleep(0.02)
+    for name, elapsed in [("a", 0.1), ("b", 0.3), ("c", 0.2)]:
+        reload_trace.item(name, elapsed)
+    reload_trace.finish()
+    record = reload_trace.record()
+    # the nested phase is not counted in the outer one
+    assert 20 <= record["phases_ms"]["outer"] < 40
+    assert 20 <= record["phases_ms"]["inner"] < 40
+    assert [item["name"] for item in record["slowest"]] == ["b", "c"]
+
+
+def test_tracing_helpers():
+    # nothing to do outside a reload
+    with tracing.phase("scan"):
+        tracing.count("files")
+
+    async def reload():
+        with tracing.trace("file", "load") as reload_trace:
+            # the trace follows the work to the worker threads
+            await asyncio.to_thread(tracing.count, "files", 2)
+            with tracing.item("site.json"):
+                pass
+        return reload_trace
+
+    reload_trace = asyncio.run(reload())
+    assert reload_trace.counts == {"files": 2}
+    assert reload_trace.record()["slowest"][0]["name"] == "site.json"
+    assert tracing.current() is None
+
+
+def test_file_site_store_trace(tmp_path, site_info_json, caplog):
+    (tmp_path / "bifi.json").write_text(site_info_json)
+    (tmp_path / "broken.json").write_text("{")
+    site_store = glue.FileSiteStore(
+        cloud_info_dir=str(tmp_path), check_glue_validity=False
+    )
+    with (
+        mock.patch("app.glue.SiteStore._get_gocdb_hostname", return_value="foo"),
+        caplog.at_level(logging.INFO, logger="app.tracing"),
+    ):
+        asyncio.run(site_store._load_sites())
+    [record] = [
+        json.loads(r.message) for r in caplog.records if r.name == "app.tracing"
+    ]
+    assert record["store"] == "file"
+    assert record["operation"] == "load"
+    assert record["generation"] == site_store.generation
+    assert record["sites"] == 1
+    assert record["counts"] == {"files_listed": 2, "files_read": 2, "files_failed": 1}
+    assert {"scan", "read", "decode", "create_site", "gocdb", "cleanup"} <= set(
+        record["phases_ms"]
+    )
+    assert {"snapshot", "warm", "diff", "swap"} <= set(record["phases_ms"])
+    assert len(record["slowest"]) == 2
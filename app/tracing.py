@@ -0,0 +1,150 @@
+"""
+Tracing of the reloads of the site information
+
+Every reload runs within a ReloadTrace that collects how long each of its
+phases took (scanning, reading, decoding, validity checks, building the
+sites, GOCDB lookups, clean up and publishing), how many items went through
+them and the slowest files. When done, the trace is logged as a single JSON
+record by the app.tracing logger.
+
+The current trace is kept in a context variable, so the helpers of this
+module can be used anywhere in the reload, including the worker threads
+started with asyncio.to_thread, and do nothing outside of a reload.
+"""
+
+import contextlib
+import contextvars
+import heapq
+import json
+import logging
+import threading
+import time
+from collections import Counter
+
+logger = logging.getLogger(__name__)
+_current = contextvars.ContextVar("reload_trace", default=None)
+
+
+class ReloadTrace:
+    """
+    Times the phases of a reload. Nested phases are not counted in their
+    parent, so the phases add up to the time spent in them
+    """
+
+    def __init__(self, store, operation, slowest=5):
+        self.store = store
+        self.operation = operation
+        self.slowest = slowest
+        self.phases = Counter()
+        self.counts = Counter()
+        self.attributes = {}
+        self._items = []
+        self._lock = threading.Lock()
+        self._stacks = threading.local()
+        self.started = time.time()
+        self._start = time.perf_counter()
+        self.duration = None
+
+    def _stack(self):
+        if not hasattr(self._stacks, "children"):
+            # time taken by the nested phases of every running phase
+            self._stacks.children = []
+        return self._stacks.children
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        stack = self._stack()
+        stack.append(0.0)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            nested = stack.pop()
+            if stack:
+                stack[-1] += elapsed
+            with self._lock:
+                self.phases[name] += elapsed - nested
+
+    def count(self, name, n=1):
+        with self._lock:
+            self.counts[name] += n
+
+    def item(self, name, elapsed):
+        """Records the time taken by an item, e.g. a file, keeping the
+        slowest ones"""
+        with self._lock:
+            entry = (elapsed, name)
+            if len(self._items) < self.slowest:
+                heapq.heappush(self._items, entry)
+            else:
+                heapq.heappushpop(self._items, entry)
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def finish(self):
+        self.duration = time.perf_counter() - self._start
+
+    def record(self):
+        return {
+            "event": "reload",
+            "store": self.store,
+            "operation": self.operation,
+            "started": self.started,
+            "duration_ms": round((self.duration or 0) * 1000, 3),
+            "phases_ms": {
+                name: round(elapsed * 1000, 3)
+                for name, elapsed in self.phases.most_common()
+            },
+            "counts": dict(self.counts),
+            "slowest": [
+                {"name": name, "duration_ms": round(elapsed * 1000, 3)}
+                for elapsed, name in sorted(self._items, reverse=True)
+            ],
+            **self.attributes,
+        }
+
+
+@contextlib.contextmanager
+def trace(store, operation):
+    """Traces a reload, logging its record when done"""
+    reload_trace = ReloadTrace(store, operation)
+    token = _current.set(reload_trace)
+    try:
+        yield reload_trace
+    finally:
+        _current.reset(token)
+        reload_trace.finish()
+        logger.info(json.dumps(reload_trace.record()))
+
+
+def current():
+    return _current.get()
+
+
+def phase(name):
+    reload_trace = _current.get()
+    if reload_trace is None:
+        return contextlib.nullcontext()
+    return reload_trace.phase(name)
+
+
+def count(name, n=1):
+    reload_trace = _current.get()
+    if reload_trace is not None:
+        reload_trace.count(name, n)
+
+
+@contextlib.contextmanager
+def item(name):
+    """Times an item of the reload, e.g. a file"""
+    reload_trace = _current.get()
+    if reload_trace is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        reload_trace.item(name, time.perf_counter() - start)
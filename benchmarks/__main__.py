@@ -0,0 +1,34 @@
+"""
+Runs the whole benchmark suite on the same generated federation
+
+    python -m benchmarks --sites 200 --vos 10 --images 50 --output results.json
+    python -m benchmarks.compare baseline.json results.json
+"""
+
+import argparse
+import asyncio
+import json
+
+from . import load, routes, startup
+from .common import environment, federation
+
+parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+load.add_arguments(parser)
+parser.add_argument("--requests", type=int, default=2000)
+parser.add_argument("--concurrency", type=int, default=64)
+parser.add_argument(
+    "--cached", action="store_true", help="keep the response cache enabled"
+)
+parser.add_argument("--output", help="write the results as JSON to this file")
+args = parser.parse_args()
+with federation(args) as directory:
+    results = {
+        "environment": environment(),
+        "args": vars(args),
+        "load": asyncio.run(load.run(directory, args)),
+        "routes": asyncio.run(routes.run(directory, args)),
+        "startup": startup.run(directory, args),
+    }
+if args.output:
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
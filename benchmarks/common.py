@@ -0,0 +1,151 @@
+"""Helpers shared by the benchmarks"""
+
+import contextlib
+import logging
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from app.glue import FileSiteStore
+
+from . import fakes, generator
+
+# the stores log every failure of the upstream services, expected with faults
+logging.disable(logging.CRITICAL)
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def summarize(latencies, elapsed, operations=None):
+    """Summarizes the latencies (in seconds) of operations that took elapsed
+    seconds overall"""
+    operations = len(latencies) if operations is None else operations
+    return {
+        "operations": operations,
+        "throughput": operations / elapsed if elapsed else None,
+        "mean_ms": statistics.fmean(latencies) * 1000,
+        "p50_ms": percentile(latencies, 0.5) * 1000,
+        "p90_ms": percentile(latencies, 0.9) * 1000,
+        "p99_ms": percentile(latencies, 0.99) * 1000,
+        "p999_ms": percentile(latencies, 0.999) * 1000,
+        "max_ms": max(latencies) * 1000,
+    }
+
+
+@contextlib.contextmanager
+def peak_memory(result):
+    """Traces the allocations of the block, storing in result the peak and the
+    memory still allocated at the end, in MB. Tracing slows everything down
+    so it's meant to be used in a separate pass from the timings"""
+    tracemalloc.start()
+    try:
+        yield result
+    finally:
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        result["peak_mb"] = peak / 2**20
+        result["retained_mb"] = current / 2**20
+
+
+def add_upstream_arguments(parser):
+    parser.add_argument(
+        "--upstream-latency", type=float, default=0, help="seconds per request"
+    )
+    parser.add_argument("--upstream-jitter", type=float, default=0)
+    parser.add_argument("--upstream-error-rate", type=float, default=0)
+    parser.add_argument("--upstream-timeout-rate", type=float, default=0)
+    parser.add_argument(
+        "--upstream-timeout", type=float, default=5, help="read timeout of clients"
+    )
+
+
+def upstream_faults(args):
+    """Gets the settings of the fake upstream services from args"""
+    return dict(
+        latency=args.upstream_latency,
+        jitter=args.upstream_jitter,
+        error_rate=args.upstream_error_rate,
+        timeout_rate=args.upstream_timeout_rate,
+        seed=args.seed,
+    )
+
+
+def fake_gocdb(args):
+    """Gets a GOCDB with the endpoints of the generated federation"""
+    return fakes.FakeGOCDB(
+        generator.gocdb_endpoints(args.sites, args.duplicates),
+        **upstream_faults(args),
+    )
+
+
+def configure_store(store, args, *services):
+    """Makes the site store use the fake GOCDB of the generated federation,
+    and the other fake services"""
+    store.gocdb_url = fakes.FakeGOCDB.URL
+    store.httpx_client = fakes.client(
+        fake_gocdb(args), *services, timeout=args.upstream_timeout
+    )
+    return store
+
+
+def make_store(directory, args):
+    return configure_store(FileSiteStore(cloud_info_dir=directory), args)
+
+
+@contextlib.contextmanager
+def federation(args):
+    """Writes a federation as configured in args to a temporary directory"""
+    with tempfile.TemporaryDirectory(prefix="cloud-info-bench-") as directory:
+        start = time.perf_counter()
+        paths = generator.write_federation(
+            directory,
+            args.sites,
+            args.vos,
+            args.images,
+            args.duplicates,
+            args.accelerated,
+            args.seed,
+        )
+        size = sum(os.path.getsize(path) for path in paths)
+        print(
+            f"Generated {len(paths)} files, {size / 2**20:.1f} MB "
+            f"in {time.perf_counter() - start:.1f} s"
+        )
+        yield directory
+
+
+def environment():
+    """Describes where the benchmarks ran, so results can be compared"""
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "HEAD"], capture_output=True, text=True
+        ).stdout.strip()
+    except OSError:
+        commit = ""
+    return {
+        "python": sys.version,
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "commit": commit,
+        "date": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+    }
+
+
+def print_result(name, result):
+    line = f"{name:50} {result['throughput'] or 0:9.1f} ops/s"
+    line += f" p50 {result['p50_ms']:8.2f} ms p99 {result['p99_ms']:8.2f} ms"
+    if "p999_ms" in result:
+        line += f" p999 {result['p999_ms']:8.2f} ms"
+    if "peak_mb" in result:
+        line += f" peak {result['peak_mb']:7.1f} MB"
+    if result.get("errors"):
+        line += f" errors {result['errors']}"
+    print(line)
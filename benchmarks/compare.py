@@ -0,0 +1,49 @@
+"""
+Compares the results of two benchmark runs
+
+    python -m benchmarks.compare baseline.json results.json
+"""
+
+import argparse
+import json
+
+
+def _results(data):
+    results = {f"load {name}": r for name, r in data.get("load", {}).items()}
+    for r in data.get("routes", []):
+        results[f"{r['method']} {r['url']}"] = r
+    for name, r in data.get("traffic", {}).items():
+        results[f"traffic {name}"] = r
+    for name, r in data.get("startup", {}).items():
+        if isinstance(r, dict):
+            results[f"startup {name}"] = r
+    return results
+
+
+def _change(old, new):
+    if not old or new is None:
+        return "     -"
+    return f"{(new - old) / old * 100:+6.1f}%"
+
+
+def compare(baseline, results, metrics=("throughput", "p50_ms", "p99_ms", "peak_mb")):
+    old_results = _results(baseline)
+    for name, new in _results(results).items():
+        old = old_results.get(name)
+        if old is None:
+            continue
+        changes = [f"{m} {_change(old.get(m), new.get(m))}" for m in metrics]
+        print(f"{name:60} {'  '.join(changes)}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("baseline")
+    parser.add_argument("results")
+    args = parser.parse_args()
+    with open(args.baseline) as f, open(args.results) as g:
+        runs = baseline, results = json.load(f), json.load(g)
+    settings = [{k: v for k, v in r["args"].items() if k != "output"} for r in runs]
+    if settings[0] != settings[1]:
+        print("Warning: the runs used different arguments")
+    compare(baseline, results)
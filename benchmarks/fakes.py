@@ -0,0 +1,293 @@
+"""
+In-process stand-ins for the upstream services
+
+Fake Operations Portal, GOCDB and Swift/S3 services speaking the same formats
+as the real ones, to be used as the transport of the httpx clients of the
+stores. Every service can add latency, fail or time out a share of the
+requests, and inflate its responses, to see how upstream problems affect
+the API without any network access:
+
+    s3 = FakeS3({"site.json": info}, latency=0.2, error_rate=0.1)
+    gocdb = FakeGOCDB([("1234G0", "cloud.example.com", "SITE")])
+    site_store = S3SiteStore(
+        s3_url=FakeS3.URL,
+        gocdb_url=FakeGOCDB.URL,
+        httpx_client=client(s3, gocdb),
+    )
+
+They can also be served over HTTP on localhost with serve(), e.g. for an API
+running in another process.
+"""
+
+import contextlib
+import datetime
+import http.server
+import json
+import random
+import threading
+import time
+from http import HTTPStatus
+from xml.sax.saxutils import escape
+
+import httpx
+
+
+class FakeService:
+    """
+    Base of the fake services, subclasses implement handle(request).
+
+    Every request waits latency seconds plus up to jitter more, and
+    len(response) / bandwidth if bandwidth (bytes per second) is set. A
+    share error_rate of requests gets a 503 and a share timeout_rate waits
+    for the read timeout of the client (or hang seconds, if shorter) and
+    raises httpx.ReadTimeout. padding adds that many bytes of whitespace to
+    the responses. The random choices only depend on seed
+    """
+
+    URL = "https://example.com"
+
+    def __init__(
+        self,
+        latency=0,
+        jitter=0,
+        bandwidth=None,
+        error_rate=0,
+        timeout_rate=0,
+        hang=60,
+        padding=0,
+        seed=0,
+        sleep=time.sleep,
+    ):
+        self.latency = latency
+        self.jitter = jitter
+        self.bandwidth = bandwidth
+        self.error_rate = error_rate
+        self.timeout_rate = timeout_rate
+        self.hang = hang
+        self.padding = padding
+        self.sleep = sleep
+        self.requests = 0
+        self.errors = 0
+        self.timeouts = 0
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def handle(self, request):
+        raise NotImplementedError
+
+    def _response(self, content, media_type):
+        if isinstance(content, str):
+            content = content.encode()
+        return httpx.Response(
+            HTTPStatus.OK,
+            content=content + b" " * self.padding,
+            headers={"content-type": media_type},
+        )
+
+    def _client_timeout(self, request):
+        timeout = request.extensions.get("timeout", {}).get("read")
+        return self.hang if timeout is None else min(timeout, self.hang)
+
+    def __call__(self, request):
+        # the stores use their clients from worker threads
+        with self._lock:
+            self.requests += 1
+            draw = self._random.random()
+            delay = self.latency + self._random.uniform(0, self.jitter)
+        if draw < self.timeout_rate:
+            with self._lock:
+                self.timeouts += 1
+            self.sleep(self._client_timeout(request))
+            raise httpx.ReadTimeout("Timed out by the fake service", request=request)
+        if draw < self.timeout_rate + self.error_rate:
+            with self._lock:
+                self.errors += 1
+            self.sleep(delay)
+            return httpx.Response(HTTPStatus.SERVICE_UNAVAILABLE)
+        response = self.handle(request)
+        if self.bandwidth:
+            delay += len(response.content) / self.bandwidth
+        self.sleep(delay)
+        return response
+
+
+def fake_vo(serial, name, disciplines=()):
+    """Gets a VO as listed by the Operations Portal"""
+    return {
+        "serial": str(serial),
+        "status": "Production",
+        "name": name,
+        "scope": "Global",
+        "homeUrl": f"https://{name}/",
+        "members": "0.0",
+        "membersTotal": "0.0",
+        "disciplines": [{"id": d} for d in disciplines],
+        "Vo": [],
+    }
+
+
+class FakeOpsPortal(FakeService):
+    """
+    Operations Portal listing the VOs, either the given names or vos
+    generated ones, each in one of the disciplines in turn, if any. If token
+    is set, requests need it as their X-API-Key
+    """
+
+    URL = "https://operations-portal.example.com/api/vo-list/json"
+
+    def __init__(self, vos=10, token=None, disciplines=(), **kwargs):
+        super().__init__(**kwargs)
+        if isinstance(vos, int):
+            vos = [f"vo{v}.example.eu" for v in range(vos)]
+        self.vos = list(vos)
+        self.token = token
+        self.disciplines = list(disciplines)
+
+    def handle(self, request):
+        if self.token and request.headers.get("X-API-Key") != self.token:
+            return httpx.Response(HTTPStatus.UNAUTHORIZED)
+        data = [
+            fake_vo(
+                serial,
+                name,
+                (
+                    [self.disciplines[serial % len(self.disciplines)]]
+                    if self.disciplines
+                    else []
+                ),
+            )
+            for serial, name in enumerate(self.vos, 1)
+        ]
+        return self._response(json.dumps({"data": data}), "application/json")
+
+
+class FakeGOCDB(FakeService):
+    """GOCDB with the given (gocdb_id, hostname, site name) endpoints"""
+
+    URL = "https://gocdb.example.com"
+
+    def __init__(self, endpoints=(), **kwargs):
+        super().__init__(**kwargs)
+        self.endpoints = list(endpoints)
+
+    def handle(self, request):
+        if request.url.params.get("method") != "get_service":
+            return httpx.Response(HTTPStatus.BAD_REQUEST)
+        items = [
+            f'<SERVICE_ENDPOINT PRIMARY_KEY="{escape(gocdb_id)}">'
+            f"<PRIMARY_KEY>{escape(gocdb_id)}</PRIMARY_KEY>"
+            f"<HOSTNAME>{escape(hostname)}</HOSTNAME>"
+            "<SERVICE_TYPE>org.openstack.nova</SERVICE_TYPE>"
+            f"<SITENAME>{escape(site_name)}</SITENAME>"
+            "</SERVICE_ENDPOINT>"
+            for gocdb_id, hostname, site_name in self.endpoints
+        ]
+        xml = (
+            '<?xml version="1.0" encoding="UTF-8"?>\n'
+            f"<results>{''.join(items)}</results>"
+        )
+        return self._response(xml, "application/xml")
+
+
+class FakeS3(FakeService):
+    """
+    Swift/S3 container with the JSON listing at its URL and every object
+    below it. objects maps the names to their content, either bytes or
+    something to dump as JSON. Use put and delete to change them
+    """
+
+    URL = "https://s3.example.com/info/"
+
+    def __init__(self, objects=None, **kwargs):
+        super().__init__(**kwargs)
+        self.objects = {}
+        # every change gets a later modification time, one second apart
+        self._modified = datetime.datetime(2025, 1, 1, tzinfo=datetime.UTC)
+        for name, content in (objects or {}).items():
+            self.put(name, content)
+
+    def put(self, name, content):
+        if not isinstance(content, bytes):
+            content = json.dumps(content).encode()
+        self._modified += datetime.timedelta(seconds=1)
+        self.objects[name] = (content, self._modified.isoformat())
+
+    def delete(self, name):
+        self.objects.pop(name, None)
+
+    def handle(self, request):
+        prefix = httpx.URL(self.URL).path
+        name = request.url.path.removeprefix(prefix)
+        if not name:
+            listing = [
+                {
+                    "name": name,
+                    "bytes": len(content),
+                    "content_type": "application/json",
+                    "last_modified": last_modified,
+                }
+                for name, (content, last_modified) in sorted(self.objects.items())
+            ]
+            return self._response(json.dumps(listing), "application/json")
+        if name not in self.objects:
+            return httpx.Response(HTTPStatus.NOT_FOUND)
+        return self._response(self.objects[name][0], "application/json")
+
+
+def transport(*services):
+    """Gets a transport sending the requests to the service with the host of
+    their URL"""
+    hosts = {httpx.URL(service.URL).host: service for service in services}
+
+    def handler(request):
+        service = hosts.get(request.url.host)
+        if service is None:
+            raise httpx.ConnectError(f"Unknown host {request.url.host}")
+        return service(request)
+
+    return httpx.MockTransport(handler)
+
+
+def client(*services, **kwargs):
+    """Gets an httpx client for the services, kwargs are passed to it"""
+    return httpx.Client(transport=transport(*services), **kwargs)
+
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        service = self.server.service
+        request = httpx.Request(
+            self.command,
+            httpx.URL(service.URL).copy_with(raw_path=self.path.encode()),
+            headers=dict(self.headers),
+        )
+        try:
+            response = service(request)
+        except httpx.TimeoutException:
+            # never answered
+            self.close_connection = True
+            return
+        self.send_response(response.status_code)
+        for header in ("content-type", "content-length"):
+            if header in response.headers:
+                self.send_header(header, response.headers[header])
+        self.end_headers()
+        self.wfile.write(response.content)
+
+    def log_message(self, format, *args):
+        return
+
+
+@contextlib.contextmanager
+def serve(service, host="127.0.0.1", port=0):
+    """Serves the service over HTTP from a thread, yielding the URL to use
+    instead of its URL"""
+    server = http.server.ThreadingHTTPServer((host, port), _Handler)
+    server.service = service
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield f"http://{host}:{server.server_port}{httpx.URL(service.URL).path}"
+    finally:
+        server.shutdown()
+        server.server_close()
@@ -0,0 +1,250 @@
+"""
+Generator of synthetic federations
+
+Creates the GLUE JSON of sites, as published by cloud-info-provider, with the
+given number of VO shares, images and instance types per site, some sites
+published by several endpoints and some instance types with accelerators.
+Apart from the creation time, i.e. when it is generated, the output only
+depends on the arguments, so runs can be compared.
+
+    python -m benchmarks.generator cloud-info --sites 100 --vos 10 --images 50
+"""
+
+import argparse
+import json
+import os
+import random
+from datetime import datetime, timezone
+
+OS_VERSIONS = [
+    ("ubuntu", "22.04"),
+    ("ubuntu", "24.04"),
+    ("almalinux", "9"),
+    ("debian", "12"),
+    ("rocky", "9"),
+]
+ACCELERATORS = [
+    ("GPU", "NVIDIA", "Tesla V100"),
+    ("GPU", "NVIDIA", "A100"),
+    ("GPU", "AMD", "MI250"),
+]
+
+
+def vo_name(v):
+    return f"vo{v}.example.eu"
+
+
+def site_name(i):
+    return f"SITE-{i}"
+
+
+def gocdb_id(i, endpoint=0):
+    return f"{1000 + i * 10 + endpoint}G0"
+
+
+def hostname(i, endpoint=0):
+    return f"cloud{endpoint}.site-{i}.example.com"
+
+
+def creation_time():
+    # still valid for the hour after being generated
+    return datetime.now(timezone.utc).replace(microsecond=0).isoformat()
+
+
+def _glue(entity_id, **attrs):
+    return dict(ID=entity_id, Validity=3600, CreationTime=creation_time(), **attrs)
+
+
+def site_info(i, endpoint=0, vos=5, images=20, accelerated=0.1, seed=0):
+    """Gets the GLUE information of the endpoint of site i"""
+    rng = random.Random(f"{seed}-{i}-{endpoint}")
+    url = f"https://{hostname(i, endpoint)}:5000/v3"
+    service_id = f"{url}_cloud.compute"
+    endpoint_id = f"{url}_OpenStack_v3_oidc"
+    manager_id = f"{url}_cloud.compute_manager"
+    associations = {
+        "CloudComputingEndpoint": [endpoint_id],
+        "CloudComputingManager": [manager_id],
+    }
+    info = {
+        "CloudComputingService": [
+            _glue(
+                service_id,
+                Name=f"Cloud Compute service at {site_name(i)}",
+                OtherInfo={
+                    "gocdb_id": gocdb_id(i, endpoint),
+                    "site_name": site_name(i),
+                },
+                Associations={"AdminDomain": [site_name(i)]},
+                Type="org.cloud.iaas",
+                QualityLevel="production",
+            )
+        ],
+        "CloudComputingManager": [
+            _glue(
+                manager_id,
+                Associations={"CloudComputingService": [service_id]},
+                InstanceMaxCPU=64,
+                InstanceMaxRAM=262144,
+            )
+        ],
+        "CloudComputingEndpoint": [
+            _glue(
+                endpoint_id,
+                Associations={"CloudComputingService": [service_id]},
+                InterfaceName="org.openstack.nova",
+                Authentication="oidc",
+                URL=url,
+            )
+        ],
+        "CloudComputingImage": [],
+        "CloudComputingInstanceType": [],
+        "CloudComputingVirtualAccelerator": [],
+        "Share": [],
+        "MappingPolicy": [],
+        "AccessPolicy": [],
+    }
+    accelerators = []
+    for a, (acc_type, vendor, model) in enumerate(ACCELERATORS):
+        acc_id = f"{url}_accelerator_{a}"
+        accelerators.append(acc_id)
+        info["CloudComputingVirtualAccelerator"].append(
+            _glue(acc_id, Type=acc_type, Vendor=vendor, Model=model, Number=1 + a)
+        )
+    # every site supports a different set of VOs
+    vo_ids = sorted(rng.sample(range(vos * 2), vos))
+    for v in vo_ids:
+        project_id = f"{rng.getrandbits(128):032x}"
+        share_id = f"{endpoint_id}_share_{vo_name(v)}_{project_id}"
+        info["Share"].append(
+            _glue(
+                share_id,
+                Name=f"{vo_name(v)} - {project_id} share",
+                Associations={
+                    "CloudComputingService": [service_id],
+                    "CloudComputingEndpoint": [endpoint_id],
+                },
+                ProjectID=project_id,
+            )
+        )
+        info["MappingPolicy"].append(
+            _glue(
+                f"{share_id}_Policy",
+                Associations={"Share": [share_id], "PolicyUserDomain": [vo_name(v)]},
+                Rule=[f"VO:{vo_name(v)}"],
+            )
+        )
+        for k in range(images):
+            os_name, os_version = OS_VERSIONS[k % len(OS_VERSIONS)]
+            egi = k % 4 != 3
+            image = _glue(
+                f"{rng.getrandbits(128):032x}",
+                Name=(
+                    f"{'EGI ' if egi else ''}{os_name.capitalize()} {os_version} "
+                    f"image {k} [{os_name.capitalize()}/{os_version}/KVM]"
+                ),
+                Associations=dict(associations, Share=[share_id]),
+                OSName=os_name,
+                OSVersion=os_version,
+                OtherInfo={"base_mpuri": "dontcare"},
+            )
+            if egi:
+                image["MarketplaceURL"] = (
+                    f"registry.egi.eu/egi_vm_images/{os_name}:{os_version}-{k}"
+                )
+                image["OtherInfo"]["eu.egi.cloud.tag"] = f"2025.01.{k % 28 + 1:02}"
+            info["CloudComputingImage"].append(image)
+        for c in (1, 2, 4, 8, 16):
+            instancetype = _glue(
+                f"{share_id}_m1.{c}",
+                Name=f"m1.{c}",
+                Associations=dict(associations, Share=[share_id]),
+                CPU=c,
+                RAM=c * 2048,
+                Disk=c * 10,
+            )
+            if rng.random() < accelerated:
+                instancetype["Name"] = f"g1.{c}"
+                instancetype["Associations"]["CloudComputingVirtualAccelerator"] = (
+                    rng.choice(accelerators)
+                )
+            info["CloudComputingInstanceType"].append(instancetype)
+        info["AccessPolicy"].append(
+            _glue(
+                f"{endpoint_id}_policy_{vo_name(v)}",
+                Associations={"CloudComputingEndpoint": [endpoint_id]},
+                Rule=[f"VO:{vo_name(v)}"],
+            )
+        )
+    return info
+
+
+def endpoints(sites, duplicates=0.05):
+    """Gets the (site, endpoint) of the federation, duplicates is the share of
+    sites with a second endpoint publishing under the same site name, spread
+    evenly among them"""
+    n_duplicated = round(sites * duplicates)
+    duplicated = set(range(0, sites, sites // n_duplicated)) if n_duplicated else ()
+    return [
+        (i, endpoint)
+        for i in range(sites)
+        for endpoint in range(2 if i in duplicated else 1)
+    ]
+
+
+def write_federation(
+    directory, sites=100, vos=5, images=20, duplicates=0.05, accelerated=0.1, seed=0
+):
+    """Writes the GLUE JSON of every endpoint to directory, returns the paths"""
+    os.makedirs(directory, exist_ok=True)
+    paths = []
+    for i, endpoint in endpoints(sites, duplicates):
+        path = os.path.join(directory, f"{site_name(i)}-{endpoint}.json")
+        with open(path, "w") as f:
+            json.dump(site_info(i, endpoint, vos, images, accelerated, seed), f)
+        paths.append(path)
+    return paths
+
+
+def gocdb_endpoints(sites, duplicates=0.05):
+    """Gets the (gocdb_id, hostname, site name) of the endpoints in GOCDB"""
+    return [
+        (gocdb_id(i, e), hostname(i, e), site_name(i))
+        for i, e in endpoints(sites, duplicates)
+    ]
+
+
+def add_arguments(parser):
+    parser.add_argument("--sites", type=int, default=100)
+    parser.add_argument("--vos", type=int, default=5, help="VO shares per site")
+    parser.add_argument("--images", type=int, default=20, help="images per share")
+    parser.add_argument(
+        "--duplicates",
+        type=float,
+        default=0.05,
+        help="share of sites with two endpoints",
+    )
+    parser.add_argument(
+        "--accelerated",
+        type=float,
+        default=0.1,
+        help="share of instance types with accelerators",
+    )
+    parser.add_argument("--seed", type=int, default=0)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("directory")
+    add_arguments(parser)
+    args = parser.parse_args()
+    paths = write_federation(
+        args.directory,
+        args.sites,
+        args.vos,
+        args.images,
+        args.duplicates,
+        args.accelerated,
+        args.seed,
+    )
+    print(f"Wrote {len(paths)} files to {args.directory}")
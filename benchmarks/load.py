@@ -0,0 +1,225 @@
+"""
+Benchmark of the loading of the site information
+
+Generates a federation and measures the parsing of the sites, the clean up
+of duplicated sites, the cold load of the whole directory and incremental
+reloads of a single file, with the peak memory of each in a separate pass.
+The same loads are measured from a fake S3, whose latency and faults can be
+set as those of the fake GOCDB.
+
+    python -m benchmarks.load --sites 200 --vos 10 --images 50 --runs 5
+    python -m benchmarks.load --upstream-latency 0.05 --upstream-error-rate 0.1
+"""
+
+import argparse
+import asyncio
+import glob
+import json
+import os
+import time
+
+from app.glue import S3SiteStore
+
+from . import fakes, generator
+from .common import (
+    add_upstream_arguments,
+    configure_store,
+    environment,
+    federation,
+    make_store,
+    peak_memory,
+    print_result,
+    summarize,
+    upstream_faults,
+)
+
+
+def _read_infos(directory):
+    infos = []
+    for path in sorted(glob.glob(os.path.join(directory, "*.json"))):
+        with open(path) as f:
+            infos.append(f.read())
+    return infos
+
+
+def bench_create_site(store, infos, runs):
+    latencies = []
+    for _ in range(runs):
+        for text in infos:
+            # create_site modifies the info, start from a fresh copy every time
+            info = json.loads(text)
+            start = time.perf_counter()
+            store.create_site(info)
+            latencies.append(time.perf_counter() - start)
+    result = summarize(latencies, sum(latencies))
+    with peak_memory(result):
+        for text in infos:
+            store.create_site(json.loads(text))
+    return result
+
+
+def _grouped_sites(sites):
+    grouped = {}
+    for site in sites:
+        grouped.setdefault(site.name, []).append(site)
+    return grouped
+
+
+def bench_clean_up(store, sites, runs):
+    latencies = []
+    for _ in range(runs):
+        grouped = _grouped_sites(sites)
+        start = time.perf_counter()
+        store._clean_up_duplicated_sites(grouped)
+        latencies.append(time.perf_counter() - start)
+    result = summarize(latencies, sum(latencies), len(sites) * runs)
+    with peak_memory(result):
+        store._clean_up_duplicated_sites(_grouped_sites(sites))
+    return result
+
+
+async def bench_cold_load(directory, args, warmers):
+    async def load():
+        store = make_store(directory, args)
+        store.warmers.extend(warmers)
+        await store._load_sites()
+        return store
+
+    latencies = []
+    for _ in range(args.runs):
+        start = time.perf_counter()
+        await load()
+        latencies.append(time.perf_counter() - start)
+    result = summarize(latencies, sum(latencies))
+    with peak_memory(result):
+        store = await load()
+    result["sites"], result["shares"], result["images"] = store.snapshot().counts()
+    return result
+
+
+async def bench_reload(directory, args, warmers):
+    """Rewrites the file of a site with new shares and images and updates the
+    store with it, as done when the directory is watched"""
+    store = make_store(directory, args)
+    store.warmers.extend(warmers)
+    await store._load_sites()
+    path = os.path.join(directory, f"{generator.site_name(0)}-0.json")
+
+    async def reload(run):
+        with open(path, "w") as f:
+            json.dump(_new_info(args, run), f)
+        await store._update_site_files([path])
+
+    latencies = []
+    for run in range(args.runs):
+        start = time.perf_counter()
+        await reload(run)
+        latencies.append(time.perf_counter() - start)
+    result = summarize(latencies, sum(latencies))
+    with peak_memory(result):
+        await reload(args.runs)
+    return result
+
+
+def _new_info(args, run):
+    """Gets new information for the first site, different on every run"""
+    return generator.site_info(
+        0, 0, args.vos, args.images, args.accelerated, args.seed + run + 1
+    )
+
+
+async def bench_s3(directory, args, warmers):
+    """Loads the sites from a fake S3 with the generated files, then updates
+    the store after changing one of them"""
+    paths = sorted(glob.glob(os.path.join(directory, "*.json")))
+    objects = {}
+    for path in paths:
+        with open(path, "rb") as f:
+            objects[os.path.basename(path)] = f.read()
+    name = f"{generator.site_name(0)}-0.json"
+
+    def make_s3_store():
+        s3 = fakes.FakeS3(objects, **upstream_faults(args))
+        store = configure_store(S3SiteStore(s3_url=fakes.FakeS3.URL), args, s3)
+        store.warmers.extend(warmers)
+        return s3, store
+
+    latencies = []
+    for _ in range(args.runs):
+        _, store = make_s3_store()
+        start = time.perf_counter()
+        await store._update_sites()
+        latencies.append(time.perf_counter() - start)
+    cold = summarize(latencies, sum(latencies))
+    s3, store = make_s3_store()
+    with peak_memory(cold):
+        await store._update_sites()
+    cold["sites"] = len(store.get_sites())
+
+    latencies = []
+    for run in range(args.runs):
+        s3.put(name, _new_info(args, run))
+        start = time.perf_counter()
+        await store._update_sites()
+        latencies.append(time.perf_counter() - start)
+    reload = summarize(latencies, sum(latencies))
+    s3.put(name, _new_info(args, args.runs))
+    with peak_memory(reload):
+        await store._update_sites()
+    return cold, reload
+
+
+async def run(directory, args):
+    warmers = []
+    if args.warm:
+        from app.main import warm_snapshot
+
+        warmers.append(warm_snapshot)
+    store = make_store(directory, args)
+    infos = _read_infos(directory)
+    results = {}
+    results["create_site"] = bench_create_site(store, infos, args.runs)
+    print_result("create_site", results["create_site"])
+    sites = [store.create_site(json.loads(text)) for text in infos]
+    results["clean_up_duplicated_sites"] = bench_clean_up(store, sites, args.runs)
+    print_result("_clean_up_duplicated_sites", results["clean_up_duplicated_sites"])
+    results["cold_load"] = await bench_cold_load(directory, args, warmers)
+    print_result("cold load", results["cold_load"])
+    results["reload"] = await bench_reload(directory, args, warmers)
+    print_result("incremental reload", results["reload"])
+    results["s3_cold_load"], results["s3_reload"] = await bench_s3(
+        directory, args, warmers
+    )
+    print_result("S3 cold load", results["s3_cold_load"])
+    print_result("S3 incremental reload", results["s3_reload"])
+    return results
+
+
+def add_arguments(parser):
+    generator.add_arguments(parser)
+    add_upstream_arguments(parser)
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument(
+        "--warm",
+        action="store_true",
+        help="also prepare the responses of the app for the new sites",
+    )
+
+
+def main(args):
+    with federation(args) as directory:
+        results = asyncio.run(run(directory, args))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(
+                {"environment": environment(), "args": vars(args), "load": results},
+                f,
+                indent=2,
+            )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    add_arguments(parser)
+    parser.add_argument("--output", help="write the results as JSON to this file")
+    main(parser.parse_args())
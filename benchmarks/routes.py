@@ -0,0 +1,154 @@
+"""
+Load benchmark of the API routes
+
+Loads a generated federation in the site store of the app and sends
+concurrent requests to it in-process, reporting throughput and latency for
+every route, and the peak memory to serve them in a separate pass.
+
+    python -m benchmarks.routes --sites 200 --concurrency 64
+"""
+
+import argparse
+import asyncio
+import json
+import time
+
+import httpx
+
+from app.main import app, response_cache, site_store, vo_store
+
+from . import fakes, generator
+from .common import (
+    add_upstream_arguments,
+    configure_store,
+    environment,
+    federation,
+    peak_memory,
+    print_result,
+    summarize,
+    upstream_faults,
+)
+
+
+def routes(site_name, vo_name):
+    """Gets the (method, url, json body) of every route of the API, for a site
+    and one of its VOs"""
+    site = f"/site/{site_name}"
+    lookup = {"vo_name": vo_name, "site_names": [site_name]}
+    return [
+        ("GET", "/health", None),
+        ("GET", "/metrics", None),
+        ("GET", "/vos/", None),
+        ("GET", "/disciplines/", None),
+        ("GET", "/disciplines/tree", None),
+        ("GET", "/disciplines/1/vos", None),
+        ("GET", "/sites/", None),
+        ("GET", f"/sites/?vo_name={vo_name}", None),
+        ("GET", f"/sites/?vo_name={vo_name}&include=images,instancetypes", None),
+        ("GET", f"{site}/", None),
+        ("GET", f"{site}/projects", None),
+        ("GET", f"{site}/images", None),
+        ("GET", f"{site}/{vo_name}/project", None),
+        ("GET", f"{site}/{vo_name}/images", None),
+        ("POST", "/sites/lookup", lookup),
+        ("GET", "/images/search?q=ubuntu&version=2025.01.01", None),
+        ("GET", f"/images/?vo_name={vo_name}", None),
+        ("GET", "/images/?limit=1000", None),
+        ("GET", "/flavors/?min_cpu=4", None),
+        ("GET", "/flavors/?gpu=true", None),
+        ("GET", "/fedcloudclient/", None),
+        ("GET", f"/fedcloudclient/sites.yaml?vo_name={vo_name}", None),
+        ("GET", f"/fedcloudclient/{site_name}/", None),
+        ("GET", "/changes/?since=0", None),
+    ]
+
+
+async def _request(client, method, url, body, cached):
+    if not cached:
+        response_cache.clear()
+    return await client.request(method, url, json=body)
+
+
+async def run_route(client, method, url, body, requests, concurrency, cached):
+    latencies = []
+    errors = 0
+    pending = iter(range(requests))
+
+    async def worker():
+        nonlocal errors
+        for _ in pending:
+            start = time.perf_counter()
+            r = await _request(client, method, url, body, cached)
+            latencies.append(time.perf_counter() - start)
+            if r.status_code != 200:
+                errors += 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    result = summarize(latencies, time.perf_counter() - start)
+    result.update(method=method, url=url, errors=errors)
+    with peak_memory(result):
+        for _ in range(min(requests, 10)):
+            await _request(client, method, url, body, cached)
+    return result
+
+
+async def load(directory, args):
+    site_store.cloud_info_dir = directory
+    configure_store(site_store, args)
+    start = time.perf_counter()
+    await site_store._load_sites()
+    print(f"Loaded the site store in {time.perf_counter() - start:.1f} s")
+    ops_portal = fakes.FakeOpsPortal(
+        [generator.vo_name(v) for v in range(args.vos * 2)],
+        disciplines=[d.id for d in vo_store.get_disciplines()],
+        **upstream_faults(args),
+    )
+    vo_store.ops_portal_url = fakes.FakeOpsPortal.URL
+    vo_store.httpx_client = fakes.client(ops_portal, timeout=args.upstream_timeout)
+    vo_store._vos = []
+
+
+async def run(directory, args):
+    await load(directory, args)
+    site = site_store.snapshot().get_site_by_name(generator.site_name(1))
+    results = []
+    async with httpx.AsyncClient(
+        transport=httpx.ASGITransport(app=app), base_url="http://bench"
+    ) as client:
+        for method, url, body in routes(site.name, site.shares[0].vo):
+            result = await run_route(
+                client, method, url, body, args.requests, args.concurrency, args.cached
+            )
+            results.append(result)
+            print_result(f"{method} {url}", result)
+    return results
+
+
+def add_arguments(parser):
+    generator.add_arguments(parser)
+    add_upstream_arguments(parser)
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=64)
+    parser.add_argument(
+        "--cached", action="store_true", help="keep the response cache enabled"
+    )
+
+
+def main(args):
+    with federation(args) as directory:
+        results = asyncio.run(run(directory, args))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(
+                {"environment": environment(), "args": vars(args), "routes": results},
+                f,
+                indent=2,
+            )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    add_arguments(parser)
+    parser.add_argument("--output", help="write the results as JSON to this file")
+    main(parser.parse_args())
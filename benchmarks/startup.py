@@ -0,0 +1,181 @@
+"""
+Benchmark of the startup of the API
+
+Measures the time to import the app, and in new uvicorn processes serving a
+generated federation the time until they accept connections, answer /sites/
+and list every site, with GOCDB and the Operations Portal served over HTTP by
+the fake services.
+
+    python -m benchmarks.startup --sites 200 --runs 5
+    python -m benchmarks.startup --upstream-latency 0.5
+"""
+
+import argparse
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+
+import httpx
+
+from . import fakes, generator
+from .common import (
+    add_upstream_arguments,
+    environment,
+    fake_gocdb,
+    federation,
+    percentile,
+    upstream_faults,
+)
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+IMPORT_APP = (
+    "import time; start = time.perf_counter(); import app.main; "
+    "print(time.perf_counter() - start)"
+)
+
+
+def summarize_times(times):
+    return {
+        "runs": len(times),
+        "p50_ms": percentile(times, 0.5) * 1000,
+        "min_ms": min(times) * 1000,
+        "max_ms": max(times) * 1000,
+    }
+
+
+def import_times(runs):
+    """Gets the time to import the app in runs new interpreters"""
+    return [
+        float(
+            subprocess.run(
+                [sys.executable, "-c", IMPORT_APP],
+                capture_output=True,
+                text=True,
+                check=True,
+                cwd=ROOT,
+            ).stdout
+        )
+        for _ in range(runs)
+    ]
+
+
+def slowest_imports(top=10):
+    """Gets the modules taking the longest to import, by their own time"""
+    stderr = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import app.main"],
+        capture_output=True,
+        text=True,
+        check=True,
+        cwd=ROOT,
+    ).stderr
+    imports = []
+    for line in stderr.splitlines():
+        # import time: self [us] | cumulative | imported package
+        fields = line.removeprefix("import time:").split("|")
+        if len(fields) == 3 and fields[0].strip().isdigit():
+            imports.append((int(fields[0]) / 1000, fields[2].strip()))
+    imports.sort(reverse=True)
+    return [{"module": name, "self_ms": ms} for ms, name in imports[:top]]
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_server(env, sites, timeout=120):
+    """Starts the API in a new process, returns the seconds until it accepted
+    a connection, answered /sites/ and listed all the sites"""
+    port = _free_port()
+    start = time.perf_counter()
+    process = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "app.main:app", "--port", str(port)]
+        + ["--log-level", "warning"],
+        env=env,
+        cwd=ROOT,
+    )
+    times = {}
+    try:
+        with httpx.Client(base_url=f"http://127.0.0.1:{port}") as client:
+            while time.perf_counter() - start < timeout:
+                if process.poll() is not None:
+                    raise RuntimeError("The API exited while starting")
+                try:
+                    if "accept" not in times:
+                        socket.create_connection(("127.0.0.1", port)).close()
+                        times["accept"] = time.perf_counter() - start
+                    r = client.get("/sites/", params={"fields": "name"})
+                except (OSError, httpx.HTTPError):
+                    time.sleep(0.005)
+                    continue
+                if r.status_code == 200:
+                    times.setdefault("first_sites", time.perf_counter() - start)
+                    if len(r.json()) >= sites:
+                        times["all_sites"] = time.perf_counter() - start
+                        return times
+                time.sleep(0.005)
+        raise RuntimeError(f"The API didn't list all the sites in {timeout} s")
+    finally:
+        process.terminate()
+        process.wait()
+
+
+def run(directory, args):
+    results = {"import": summarize_times(import_times(args.runs))}
+    print(f"{'import app.main':50} p50 {results['import']['p50_ms']:8.1f} ms")
+    results["slowest_imports"] = slowest_imports()
+    for item in results["slowest_imports"]:
+        print(f"  {item['module']:48} {item['self_ms']:8.1f} ms")
+    ops_portal = fakes.FakeOpsPortal(args.vos * 2, **upstream_faults(args))
+    # every endpoint is published as a different site
+    sites = len(generator.endpoints(args.sites, args.duplicates))
+    starts = []
+    with (
+        fakes.serve(fake_gocdb(args)) as gocdb_url,
+        fakes.serve(ops_portal) as ops_portal_url,
+    ):
+        env = dict(
+            os.environ,
+            CLOUD_INFO_DIR=directory,
+            GOCDB_URL=gocdb_url,
+            OPS_PORTAL_URL=ops_portal_url,
+        )
+        for _ in range(args.runs):
+            starts.append(start_server(env, sites))
+    for name, label in [
+        ("accept", "first accepted connection"),
+        ("first_sites", "first /sites/ response"),
+        ("all_sites", "/sites/ with all the sites"),
+    ]:
+        results[name] = summarize_times([times[name] for times in starts])
+        print(f"{label:50} p50 {results[name]['p50_ms']:8.1f} ms")
+    return results
+
+
+def add_arguments(parser):
+    generator.add_arguments(parser)
+    add_upstream_arguments(parser)
+    parser.add_argument("--runs", type=int, default=5)
+
+
+def main(args):
+    with federation(args) as directory:
+        results = run(directory, args)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(
+                {"environment": environment(), "args": vars(args), "startup": results},
+                f,
+                indent=2,
+            )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    add_arguments(parser)
+    parser.add_argument("--output", help="write the results as JSON to this file")
+    main(parser.parse_args())
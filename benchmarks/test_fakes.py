@@ -0,0 +1,112 @@
+"""Testing the fake upstream services"""
+
+import asyncio
+
+import httpx
+import pytest
+
+from app import glue
+
+from . import fakes, generator
+
+
+@pytest.fixture
+def site_info():
+    return generator.site_info(0, vos=1, images=1)
+
+
+def test_fake_ops_portal():
+    ops_portal = fakes.FakeOpsPortal(["alice", "ops"], token="secret")
+    vo_store = glue.VOStore(
+        ops_portal_url=fakes.FakeOpsPortal.URL,
+        ops_portal_token="secret",
+        httpx_client=fakes.client(ops_portal),
+    )
+    assert [vo.name for vo in vo_store.get_vos()] == ["alice", "ops"]
+    vo_store.ops_portal_token = "wrong"
+    vo_store.update_vos()
+    # the last VOs are kept
+    assert [vo.name for vo in vo_store.get_vos()] == ["alice", "ops"]
+    assert ops_portal.requests == 2
+
+
+def test_fake_ops_portal_disciplines():
+    ops_portal = fakes.FakeOpsPortal(["alice", "ops", "lhcb"], disciplines=["1", "2"])
+    vo_store = glue.VOStore(
+        ops_portal_url=fakes.FakeOpsPortal.URL, httpx_client=fakes.client(ops_portal)
+    )
+    assert [vo.disciplines for vo in vo_store.get_vos()] == [["2"], ["1"], ["2"]]
+
+
+def test_fake_gocdb():
+    gocdb = fakes.FakeGOCDB(
+        [("1G0", "cloud.a.example.com", "A"), ("2G0", "cloud.b.example.com", "B")]
+    )
+    site_store = glue.SiteStore(
+        gocdb_url=fakes.FakeGOCDB.URL, httpx_client=fakes.client(gocdb)
+    )
+    assert site_store._get_gocdb_hostname("2G0") == "cloud.b.example.com"
+    assert site_store._get_gocdb_hostname("3G0") == ""
+    # cached after the first request
+    assert gocdb.requests == 1
+
+
+def test_fake_s3(site_info):
+    s3 = fakes.FakeS3({"site.json": site_info})
+    gocdb = fakes.FakeGOCDB([(generator.gocdb_id(0), "foo", "SITE")])
+    site_store = glue.S3SiteStore(
+        s3_url=fakes.FakeS3.URL,
+        gocdb_url=fakes.FakeGOCDB.URL,
+        httpx_client=fakes.client(s3, gocdb),
+    )
+    asyncio.run(site_store._update_sites())
+    [site] = site_store.get_sites()
+    assert (site.name, site.hostname) == (generator.site_name(0), "foo")
+    # listing, object and GOCDB
+    assert (s3.requests, gocdb.requests) == (2, 1)
+    asyncio.run(site_store._update_sites())
+    assert s3.requests == 3
+    s3.put("site.json", site_info)
+    asyncio.run(site_store._update_sites())
+    assert s3.requests == 5
+    s3.delete("site.json")
+    asyncio.run(site_store._update_sites())
+    assert site_store.get_sites() == []
+
+
+def test_fake_service_faults():
+    delays = []
+    ops_portal = fakes.FakeOpsPortal(
+        3, latency=0.5, bandwidth=1000, padding=100, sleep=delays.append
+    )
+    response = fakes.client(ops_portal).get(fakes.FakeOpsPortal.URL)
+    assert len(response.json()["data"]) == 3
+    assert response.content.endswith(b" " * 100)
+    assert delays == [0.5 + len(response.content) / 1000]
+
+    ops_portal = fakes.FakeOpsPortal(error_rate=1, sleep=delays.append)
+    response = fakes.client(ops_portal).get(fakes.FakeOpsPortal.URL)
+    assert response.status_code == 503
+    assert ops_portal.errors == 1
+
+    delays = []
+    ops_portal = fakes.FakeOpsPortal(timeout_rate=1, sleep=delays.append)
+    with pytest.raises(httpx.ReadTimeout):
+        fakes.client(ops_portal, timeout=2).get(fakes.FakeOpsPortal.URL)
+    # waits for the timeout of the client
+    assert delays == [2]
+    assert ops_portal.timeouts == 1
+
+    with pytest.raises(httpx.ConnectError):
+        fakes.client(ops_portal).get("https://unknown.example.com")
+
+
+def test_serve(site_info):
+    s3 = fakes.FakeS3({"site.json": site_info}, timeout_rate=1, hang=0)
+    gocdb = fakes.FakeGOCDB([("1234G0", "cloud.example.com", "SITE")])
+    with fakes.serve(gocdb) as gocdb_url, fakes.serve(s3) as s3_url:
+        r = httpx.get(f"{gocdb_url}/gocdbpi/public/", params={"method": "get_service"})
+        assert r.headers["content-type"] == "application/xml"
+        assert "<HOSTNAME>cloud.example.com</HOSTNAME>" in r.text
+        with pytest.raises(httpx.HTTPError):
+            httpx.get(s3_url)
@@ -0,0 +1,285 @@
+"""
+Load test with a mix of API calls
+
+Replays a weighted mix of the calls done by the clients of the API against a
+running instance, or in-process on a generated federation, with a number of
+concurrent clients, reporting throughput, latency percentiles and errors for
+every kind of call. In-process, the sites can be reloaded during the run to
+see how the reloads affect the requests. The calls can be recorded to a file
+and replayed later, so different versions see the same traffic.
+
+    python -m benchmarks.traffic --sites 200 --concurrency 64 --duration 30
+    python -m benchmarks.traffic --reload-interval 1 --record calls.txt
+    python -m benchmarks.traffic --url http://localhost:8000 --replay calls.txt
+"""
+
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import random
+import time
+from collections import Counter
+
+import httpx
+
+from . import generator
+from .common import (
+    add_upstream_arguments,
+    environment,
+    federation,
+    print_result,
+    summarize,
+)
+
+# relative weight of every kind of call in the default mix
+MIX = {
+    "vos": 1,
+    "sites": 4,
+    "site_images": 8,
+    "images": 3,
+    "fedcloudclient": 2,
+}
+CALLS = {
+    "vos": "/vos/",
+    "sites": "/sites/?vo_name={vo}",
+    "site_images": "/site/{site}/{vo}/images",
+    "images": "/images/?vo_name={vo}",
+    "fedcloudclient": "/fedcloudclient/{site}/",
+}
+
+
+def parse_mix(value):
+    """Parses a mix like "sites=4,images=1", the kinds not listed aren't
+    called"""
+    mix = {}
+    for item in value.split(","):
+        kind, _, weight = item.partition("=")
+        if kind.strip() not in CALLS:
+            raise argparse.ArgumentTypeError(f"Unknown call {kind}")
+        mix[kind.strip()] = float(weight or 1)
+    return mix
+
+
+def plan(targets, mix, requests, seed=0):
+    """Gets requests (kind, url) calls following the mix, with (site, VO)
+    pairs picked from targets"""
+    rng = random.Random(seed)
+    kinds = list(mix)
+    weights = [mix[kind] for kind in kinds]
+    calls = []
+    for kind in rng.choices(kinds, weights, k=requests):
+        site, vo = rng.choice(targets)
+        calls.append((kind, CALLS[kind].format(site=site, vo=vo)))
+    return calls
+
+
+def write_calls(path, calls):
+    with open(path, "w") as f:
+        f.writelines(f"{kind} {url}\n" for kind, url in calls)
+
+
+def read_calls(path):
+    """Reads the calls to replay, one "kind url" or just "url" per line"""
+    calls = []
+    with open(path) as f:
+        for line in f:
+            parts = line.split()
+            if not parts or parts[0].startswith("#"):
+                continue
+            if len(parts) == 1:
+                kind = parts[0].strip("/").split("/")[0].split("?")[0] or "root"
+                parts = [kind, parts[0]]
+            calls.append((parts[0], parts[1]))
+    return calls
+
+
+async def discover(client):
+    """Gets the (site, VO) pairs served by the API"""
+    targets = []
+    for vo in (await client.get("/vos/")).json():
+        r = await client.get("/sites/", params={"vo_name": vo, "fields": "name"})
+        targets.extend((site["name"], vo) for site in r.json())
+    return targets
+
+
+async def replay(client, calls, concurrency, duration=None):
+    """Sends the calls with concurrency clients, once or over and over for
+    duration seconds, returning (kind, status, latency) for every call"""
+    samples = []
+    pending = itertools.cycle(calls) if duration else iter(calls)
+    deadline = time.perf_counter() + duration if duration else None
+
+    async def worker():
+        for kind, url in pending:
+            if deadline and time.perf_counter() > deadline:
+                return
+            start = time.perf_counter()
+            try:
+                r = await client.get(url)
+                status = r.status_code
+            except httpx.HTTPError as e:
+                status = type(e).__name__
+            samples.append((kind, status, time.perf_counter() - start))
+
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return samples
+
+
+def report(samples, elapsed):
+    """Summarizes the samples overall and by kind of call. Server errors and
+    failed requests are counted as errors, other statuses are reported apart
+    as they may be expected, e.g. a site that no longer supports a VO"""
+    by_kind = {"all": samples}
+    for sample in samples:
+        by_kind.setdefault(sample[0], []).append(sample)
+    results = {}
+    for kind, kind_samples in by_kind.items():
+        statuses = Counter(str(status) for _, status, _ in kind_samples)
+        errors = sum(
+            1
+            for _, status, _ in kind_samples
+            if not isinstance(status, int) or status >= 500
+        )
+        result = summarize([latency for *_, latency in kind_samples], elapsed)
+        result.update(
+            errors=errors,
+            error_rate=errors / len(kind_samples),
+            statuses=dict(statuses),
+        )
+        results[kind] = result
+    return results
+
+
+async def reload_sites(site_store, directory, args, latencies):
+    """Rewrites the file of a site with new shares and images every
+    reload_interval seconds, going through all the sites, and updates the
+    store with it as done when the directory is watched"""
+    for run in itertools.count():
+        await asyncio.sleep(args.reload_interval)
+        i = run % args.sites
+        path = os.path.join(directory, f"{generator.site_name(i)}-0.json")
+        info = generator.site_info(
+            i, 0, args.vos, args.images, args.accelerated, args.seed + run + 1
+        )
+        with open(path, "w") as f:
+            json.dump(info, f)
+        start = time.perf_counter()
+        await site_store._update_site_files([path])
+        latencies.append(time.perf_counter() - start)
+
+
+async def run(client, args, reload=None):
+    """Runs the load test with client, reload is a coroutine function
+    triggering reloads, if any"""
+    if args.replay:
+        calls = read_calls(args.replay)
+    else:
+        targets = await discover(client)
+        if not targets:
+            raise SystemExit("No sites found to send requests about")
+        calls = plan(targets, args.mix, args.requests, args.seed)
+    if args.record:
+        write_calls(args.record, calls)
+    reload_latencies = []
+    reloads = None
+    if reload is not None and args.reload_interval:
+        reloads = asyncio.create_task(reload(reload_latencies))
+    start = time.perf_counter()
+    try:
+        samples = await replay(client, calls, args.concurrency, args.duration)
+    finally:
+        if reloads is not None:
+            reloads.cancel()
+    results = report(samples, time.perf_counter() - start)
+    for kind, result in results.items():
+        print_result(kind, result)
+    if reload_latencies:
+        results["reload"] = summarize(reload_latencies, sum(reload_latencies))
+        print_result("reload", results["reload"])
+    return results
+
+
+async def run_in_process(directory, args):
+    """Runs the load test on the app, with the generated federation"""
+    from app.main import app, site_store
+
+    from . import routes
+
+    await routes.load(directory, args)
+    async with httpx.AsyncClient(
+        transport=httpx.ASGITransport(app=app), base_url="http://bench"
+    ) as client:
+        return await run(
+            client,
+            args,
+            lambda latencies: reload_sites(site_store, directory, args, latencies),
+        )
+
+
+async def run_live(args):
+    limits = httpx.Limits(max_connections=args.concurrency)
+    async with httpx.AsyncClient(
+        base_url=args.url, timeout=args.timeout, limits=limits
+    ) as client:
+        return await run(client, args)
+
+
+def add_arguments(parser):
+    """Adds the arguments of the load test, but the generator's"""
+    parser.add_argument(
+        "--mix",
+        type=parse_mix,
+        default=MIX,
+        help="weights of the calls, e.g. sites=4,site_images=8,images=1, "
+        f"out of {', '.join(CALLS)}",
+    )
+    parser.add_argument(
+        "--requests", type=int, default=5000, help="number of calls to plan"
+    )
+    parser.add_argument("--concurrency", type=int, default=64)
+    parser.add_argument(
+        "--duration",
+        type=float,
+        help="repeat the calls for this many seconds instead of once",
+    )
+    parser.add_argument(
+        "--reload-interval",
+        type=float,
+        default=0,
+        help="reload a site every this many seconds, only in-process",
+    )
+
+
+def main(args):
+    if args.url:
+        results = asyncio.run(run_live(args))
+    else:
+        with federation(args) as directory:
+            results = asyncio.run(run_in_process(directory, args))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(
+                {"environment": environment(), "args": vars(args), "traffic": results},
+                f,
+                indent=2,
+            )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    generator.add_arguments(parser)
+    add_upstream_arguments(parser)
+    add_arguments(parser)
+    parser.add_argument("--url", help="base URL of a running API, else in-process")
+    parser.add_argument(
+        "--timeout", type=float, default=30, help="timeout of the live requests"
+    )
+    parser.add_argument("--record", help="write the calls to this file")
+    parser.add_argument("--replay", help="replay the calls in this file")
+    parser.add_argument("--output", help="write the results as JSON to this file")
+    args = parser.parse_args()
+    if args.url and args.reload_interval:
+        parser.error("reloads can only be triggered in-process")
+    main(args)